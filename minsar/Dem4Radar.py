@@ -4,6 +4,9 @@
 ############################################################
 import argparse
 import os
+import json
+import hashlib
+import multiprocessing as mp
 import numpy as np
 import glob
 import matplotlib.pyplot as plt
@@ -57,6 +60,8 @@ parser.add_argument('--offset', '-d', type=float, help='dem offset e.g., it is 2
 parser.add_argument('--fontsize', '-f', type=float, help='font size')
 parser.add_argument('--figsizey', '-figy', type=float, help='figure size in y direction')
 parser.add_argument('--figsizex', '-figx', type=float, help='figure size in x direction')
+parser.add_argument('--num-workers', dest='num_workers', type=int, default=min(8, os.cpu_count() or 1),
+                    help='number of processes for the amplitude statistics (default: %(default)s)')
 
 args = parser.parse_args()
 
@@ -71,7 +76,7 @@ outfile=args.outfile
 #### Input files
 #out_dir = './out_figures'
 out_dir = '.'
-out_amplitude = project_dir + '/mean_amplitude.npy'
+out_amplitude = project_dir + '/amplitude_stats.h5'
 geom_dsm = '/work2/05861/tg851601/stampede2/insarlab/DEM/Miami_DSM/dsm_reprojected_wgs84.tif'   
 geom_dsm = project_dir + '/../../dsm_reprojected_wgs84.tif'
 demError_file = project_dir + '/demErr.h5'
@@ -85,27 +90,91 @@ tsStack = project_dir + '/timeseries_demErr.h5'
 #tsStack = project_dir + '/timeseries_ERA5_demErr.h5'
 slcStack = project_dir + '/../inputs/slcStack.h5'
 ##### 
-def calculate_mean_amplitude(slcStack, out_amplitude):
+# block size of the amplitude statistics (all dates of a row block are read at once)
+MAX_BLOCK_MB = 256
+
+
+def get_stack_fingerprint(slcStack):
+    """ identifies the SLC stack (path, size, modification time, shape) """
+    with h5py.File(slcStack, 'r') as f:
+        shape = f['slc'].shape
+    stat = os.stat(slcStack)
+    items = [os.path.abspath(slcStack), stat.st_size, int(stat.st_mtime), list(shape)]
+    return hashlib.md5(json.dumps(items).encode()).hexdigest()
+
+
+def get_row_blocks(slcStack, max_mb=MAX_BLOCK_MB):
+    """ row blocks of whole HDF5 chunks with all dates of a block below max_mb """
     with h5py.File(slcStack, 'r') as f:
         slcs = f['slc']
-        s_shape = slcs.shape
-        mean_amplitude = np.zeros((s_shape[1], s_shape[2]), dtype='float32')
-        lines = np.arange(0, s_shape[1], 100)
-        for t in lines:
-            last = t + 100
-            if t == lines[-1]:
-                lst = s_shape[1]
+        num_date, length, width = slcs.shape
+        chunk_rows = slcs.chunks[1] if slcs.chunks else 1
+        row_bytes = num_date * width * slcs.dtype.itemsize
+    num_rows = max(1, int(max_mb * 1024 ** 2 / row_bytes) // chunk_rows) * chunk_rows
+    return [(row0, min(row0 + num_rows, length)) for row0 in range(0, length, num_rows)]
 
-            mean_amplitude[t:last, :] = np.mean(np.abs(f['slc'][:,t:last,:]), axis=0)
-            np.save(out_amplitude, mean_amplitude)
-    return
 
+def calculate_block_statistics(job):
+    """ sum, sum of squares and number of non-zero amplitudes of a row block (runs in a worker) """
+    slcStack, row0, row1 = job
+    with h5py.File(slcStack, 'r') as f:
+        slcs = f['slc']
+        amp_sum = np.zeros((row1 - row0, slcs.shape[2]), dtype=np.float64)
+        amp_sum2 = np.zeros(amp_sum.shape, dtype=np.float64)
+        count = np.zeros(amp_sum.shape, dtype=np.int32)
+        amplitude = np.abs(slcs[:, row0:row1, :])
+        for amp in amplitude:
+            amp_sum += amp
+            amp_sum2 += amp.astype(np.float64) ** 2
+            count += amp > 0
+    return row0, row1, amp_sum, amp_sum2, count
+
+
+def calculate_mean_amplitude(slcStack, out_amplitude, num_workers=1):
+    """ mean amplitude, amplitude dispersion (std / mean) and number of valid dates in one pass over
+        the SLC stack; the result is reused as long as the stack fingerprint does not change """
+    fingerprint = get_stack_fingerprint(slcStack)
+    if os.path.exists(out_amplitude):
+        with h5py.File(out_amplitude, 'r') as f:
+            if f.attrs.get('FINGERPRINT') == fingerprint:
+                return out_amplitude
+
+    with h5py.File(slcStack, 'r') as f:
+        length, width = f['slc'].shape[1:]
+    jobs = [(slcStack, row0, row1) for row0, row1 in get_row_blocks(slcStack)]
+
+    tmp_file = out_amplitude + '.tmp'
+    with h5py.File(tmp_file, 'w') as fo:
+        for dsName, dtype in [('mean', np.float32), ('dispersion', np.float32), ('count', np.int32)]:
+            fo.create_dataset(dsName, shape=(length, width), dtype=dtype, chunks=True)
+        pool = mp.Pool(min(num_workers, len(jobs))) if num_workers > 1 and len(jobs) > 1 else None
+        try:
+            results = pool.imap_unordered(calculate_block_statistics, jobs) if pool else map(calculate_block_statistics, jobs)
+            for i, (row0, row1, amp_sum, amp_sum2, count) in enumerate(results):
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    mean = amp_sum / count
+                    dispersion = np.sqrt(np.maximum(amp_sum2 / count - mean ** 2, 0)) / mean
+                fo['mean'][row0:row1, :] = np.nan_to_num(mean)
+                fo['dispersion'][row0:row1, :] = np.nan_to_num(dispersion)
+                fo['count'][row0:row1, :] = count
+                print('amplitude statistics: {} of {} blocks'.format(i + 1, len(jobs)))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        fo.attrs['FINGERPRINT'] = fingerprint
+        fo.attrs['FILE_PATH'] = os.path.abspath(slcStack)
+    os.replace(tmp_file, out_amplitude)
+    return out_amplitude
+
+
+def read_window(fname, datasetName, ymin, ymax, xmin, xmax):
+    """ reads only the plotted subset of a 2D dataset """
+    return readfile.read(fname, datasetName=datasetName, box=(xmin, ymin, xmax, ymax))[0]
 
 
 def get_data(ymin, ymax, xmin, xmax, ps, out_amplitude, shift=0):
  
-    velocity, atr = readfile.read(vel_file, datasetName='velocity')
-
     if ymin >= ymax:
        tmp_ymin = ymin
        tmp_ymax = ymax
@@ -117,6 +186,8 @@ def get_data(ymin, ymax, xmin, xmax, ps, out_amplitude, shift=0):
        xmin = tmp_xmax 
        xmax = tmp_xmin 
 
+    velocity, atr = readfile.read(vel_file, datasetName='velocity', box=(xmin, ymin, xmax, ymax))
+
     # needed as for Tsx there is no ORBIT_DIRECTION attribute
     try:
         orbit_direction = attr['ORBIT_DIRECTION']
@@ -133,35 +204,20 @@ def get_data(ymin, ymax, xmin, xmax, ps, out_amplitude, shift=0):
             orbit_direction = 'DESCENDING'
 
     if orbit_direction == 'ASCENDING':
-        flipud_flag = True
-        fliplr_flag = False
+        flip = np.flipud
     if orbit_direction == 'DESCENDING':
-        flipud_flag = False
-        fliplr_flag = True
+        flip = np.fliplr
 
     # need to check in view.py how Yunjun is doing the flipping and whetehr it works for TSX (does he has the ORBIT_DIRECTION attribute?)
-    if flipud_flag:
-       DEM = np.flipud(readfile.read(geo_file, datasetName='height')[0][ymin:ymax, xmin:xmax]) + shift
-       demError = np.flipud(readfile.read(demError_file, datasetName='dem')[0][ymin:ymax, xmin:xmax])
-       amplitude = np.flipud(np.load(out_amplitude)[ymin:ymax, xmin:xmax]) 
-       mask_t = np.flipud(readfile.read(mask_file_t, datasetName='mask')[0][ymin:ymax, xmin:xmax])
-       mask_p = np.flipud(readfile.read(mask_file_ps, datasetName='mask')[0][ymin:ymax, xmin:xmax])
-       if ps:
-           mask = mask_p
-       else:
-           mask=mask_t
-       velocity = np.flipud(velocity[ymin:ymax, xmin:xmax])
-    if fliplr_flag:
-       DEM = np.fliplr(readfile.read(geo_file, datasetName='height')[0][ymin:ymax, xmin:xmax]) + shift
-       demError = np.fliplr(readfile.read(demError_file, datasetName='dem')[0][ymin:ymax, xmin:xmax])
-       amplitude = np.fliplr(np.load(out_amplitude)[ymin:ymax, xmin:xmax]) 
-       mask_t = np.fliplr(readfile.read(mask_file_t, datasetName='mask')[0][ymin:ymax, xmin:xmax])
-       mask_p = np.fliplr(readfile.read(mask_file_ps, datasetName='mask')[0][ymin:ymax, xmin:xmax])
-       if ps:
-           mask = mask_p
-       else:
-           mask=mask_t
-       velocity = np.fliplr(velocity[ymin:ymax, xmin:xmax])
+    DEM = flip(read_window(geo_file, 'height', ymin, ymax, xmin, xmax)) + shift
+    demError = flip(read_window(demError_file, 'dem', ymin, ymax, xmin, xmax))
+    with h5py.File(out_amplitude, 'r') as f:
+        amplitude = flip(f['mean'][ymin:ymax, xmin:xmax])
+    if ps:
+        mask = flip(read_window(mask_file_ps, 'mask', ymin, ymax, xmin, xmax))
+    else:
+        mask = flip(read_window(mask_file_t, 'mask', ymin, ymax, xmin, xmax))
+    velocity = flip(velocity)
   
     vel = velocity[mask==1]*1000
     demerr = demError[mask==1]
@@ -253,60 +309,66 @@ def plot_subset(ymin, ymax, xmin, xmax, ps, vel_range, amplitude_im, dem_offset,
 
 ######
 
-if args.fontsize is not None:
-    f=args.fontsize
-else:
-    f=10
-
-plt.rcParams["font.size"] = f
-
-if not os.path.exists(out_amplitude):
-   calculate_mean_amplitude(slcStack, out_amplitude)
-
-#points_lalo = np.array([[25.875, -80.122],
-#                  [25.8795, -80.121]])
-
-points_lalo = np.array([[lat1, lon1],
-                  [lat2, lon2]])
-print (points_lalo)
-
-attr = readfile.read_attribute(tsStack)
-coord = ut.coordinate(attr, geo_file)
-yg1, xg1 = coord.geo2radar(points_lalo[0][0], points_lalo[0][1])[0:2]
-yg2, xg2 = coord.geo2radar(points_lalo[1][0], points_lalo[1][1])[0:2]
-print (yg1, xg1, yg2, xg2)
-
-yg1, xg1 = coord.geo2radar(points_lalo[0][0], points_lalo[0][1])[0:2]
-yg2, xg2 = coord.geo2radar(points_lalo[0][0], points_lalo[1][1])[0:2]
-yg3, xg3 = coord.geo2radar(points_lalo[1][0], points_lalo[0][1])[0:2]
-yg4, xg4 = coord.geo2radar(points_lalo[1][0], points_lalo[1][1])[0:2]
-print("Lat, Lon, y, x: ",points_lalo[0][0], points_lalo[0][1], yg1, xg1)
-print("Lat, Lon, y, x: ",points_lalo[0][0], points_lalo[1][1], yg2, xg2)
-print("Lat, Lon, y, x: ",points_lalo[1][0], points_lalo[0][1], yg3, xg3)
-print("Lat, Lon, y, x: ",points_lalo[1][0], points_lalo[1][1], yg4, xg4)
-print (yg1, xg1, yg2, xg2, yg3, xg3, yg4, xg4)
-ymin = min(yg1, yg2, yg3, yg4)
-ymax = max(yg1, yg2, yg3, yg4)
-xmin = min(xg1, xg2, xg3, xg4)
-xmax = max(xg1, xg2, xg3, xg4)
-print (ymin, xmin, ymax, xmax)
-#import pdb; pdb.set_trace()
-
-if args.psize is not None:
-        size=args.psize
-else:
-        size=10
-
-if args.vrange is not None:
-        vel=args.vrange
-else:
-        vel=0.6
-
-if args.offset is not None:
-        doff=args.offset
-else:
-        doff=26
-
-plot_subset(ymin=ymin, ymax=ymax, xmin=xmin, xmax=xmax, ps=True, vel_range=vel,
-            amplitude_im=out_amplitude, dem_offset=doff, dem_name='dem', 
-            out_name=outfile, out_dir=out_dir, size=size)
+def main():
+    global attr
+
+    if args.fontsize is not None:
+        f=args.fontsize
+    else:
+        f=10
+
+    plt.rcParams["font.size"] = f
+
+    calculate_mean_amplitude(slcStack, out_amplitude, num_workers=args.num_workers)
+
+    #points_lalo = np.array([[25.875, -80.122],
+    #                  [25.8795, -80.121]])
+
+    points_lalo = np.array([[lat1, lon1],
+                      [lat2, lon2]])
+    print (points_lalo)
+
+    attr = readfile.read_attribute(tsStack)
+    coord = ut.coordinate(attr, geo_file)
+    yg1, xg1 = coord.geo2radar(points_lalo[0][0], points_lalo[0][1])[0:2]
+    yg2, xg2 = coord.geo2radar(points_lalo[1][0], points_lalo[1][1])[0:2]
+    print (yg1, xg1, yg2, xg2)
+
+    yg1, xg1 = coord.geo2radar(points_lalo[0][0], points_lalo[0][1])[0:2]
+    yg2, xg2 = coord.geo2radar(points_lalo[0][0], points_lalo[1][1])[0:2]
+    yg3, xg3 = coord.geo2radar(points_lalo[1][0], points_lalo[0][1])[0:2]
+    yg4, xg4 = coord.geo2radar(points_lalo[1][0], points_lalo[1][1])[0:2]
+    print("Lat, Lon, y, x: ",points_lalo[0][0], points_lalo[0][1], yg1, xg1)
+    print("Lat, Lon, y, x: ",points_lalo[0][0], points_lalo[1][1], yg2, xg2)
+    print("Lat, Lon, y, x: ",points_lalo[1][0], points_lalo[0][1], yg3, xg3)
+    print("Lat, Lon, y, x: ",points_lalo[1][0], points_lalo[1][1], yg4, xg4)
+    print (yg1, xg1, yg2, xg2, yg3, xg3, yg4, xg4)
+    ymin = min(yg1, yg2, yg3, yg4)
+    ymax = max(yg1, yg2, yg3, yg4)
+    xmin = min(xg1, xg2, xg3, xg4)
+    xmax = max(xg1, xg2, xg3, xg4)
+    print (ymin, xmin, ymax, xmax)
+    #import pdb; pdb.set_trace()
+
+    if args.psize is not None:
+            size=args.psize
+    else:
+            size=10
+
+    if args.vrange is not None:
+            vel=args.vrange
+    else:
+            vel=0.6
+
+    if args.offset is not None:
+            doff=args.offset
+    else:
+            doff=26
+
+    plot_subset(ymin=ymin, ymax=ymax, xmin=xmin, xmax=xmax, ps=True, vel_range=vel,
+                amplitude_im=out_amplitude, dem_offset=doff, dem_name='dem', 
+                out_name=outfile, out_dir=out_dir, size=size)
+
+
+if __name__ == '__main__':
+    main()
@@ -32,11 +32,28 @@
 import logging
 import argparse
 import os
+import time
+import multiprocessing as mp
 
+import numpy as np
+from scipy import fft
 import isce
 import isceobj
 logger = logging.getLogger('isce.tops.runFilter')
 
+# tiled numpy engine: FFT patch size/step of the power-spectral filter and
+# window size of the phase-sigma coherence (same defaults as psfilt/icu)
+FILTER_NFFT = 32
+FILTER_STEP = 4
+COHERENCE_WINDOW = 5
+TILE_ROWS = 1024
+# memory of a batch of filtered patches in goldstein_filter
+FILTER_BATCH_MB = 64
+
+# agreement with the ISCE (mroipac) results, checked by --validate
+PHASE_TOLERANCE = 0.1         # rms of the wrapped phase difference [radian]
+COHERENCE_TOLERANCE = 0.05    # mean absolute difference
+
 
 def runFilter(infile, outfile, filterStrength):
     from mroipac.filter.Filter import Filter
@@ -156,6 +173,215 @@ def estCpxCoherence(slc1_file, slc2_file, cpx_coh_file, alks=3, rlks=9):
     return
 
 
+def get_image_size(infile):
+    """Return (length, width) of an ISCE image from its .xml file."""
+    img = isceobj.createImage()
+    img.load(infile + '.xml')
+    return img.getLength(), img.getWidth()
+
+
+def _boxcar_sum(data, win):
+    """Sum over a win x win window centered on every pixel (zero outside)."""
+    half = win // 2
+    data = data.astype(np.complex128 if np.iscomplexobj(data) else np.float64)
+    pad = np.pad(data, ((half + 1, half), (half + 1, half)), mode='constant')
+    csum = pad.cumsum(axis=0).cumsum(axis=1)
+    return csum[win:, win:] - csum[:-win, win:] - csum[win:, :-win] + csum[:-win, :-win]
+
+
+def goldstein_filter(data, alpha, nfft=FILTER_NFFT, step=FILTER_STEP):
+    """Goldstein-Werner power-spectral filter of a complex interferogram block.
+
+    The block is covered by nfft x nfft patches on a grid with spacing step, starting
+    at (-nfft + step) so that every pixel is covered by the same number of patches.
+    Patches are filtered with |S|^alpha of the 3x3 smoothed spectrum and blended back
+    with a triangular window. The patch grid only depends on the block origin, hence
+    blocks whose origin is a multiple of step give identical results to a full image.
+    Patch rows are filtered and added in batches, so memory stays bounded for wide blocks.
+    """
+    k = nfft // step
+    length, width = data.shape
+    pad0 = nfft - step
+    ny = (length + pad0 + step - 1) // step
+    nx = (width + pad0 + step - 1) // step
+    ny += (-ny) % k
+    nx += (-nx) % k
+    padded = np.zeros(((ny - 1) * step + nfft, (nx - 1) * step + nfft), dtype=np.complex64)
+    padded[pad0:pad0 + length, pad0:pad0 + width] = data
+
+    wf = 1. - np.abs(np.arange(nfft) - (nfft - 1) / 2.) / (nfft / 2.)
+    weight = np.outer(wf, wf).astype(np.float32)
+
+    out = np.zeros(padded.shape, dtype=np.complex64)
+    wsum = np.zeros(padded.shape, dtype=np.float32)
+    # rows of patches are filtered in batches of about FILTER_BATCH_MB
+    # (spectrum, amplitude, smoothed amplitude and filtered patches in complex64/float32;
+    # scipy.fft keeps complex64 input in single precision)
+    batch = max(1, int(FILTER_BATCH_MB * 1024 ** 2 / (nx * nfft * nfft * 8 * 4)))
+    for iy0 in range(0, ny, batch):
+        iy1 = min(iy0 + batch, ny)
+        band = padded[iy0 * step:(iy1 - 1) * step + nfft, :]
+        patches = np.lib.stride_tricks.sliding_window_view(band, (nfft, nfft))[::step, ::step]
+        spec = fft.fft2(patches)
+        amp = np.abs(spec)
+        smooth = np.zeros_like(amp)
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                smooth += np.roll(amp, (dy, dx), axis=(-2, -1))
+        del amp
+        spec *= (smooth / 9.) ** alpha
+        del smooth
+        filt = fft.ifft2(spec)
+        del spec
+        filt *= weight
+
+        # patches (i, b::k) of a patch row do not overlap, add each of these k sets in one go
+        for i in range(iy1 - iy0):
+            y0 = (iy0 + i) * step
+            for b in range(k):
+                sub = filt[i, b::k]
+                sub = sub.transpose(1, 0, 2).reshape(nfft, sub.shape[0] * nfft)
+                x0 = b * step
+                out[y0:y0 + nfft, x0:x0 + sub.shape[1]] += sub
+                wsum[y0:y0 + nfft, x0:x0 + sub.shape[1]] += np.tile(weight, (1, sub.shape[1] // nfft))
+        del filt
+
+    out = out[pad0:pad0 + length, pad0:pad0 + width]
+    wsum = wsum[pad0:pad0 + length, pad0:pad0 + width]
+    out = np.divide(out, wsum, out=np.zeros_like(out), where=wsum > 0)
+    out[data == 0] = 0
+    return out.astype(np.complex64)
+
+
+def phase_sigma_coherence(data, win=COHERENCE_WINDOW):
+    """Phase-sigma coherence: magnitude of the mean unit phasor over win x win pixels."""
+    valid = np.abs(data) > 0
+    phasor = np.zeros(data.shape, dtype=np.complex64)
+    phasor[valid] = data[valid] / np.abs(data[valid])
+    num = _boxcar_sum(valid.astype(np.float32), win)
+    coh = np.abs(_boxcar_sum(phasor, win))
+    coh = np.divide(coh, num, out=np.zeros(coh.shape, dtype=np.float64), where=num > 0)
+    coh[~valid] = 0
+    return coh.astype(np.float32)
+
+
+def _filter_coherence_tile(args):
+    """Filter and estimate coherence for rows [row0, row1) with one read of the input."""
+    infile, filtfile, corfile, shape, row0, row1, alpha = args
+    length, width = shape
+    half = COHERENCE_WINDOW // 2
+    # halo: a full patch for the filter plus the coherence window, aligned to the patch step
+    halo = FILTER_NFFT + int(np.ceil(half / FILTER_STEP)) * FILTER_STEP
+
+    ifg = np.memmap(infile, dtype=np.complex64, mode='r', shape=shape)
+    data = np.zeros((row1 - row0 + 2 * halo, width), dtype=np.complex64)
+    r0, r1 = max(row0 - halo, 0), min(row1 + halo, length)
+    data[r0 - (row0 - halo):r1 - (row0 - halo), :] = ifg[r0:r1, :]
+    del ifg
+
+    filt = goldstein_filter(data, alpha)
+    filt[:r0 - (row0 - halo), :] = 0
+    filt[r1 - (row0 - halo):, :] = 0
+    coh = phase_sigma_coherence(filt)
+
+    out_filt = np.memmap(filtfile, dtype=np.complex64, mode='r+', shape=shape)
+    out_filt[row0:row1, :] = filt[halo:halo + row1 - row0, :]
+    del out_filt
+    out_coh = np.memmap(corfile, dtype=np.float32, mode='r+', shape=shape)
+    out_coh[row0:row1, :] = coh[halo:halo + row1 - row0, :]
+    del out_coh
+    return row0, row1
+
+
+def runFilterCoherence_tiled(infile, outfile, corfile, filterStrength, num_workers=1, tile_rows=TILE_ROWS):
+    """Numpy/FFT engine: filtered interferogram and phase-sigma coherence in one read pass.
+
+    The memmapped interferogram is split into row tiles (multiples of FILTER_STEP) with an
+    overlapping halo. Tiles are processed by a pool of workers which write their rows
+    directly into the memmapped outputs.
+    """
+    logger.info("Applying power-spectral filter and phase-sigma coherence with {} workers".format(num_workers))
+    length, width = get_image_size(infile)
+    shape = (length, width)
+
+    tile_rows = max(FILTER_STEP, tile_rows - tile_rows % FILTER_STEP)
+    np.memmap(outfile, dtype=np.complex64, mode='w+', shape=shape).flush()
+    np.memmap(corfile, dtype=np.float32, mode='w+', shape=shape).flush()
+
+    tasks = [(infile, outfile, corfile, shape, r, min(r + tile_rows, length), filterStrength)
+             for r in range(0, length, tile_rows)]
+    if num_workers > 1:
+        with mp.Pool(num_workers) as pool:
+            for _ in pool.imap_unordered(_filter_coherence_tile, tasks):
+                pass
+    else:
+        for task in tasks:
+            _filter_coherence_tile(task)
+
+    filtImage = isceobj.createIntImage()
+    filtImage.setFilename(outfile)
+    filtImage.setWidth(width)
+    filtImage.setLength(length)
+    filtImage.setAccessMode('read')
+    filtImage.renderHdr()
+
+    phsigImage = isceobj.createImage()
+    phsigImage.dataType = 'FLOAT'
+    phsigImage.bands = 1
+    phsigImage.setFilename(corfile)
+    phsigImage.setWidth(width)
+    phsigImage.setLength(length)
+    phsigImage.setAccessMode('read')
+    phsigImage.renderHdr()
+    return
+
+
+def compare_with_isce(isce_filt, isce_cor, np_filt, np_cor):
+    """Compare numpy engine outputs with the ISCE outputs.
+
+    Returns the rms of the filtered phase difference, the mean absolute coherence difference
+    and whether both are within PHASE_TOLERANCE and COHERENCE_TOLERANCE.
+    """
+    shape = get_image_size(isce_filt)
+    f1 = np.memmap(isce_filt, dtype=np.complex64, mode='r', shape=shape)
+    f2 = np.memmap(np_filt, dtype=np.complex64, mode='r', shape=shape)
+    c1 = np.memmap(isce_cor, dtype=np.float32, mode='r', shape=shape)
+    c2 = np.memmap(np_cor, dtype=np.float32, mode='r', shape=shape)
+
+    valid = (np.abs(f1) > 0) * (np.abs(f2) > 0)
+    dphase = np.angle(f1[valid] * np.conj(f2[valid]))
+    phase_rms = float(np.sqrt(np.mean(dphase ** 2)))
+    coh_diff = float(np.mean(np.abs(c1[valid] - c2[valid])))
+
+    return phase_rms, coh_diff, phase_rms <= PHASE_TOLERANCE and coh_diff <= COHERENCE_TOLERANCE
+
+
+def benchmark_filter_coherence(infile, filterStrength, workers=(1, 4, 16), tile_rows=TILE_ROWS):
+    """Per-interferogram throughput of the numpy engine for different numbers of workers."""
+    length, width = get_image_size(infile)
+    size_mb = length * width * 8 / 1024 ** 2
+    out_dir = os.path.dirname(os.path.abspath(infile))
+    filtfile = os.path.join(out_dir, 'benchmark_filt.int')
+    corfile = os.path.join(out_dir, 'benchmark_phsig.cor')
+
+    print('benchmark {} ({} x {}, {:.1f} MB)'.format(infile, length, width, size_mb))
+    results = {}
+    for num_workers in workers:
+        time0 = time.time()
+        runFilterCoherence_tiled(infile, filtfile, corfile, filterStrength,
+                                 num_workers=num_workers, tile_rows=tile_rows)
+        seconds = time.time() - time0
+        results[num_workers] = seconds
+        print('workers: {:3d}  time: {:8.2f} s  throughput: {:8.2f} MB/s  {:6.3f} ifg/min'.format(
+            num_workers, seconds, size_mb / seconds, 60. / seconds))
+
+    for fname in [filtfile, corfile]:
+        for ext in ['', '.xml', '.vrt']:
+            if os.path.exists(fname + ext):
+                os.remove(fname + ext)
+    return results
+
+
 def createParser():
     '''
     Create command line parser.
@@ -176,6 +402,16 @@ def createParser():
             dest='cpx_cohfile')
     parser.add_argument('-r','--range_looks',type=int, default=9, help= 'range looks', dest='numberRangelooks')
     parser.add_argument('-z','--azimuth_looks',type=int, default=3, help= 'azimuth looks', dest='numberAzlooks')
+    parser.add_argument('--engine', type=str, default='isce', choices=['isce', 'numpy'],
+            help='isce: mroipac filter and icu coherence; numpy: tiled FFT engine (default: %(default)s)', dest='engine')
+    parser.add_argument('--num_workers', type=int, default=1, help='number of workers for the numpy engine',
+            dest='num_workers')
+    parser.add_argument('--tile_rows', type=int, default=TILE_ROWS, help='rows per tile for the numpy engine',
+            dest='tile_rows')
+    parser.add_argument('--validate', action='store_true', dest='validate',
+            help='run both engines and compare the numpy outputs with the ISCE outputs')
+    parser.add_argument('--benchmark', action='store_true', dest='benchmark',
+            help='report numpy engine throughput for 1, 4 and 16 workers and exit')
     return parser
 
 def cmdLineParse(iargs=None):
@@ -189,9 +425,33 @@ def main(iargs=None):
     if inps.filtfile is None:
         inps.filtfile = 'filt_' + inps.infile
 
-    runFilter(inps.infile, inps.filtfile, inps.filterstrength)
+    if inps.benchmark:
+        benchmark_filter_coherence(inps.infile, inps.filterstrength, tile_rows=inps.tile_rows)
+        return
 
-    estCoherence(inps.filtfile, inps.cohfile)
+    if inps.engine == 'numpy':
+        runFilterCoherence_tiled(inps.infile, inps.filtfile, inps.cohfile, inps.filterstrength,
+                                 num_workers=inps.num_workers, tile_rows=inps.tile_rows)
+    else:
+        runFilter(inps.infile, inps.filtfile, inps.filterstrength)
+
+        estCoherence(inps.filtfile, inps.cohfile)
+
+    if inps.validate:
+        if inps.engine == 'numpy':
+            isce_filt, isce_cor = inps.filtfile + '.isce', inps.cohfile + '.isce'
+            runFilter(inps.infile, isce_filt, inps.filterstrength)
+            estCoherence(isce_filt, isce_cor)
+            phase_rms, coh_diff, status = compare_with_isce(isce_filt, isce_cor, inps.filtfile, inps.cohfile)
+        else:
+            np_filt, np_cor = inps.filtfile + '.numpy', inps.cohfile + '.numpy'
+            runFilterCoherence_tiled(inps.infile, np_filt, np_cor, inps.filterstrength,
+                                     num_workers=inps.num_workers, tile_rows=inps.tile_rows)
+            phase_rms, coh_diff, status = compare_with_isce(inps.filtfile, inps.cohfile, np_filt, np_cor)
+        print('filtered phase rms difference: {:.4f} rad (tolerance {})'.format(phase_rms, PHASE_TOLERANCE))
+        print('coherence mean abs difference: {:.4f} (tolerance {})'.format(coh_diff, COHERENCE_TOLERANCE))
+        if not status:
+            raise RuntimeError('numpy engine differs from ISCE results by more than the stated tolerance')
 
     #FAif inps.slc1 and inps.slc2:
     #FA    estCpxCoherence(inps.slc1, inps.slc2, inps.cpx_cohfile,
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+############################################################
+# Parallel concatenation of MiaplPy phase linking patches  #
+############################################################
+# Patches are read by a pool of workers; the main process is the only writer of the
+# output HDF5 file, whose chunks are aligned to the patch grid.
+# Writes inverted/phase_series.h5 before miaplpyApp.py --dostep concatenate_patches runs
+# (see job_submission.py), which then finds the product.
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing as mp
+import h5py
+import numpy as np
+
+EXAMPLE = """example:
+  concatenate_patches_parallel.py --dir ./miaplpy -t $SAMPLESDIR/unittestGalapagosSenDT128.template
+  concatenate_patches_parallel.py -w ./miaplpy/inverted -s ./miaplpy/inputs/slcStack.h5 --patch-size 200 \\
+                                  --range-window 19 --azimuth-window 9 --num-worker 16
+"""
+
+# npy file in the patch directory : output dataset : reduction of complex data
+# (the datasets of MiaplPy's phase_series.h5; npy files missing in the patches are skipped)
+DEFAULT_DATASETS = ['phase_ref.npy:phase:angle', 'phase_ref.npy:amplitude:abs',
+                    'tempCoh.npy:temporalCoherence', 'shp.npy:shp', 'mask_ps.npy:mask_ps']
+MAX_CHUNK_MB = 32
+OUT_FILE = 'phase_series.h5'
+# defaults of miaplpy.inversion.patchSize, rangeWindow and azimuthWindow
+PATCH_SIZE = 200
+RANGE_WINDOW = 19
+AZIMUTH_WINDOW = 9
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Concatenate phase linking patches with parallel readers',
+                                     formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+    parser.add_argument('--dir', dest='miaplpy_dir', default=None,
+                        help='miaplpy directory (sets --work-dir DIR/inverted and --slc-stack DIR/inputs/slcStack.h5)')
+    parser.add_argument('-t', '--template', dest='template_file', default=None,
+                        help='template file with miaplpy.inversion.patchSize, rangeWindow and azimuthWindow')
+    parser.add_argument('-w', '--work-dir', dest='work_dir', default=None,
+                        help='inverted directory with PATCHES/PATCH_*')
+    parser.add_argument('-s', '--slc-stack', dest='slc_stack', default=None,
+                        help='slcStack.h5 (image size, dates and attributes)')
+    parser.add_argument('--patch-size', dest='patch_size', type=int, default=None,
+                        help='miaplpy.inversion.patchSize (default: {})'.format(PATCH_SIZE))
+    parser.add_argument('--range-window', dest='range_window', type=int, default=None,
+                        help='miaplpy.inversion.rangeWindow (default: {})'.format(RANGE_WINDOW))
+    parser.add_argument('--azimuth-window', dest='azimuth_window', type=int, default=None,
+                        help='miaplpy.inversion.azimuthWindow (default: {})'.format(AZIMUTH_WINDOW))
+    parser.add_argument('-d', '--dataset', dest='datasets', action='append', default=None,
+                        help='NPY:DATASET[:angle|abs|real|imag], repeat for several datasets\n'
+                             '(default: {})'.format(' '.join(DEFAULT_DATASETS)))
+    parser.add_argument('-o', '--output', dest='out_file', default=OUT_FILE,
+                        help='output file in work dir (default: %(default)s)')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='overwrite an existing output file')
+    parser.add_argument('--num-worker', dest='num_worker', type=int, default=min(8, os.cpu_count() or 1),
+                        help='number of patch reading processes (default: %(default)s)')
+    return parser
+
+
+def cmd_line_parse(iargs=None):
+    parser = create_parser()
+    inps = parser.parse_args(args=iargs)
+    if inps.miaplpy_dir:
+        inps.work_dir = inps.work_dir or os.path.join(inps.miaplpy_dir, 'inverted')
+        inps.slc_stack = inps.slc_stack or os.path.join(inps.miaplpy_dir, 'inputs', 'slcStack.h5')
+    if not inps.work_dir or not inps.slc_stack:
+        parser.error('--dir or both --work-dir and --slc-stack are required')
+
+    template = read_inversion_options(inps.template_file) if inps.template_file else {}
+    for name, key, default in [('patch_size', 'patchSize', PATCH_SIZE),
+                               ('range_window', 'rangeWindow', RANGE_WINDOW),
+                               ('azimuth_window', 'azimuthWindow', AZIMUTH_WINDOW)]:
+        if getattr(inps, name) is None:
+            setattr(inps, name, template.get(key, default))
+    if not inps.datasets:
+        inps.datasets = DEFAULT_DATASETS
+    return inps
+
+
+def read_inversion_options(template_file):
+    """Integer miaplpy.inversion.* options of a template file ('auto' values are left out)."""
+    options = {}
+    with open(template_file, 'r') as f:
+        for line in f:
+            line = line.split('#')[0]
+            if line.strip().startswith('miaplpy.inversion.') and '=' in line:
+                key, value = [item.strip() for item in line.split('=', 1)]
+                if value.isdigit():
+                    options[key.split('.')[-1]] = int(value)
+    return options
+
+
+def get_patch_boxes(length, width, patch_size, azimuth_window=AZIMUTH_WINDOW, range_window=RANGE_WINDOW):
+    """Patch boxes (x0, y0, x1, y1) in the order of MiaplPy phase linking (row-major).
+    As in MiaplPy's patch_slice, the patches after the first row (column) start 2 * azimuth_window
+    (2 * range_window) earlier and overlap the previous patch.
+    """
+    row0 = np.ogrid[0:max(length - 50, 1):patch_size]
+    col0 = np.ogrid[0:max(width - 50, 1):patch_size]
+    row1 = row0 + patch_size
+    col1 = col0 + patch_size
+    row1[-1] = length
+    col1[-1] = width
+    row0[1:] -= 2 * azimuth_window
+    col0[1:] -= 2 * range_window
+    return [(int(col0[j]), int(row0[i]), int(col1[j]), int(row1[i]))
+            for i in range(len(row0)) for j in range(len(col0))]
+
+
+def get_output_box(box, azimuth_window=AZIMUTH_WINDOW, range_window=RANGE_WINDOW):
+    """Non-overlapping part of a patch box (on the patch_size grid)."""
+    x0, y0, x1, y1 = box
+    return (x0 + 2 * range_window if x0 > 0 else 0, y0 + 2 * azimuth_window if y0 > 0 else 0, x1, y1)
+
+
+def parse_datasets(datasets):
+    """'npy:dataset[:func]' strings to a list of (npy, dataset, func)."""
+    out = []
+    for item in datasets:
+        parts = item.split(':')
+        out.append((parts[0], parts[1], parts[2] if len(parts) > 2 else None))
+    return out
+
+
+def reduce_data(data, func):
+    if func in ['angle', 'abs', 'real', 'imag']:
+        return getattr(np, func)(data).astype(np.float32)
+    return data
+
+
+def read_patch(args):
+    """Read the npy files of one patch, apply the dataset functions and crop the overlap (runs in a worker)."""
+    index, patch_dir, datasets, box, out_box = args
+    x0, y0, x1, y1 = box
+    row0, col0 = out_box[1] - y0, out_box[0] - x0
+    arrays = {}
+    cache = {}
+    for npy, dset_name, func in datasets:
+        if npy not in cache:
+            cache[npy] = np.load(os.path.join(patch_dir, npy), allow_pickle=True)
+        data = cache[npy]
+        if data.shape[-2:] != (y1 - y0, x1 - x0):
+            raise ValueError('{}/{} has shape {}, expected {} for patch box {}'.format(
+                             patch_dir, npy, data.shape, (y1 - y0, x1 - x0), box))
+        arrays[dset_name] = reduce_data(data[..., row0:, col0:], func)
+    return index, arrays
+
+
+def get_chunk_shape(shape, patch_size, dtype):
+    """Chunks covering one patch in space; the time dimension is limited to MAX_CHUNK_MB."""
+    if len(shape) == 2:
+        return (min(patch_size, shape[0]), min(patch_size, shape[1]))
+    itemsize = np.dtype(dtype).itemsize
+    num_time = max(1, min(shape[0], int(MAX_CHUNK_MB * 1024 ** 2 / (itemsize * patch_size ** 2))))
+    return (num_time, min(patch_size, shape[1]), min(patch_size, shape[2]))
+
+
+def concatenate_patches(work_dir, slc_stack, patch_size, datasets, out_file, num_worker=1,
+                        azimuth_window=AZIMUTH_WINDOW, range_window=RANGE_WINDOW):
+    """Concatenate the patches of work_dir/PATCHES into out_file; returns the throughput in MB/s.
+    The dates and attributes are those of slc_stack; out_file is renamed into place when complete.
+    """
+    with h5py.File(slc_stack, 'r') as f:
+        length, width = f['slc'].shape[1:]
+        metadata = dict(f.attrs)
+        stack_datasets = {name: f[name][:] for name in ['date', 'bperp'] if name in f}
+
+    boxes = get_patch_boxes(length, width, patch_size, azimuth_window, range_window)
+    out_boxes = [get_output_box(box, azimuth_window, range_window) for box in boxes]
+    patch_dirs = [os.path.join(work_dir, 'PATCHES', 'PATCH_{:04d}'.format(i)) for i in range(len(boxes))]
+    missing = [d for d in patch_dirs if not os.path.isdir(d)]
+    if missing:
+        raise FileNotFoundError('{} of {} patch directories missing, e.g. {}'.format(len(missing), len(boxes),
+                                                                                     missing[0]))
+
+    # datasets whose npy files exist, output layout from the first patch
+    datasets = [item for item in parse_datasets(datasets) if os.path.isfile(os.path.join(patch_dirs[0], item[0]))]
+    if not datasets:
+        raise FileNotFoundError('none of the npy files of the datasets found in {}'.format(patch_dirs[0]))
+    jobs = [(i, patch_dirs[i], datasets, boxes[i], out_boxes[i]) for i in range(len(boxes))]
+    first = read_patch(jobs[0])[1]
+
+    # the workers are started before out_file is opened so they do not inherit its handle
+    pool = mp.Pool(num_worker) if num_worker > 1 else None
+    tmp_file = out_file + '.tmp'
+    time0 = time.time()
+    num_bytes = 0
+    try:
+        with h5py.File(tmp_file, 'w') as f:
+            for dset_name, data in first.items():
+                shape = data.shape[:-2] + (length, width)
+                f.create_dataset(dset_name, shape=shape, dtype=data.dtype,
+                                 chunks=get_chunk_shape(shape, patch_size, data.dtype))
+            for dset_name, data in stack_datasets.items():
+                f.create_dataset(dset_name, data=data)
+            for key, value in metadata.items():
+                f.attrs[key] = value
+            f.attrs['LENGTH'] = str(length)
+            f.attrs['WIDTH'] = str(width)
+
+            # batches of 2 patches per worker bound the data held in memory
+            batch_size = 2 * max(num_worker, 1)
+            for start in range(0, len(jobs), batch_size):
+                batch = jobs[start:start + batch_size]
+                results = pool.imap_unordered(read_patch, batch) if pool else map(read_patch, batch)
+                for index, arrays in results:
+                    x0, y0, x1, y1 = out_boxes[index]
+                    for dset_name, data in arrays.items():
+                        f[dset_name][..., y0:y1, x0:x1] = data
+                        num_bytes += data.nbytes
+                print('concatenated {} of {} patches'.format(min(start + batch_size, len(jobs)), len(jobs)))
+    except BaseException:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    os.replace(tmp_file, out_file)
+
+    seconds = time.time() - time0
+    mb_per_second = num_bytes / 1024 ** 2 / max(seconds, 1e-6)
+    print('wrote {:.1f} MB to {} in {:.1f} s: {:.1f} MB/s ({} workers)'.format(
+          num_bytes / 1024 ** 2, out_file, seconds, mb_per_second, num_worker))
+    return mb_per_second
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+
+    out_file = os.path.join(inps.work_dir, inps.out_file)
+    if os.path.isfile(out_file) and not inps.force:
+        print('{} exists, skip concatenation (use --force to overwrite)'.format(out_file))
+        return
+
+    concatenate_patches(inps.work_dir, inps.slc_stack, inps.patch_size, inps.datasets, out_file,
+                        num_worker=inps.num_worker, azimuth_window=inps.azimuth_window,
+                        range_window=inps.range_window)
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,11 +2,14 @@
 # Author: Sara Mirzaee
 
 import os
+import time
 import numpy as np
 import argparse
 from datetime import datetime
 from scipy.spatial import Delaunay
 
+BENCHMARK_NUM_DATES = [500, 1000, 2000, 5000]
+
 def cmd_line_parse(iargs=None):
     parser = argparse.ArgumentParser(description='find the minimum number of connected good interferograms')
     parser.add_argument('-b', '--baselineDir', dest='baseline_dir', type=str, help='Baselines directory')
@@ -19,6 +22,9 @@ def cmd_line_parse(iargs=None):
                         help='Perpendicular baseline threshold')
     parser.add_argument('-d', '--date_list', dest='date_list', default=None, type=str,
                         help='Text file having existing SLC dates')
+    parser.add_argument('--benchmark', dest='benchmark', action='store_true',
+                        help='Time the network construction for synthetic stacks of {} dates'.format(
+                            BENCHMARK_NUM_DATES))
     #parser.add_argument('--MinSpanTree', dest='min_span_tree', action='store_true',
     #                      help='Keep minimum spanning tree pairs')
 
@@ -28,75 +34,21 @@ def cmd_line_parse(iargs=None):
 
 def find_baselines(iargs=None):
     inps = cmd_line_parse(iargs)
+    if inps.benchmark:
+        benchmark_network()
+        return
 
     baselines, dates0 = get_baselines_dict(inps.baseline_dir)
     with open(inps.date_list, 'r') as f:
         date_list = f.readlines()
-        date_list = [dd.split('\n')[0] for dd in date_list]
-
-    min_baselines = min(baselines.values())
-    max_baselines = max(baselines.values())
+        date_list = set(dd.split('\n')[0] for dd in date_list)
 
-    dates = []
-    for date in dates0:
-        if date in date_list:
-            dates.append(date)
+    dates = np.unique([date for date in dates0 if date in date_list])
+    bperp = np.array([baselines[date] for date in dates], dtype=np.float64)
 
-    dates = np.sort(dates)
-
-    days = [(datetime.strptime(date, '%Y%m%d') - datetime.strptime(dates[0], '%Y%m%d')).days for date in dates]
-
-    temp2perp_scale = np.abs((max_baselines - min_baselines) / (np.nanmin(np.array(days)) - np.nanmax(np.array(days))))
-    days = [tbase * temp2perp_scale for tbase in days]
-
-    inps.t_threshold *= temp2perp_scale
-    multplier = np.sqrt(inps.baseline_ratio)
-    days = [x / multplier for x in days]
-
-    pairtr = []
-    for i, date in enumerate(dates):
-        pairtr.append([days[i], baselines[date] * multplier])
-
-    pairtr = np.array(pairtr)
-    tri = Delaunay(pairtr, incremental=False)
-
-    qm = np.zeros([len(dates), len(dates)])
-
-    for trp in pairtr[tri.simplices]:
-        x1 = trp[0][0]
-        x2 = trp[1][0]
-        x3 = trp[2][0]
-        b1 = trp[0][1]
-        b2 = trp[1][1]
-        b3 = trp[2][1]
-        if np.abs(x1 - x2) <= inps.t_threshold:
-            qm[days.index(x1), days.index(x2)] = np.abs(b1 - b2)
-            qm[days.index(x2), days.index(x1)] = np.abs(b1 - b2)
-        if np.abs(x2 - x3) <= inps.t_threshold:
-            qm[days.index(x2), days.index(x3)] = np.abs(b2 - b3)
-            qm[days.index(x3), days.index(x2)] = np.abs(b2 - b3)
-        if np.abs(x1 - x3) <= inps.t_threshold:
-            qm[days.index(x1), days.index(x3)] = np.abs(b1 - b3)
-            qm[days.index(x3), days.index(x1)] = np.abs(b1 - b3)
-
-    qm[qm > inps.p_threshold] = 0
-
-    #if inps.min_span_tree:
-    #    X = csr_matrix(qm)
-    #    Tcsr = minimum_spanning_tree(X)
-    #    A = Tcsr.toarray()
-    #else:
-    #    for i in range(len(dates)):
-    #        if len(np.nonzero(qm[i, :])[0]) <= 1:
-    #            qm[i, :] = 0
-    #    A = np.triu(qm)
-
-    for i in range(len(dates)):
-        if len(np.nonzero(qm[i, :])[0]) <= 1:
-            qm[i, :] = 0
-    A = np.triu(qm)
-
-    ind1, ind2 = np.where(A > 0)
+    ind1, ind2 = find_short_baseline_pairs(dates, bperp, inps.t_threshold, inps.p_threshold,
+                                           baseline_ratio=inps.baseline_ratio,
+                                           bperp_range=(min(baselines.values()), max(baselines.values())))
     ifgdates = ['{}_{}\n'.format(dates[g], dates[h]) for g, h in zip(ind1, ind2)]
 
     with open(inps.out_file, 'w') as f:
@@ -108,6 +60,68 @@ def find_baselines(iargs=None):
     return
 
 
+def get_days(dates):
+    """Days since the first date for sorted YYYYMMDD strings, as int array."""
+    days = np.array([np.datetime64('{}-{}-{}'.format(d[:4], d[4:6], d[6:8])) for d in dates], dtype='datetime64[D]')
+    return (days - days[0]).astype(np.int64)
+
+
+def delaunay_edges(points):
+    """Unique edges (i < j) of the Delaunay triangulation of points, as two index arrays."""
+    simplices = Delaunay(points, incremental=False).simplices
+    edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    return edges[:, 0], edges[:, 1]
+
+
+def find_short_baseline_pairs(dates, bperp, t_threshold, p_threshold, baseline_ratio=1, bperp_range=None):
+    """Interferogram pairs from the Delaunay network of (scaled time, perpendicular baseline).
+
+    Edges longer than t_threshold [days] or p_threshold [m] are dropped, and so are the edges
+    whose first date keeps less than two connections. The triangulation edges are kept as
+    sparse index arrays instead of a dense n x n matrix.
+    Parameters: dates        : sorted array of YYYYMMDD strings
+                bperp        : array of perpendicular baselines
+                bperp_range  : (min, max) baseline used to scale time to baseline (default: of bperp)
+    Returns:    ind1, ind2   : index arrays of the pairs, ind1 < ind2, sorted
+    """
+    if bperp_range is None:
+        bperp_range = (np.min(bperp), np.max(bperp))
+    days = get_days(dates).astype(np.float64)
+
+    temp2perp_scale = np.abs((bperp_range[1] - bperp_range[0]) / (np.nanmin(days) - np.nanmax(days)))
+    multplier = np.sqrt(baseline_ratio)
+    days = days * temp2perp_scale / multplier
+    t_threshold = t_threshold * temp2perp_scale
+    bperp = bperp * multplier
+
+    ind1, ind2 = delaunay_edges(np.stack([days, bperp], axis=1))
+    weight = np.abs(bperp[ind1] - bperp[ind2])
+    valid = (np.abs(days[ind1] - days[ind2]) <= t_threshold) * (weight > 0) * (weight <= p_threshold)
+    ind1, ind2 = ind1[valid], ind2[valid]
+
+    # a date with a single connection does not contribute its pairs to later dates
+    num_connections = np.bincount(np.concatenate([ind1, ind2]), minlength=len(dates))
+    keep = num_connections[ind1] > 1
+    ind1, ind2 = ind1[keep], ind2[keep]
+
+    order = np.lexsort((ind2, ind1))
+    return ind1[order], ind2[order]
+
+
+def benchmark_network(num_dates_list=BENCHMARK_NUM_DATES, t_threshold=120, p_threshold=200, seed=0):
+    """Time find_short_baseline_pairs on synthetic 6-day stacks with random baselines."""
+    rng = np.random.default_rng(seed)
+    for num_dates in num_dates_list:
+        days = np.datetime64('2015-01-01') + 6 * np.arange(num_dates)
+        dates = np.array([str(d).replace('-', '') for d in days])
+        bperp = np.cumsum(rng.normal(0, 20, num_dates))
+        time0 = time.time()
+        ind1, ind2 = find_short_baseline_pairs(dates, bperp, t_threshold, p_threshold)
+        print('{:6d} dates: {:6d} pairs in {:.3f} s'.format(num_dates, len(ind1), time.time() - time0))
+    return
+
+
 def get_baselines_dict(baseline_dir):
 
     bf = os.listdir(baseline_dir)
@@ -183,37 +197,36 @@ def plot_baselines(ind1, ind2, dates=None, baselines=None, out_dir=None, baselin
 def find_short_pbaseline_pair(baselines, date_list, ministack_size, last_index):
 
     second_index = np.arange(last_index - ministack_size + 1, last_index)
-    diff_bselines = [np.abs(baselines[date_list[last_index - ministack_size - 2]] - baselines[date_list[i]]) for i in second_index]
-    min_ind = np.min(diff_bselines)
-    pair = (date_list[last_index - ministack_size - 2], date_list[second_index[diff_bselines.index(min_ind)]])
+    diff_bselines = np.abs(baselines[date_list[last_index - ministack_size - 2]] -
+                           np.array([baselines[date_list[i]] for i in second_index]))
+    pair = (date_list[last_index - ministack_size - 2], date_list[second_index[np.argmin(diff_bselines)]])
     return pair
 
 
 def find_mini_stacks(date_list, baseline_dir, month=6):
     pairs = []
-    dates = [datetime.strptime(date_str, '%Y%m%d') for date_str in date_list]
+    dates = np.array(date_list)
     bperp = get_baselines_dict(baseline_dir)[0]
-    years = np.array([x.year for x in dates])
+    years = np.array([int(x[:4]) for x in date_list])
+    months_all = np.array([int(x[4:6]) for x in date_list])
     u, indices_first = np.unique(years, return_index=True)
     f_ind = indices_first
-    l_ind = np.zeros(indices_first.shape, dtype=np.int)
-    l_ind[0:-1] = np.array(f_ind[1::]).astype(np.int)
+    l_ind = np.zeros(indices_first.shape, dtype=int)
+    l_ind[0:-1] = np.array(f_ind[1::]).astype(int)
     l_ind[-1] = len(dates)
     ref_inds = []
     for i in range(len(f_ind)):
-        months = np.array([x.month for x in dates[f_ind[i]:l_ind[i]]])
+        months = months_all[f_ind[i]:l_ind[i]]
         u, indices = np.unique(months, return_index=True)
-        ind = np.where(u == month)[0]
-        if len(ind) == 0:
+        ind = np.searchsorted(u, month)
+        if ind == len(u) or u[ind] != month:
             ind = int(len(u)//2)
-        else:
-            ind = ind[0]
         ref_ind = indices[ind] + f_ind[i]
         ref_inds.append(ref_ind)
 
-        for k in range(f_ind[i], l_ind[i]):
-            if not ref_ind == k:
-                pairs.append((date_list[ref_ind], date_list[k]))
+        secondary = np.arange(f_ind[i], l_ind[i])
+        secondary = secondary[secondary != ref_ind]
+        pairs += list(zip([date_list[ref_ind]] * len(secondary), dates[secondary].tolist()))
         ministack_size = l_ind[i] - f_ind[i]
         if i > 0:
             pairs.append(find_short_pbaseline_pair(bperp, date_list, ministack_size, l_ind[i]))
@@ -224,19 +237,16 @@ def find_mini_stacks(date_list, baseline_dir, month=6):
     return pairs
 
 def find_one_year_interferograms(date_list):
-    dates = np.array([datetime.datetime.strptime(date, '%Y%m%d') for date in date_list])
-
-    ifg_ind = []
-    for i, date in enumerate(dates):
-        range_1 = date + datetime.timedelta(days=365) - datetime.timedelta(days=5)
-        range_2 = date + datetime.timedelta(days=365) + datetime.timedelta(days=5)
-        index = np.where((dates >= range_1) * (dates <= range_2))[0]
-        if len(index) >= 1:
-            date_diff = list(dates[index] - (date + datetime.timedelta(days=365)))
-            ind = date_diff.index(np.nanmin(date_diff))
-            ind_date = index[ind]
-            date2 = date_list[ind_date]
-            ifg_ind.append((date_list[i], date2))
+    """Pair each date with the first date within 365 +/- 5 days, using a sorted search."""
+    days = get_days(date_list)
+    order = np.argsort(days, kind='stable')
+    sorted_days = days[order]
+
+    index = np.searchsorted(sorted_days, days + 365 - 5, side='left')
+    valid = index < len(days)
+    valid[valid] = sorted_days[index[valid]] <= days[valid] + 365 + 5
+
+    ifg_ind = [(date_list[i], date_list[order[index[i]]]) for i in np.flatnonzero(valid)]
 
     return ifg_ind
 
@@ -12,6 +12,10 @@ import glob
 import argparse
 import numpy as np
 import copy
+import time
+import shutil
+import tempfile
+import multiprocessing as mp
 
 warnings.filterwarnings("ignore")
 
@@ -28,7 +32,7 @@ def enablePrint():
 
 blockPrint()
 from mintpy.utils import isce_utils, ptime, readfile, writefile, utils as ut
-from miaplpy.objects.utils import read_attribute, read
+from miaplpy.objects.utils import read_attribute, read, read_isce_xml, read_roipac_rsc, get_metadata_cache_info
 enablePrint()
 
 
@@ -38,6 +42,10 @@ EXAMPLE = """example:
   """
 
 GEOMETRY_PREFIXS = ['hgt', 'lat', 'lon', 'los', 'shadowMask', 'waterMask', 'incLocal']
+# serial by default: the pool overhead is larger than the .rsc writing on local disks,
+# parallel writing (--num-workers) only pays off on high-latency file systems
+NUM_WORKERS = 1
+BENCHMARK_WORKERS = min(8, os.cpu_count() or 1)
 
 def create_parser():
     """Command line parser."""
@@ -64,13 +72,18 @@ def create_parser():
                              'All geometry files need to be in the same directory.')
     parser.add_argument('--force', dest='update_mode', action='store_false',
                         help='Force to overwrite all .rsc metadata files.')
+    parser.add_argument('--num-workers', dest='num_workers', type=int, default=NUM_WORKERS,
+                        help='Number of processes writing the .rsc files of the stack (default: %(default)s, serial).\n'
+                             'More processes pay off on high-latency file systems such as Lustre.')
+    parser.add_argument('--benchmark', dest='benchmark', type=int, default=None, metavar='NUM_DATES',
+                        help='Time serial and parallel .rsc generation on a synthetic stack of NUM_DATES SLCs.')
     return parser
 
 
 def cmd_line_parse(iargs = None):
     parser = create_parser()
     inps = parser.parse_args(args=iargs)
-    if all(not i for i in [inps.slcDir, inps.geometryDir, inps.metaFile]):
+    if all(not i for i in [inps.slcDir, inps.geometryDir, inps.metaFile, inps.benchmark]):
         parser.print_usage()
         raise SystemExit('error: at least one of the following arguments are required: -s, -g, -m')
     return inps
@@ -94,7 +107,7 @@ def extract_multilook_number(geom_dir, metadata=dict()):
         if len(fnames) > 0:
             fullXmlFile = '{}.full.xml'.format(fnames[0])
             if os.path.isfile(fullXmlFile):
-                fullXmlDict = readfile.read_isce_xml(fullXmlFile)
+                fullXmlDict = read_isce_xml(fullXmlFile)
                 xmlDict = readfile.read_attribute(fnames[0])
                 metadata['ALOOKS'] = int(int(fullXmlDict['LENGTH']) / int(xmlDict['LENGTH']))
                 metadata['RLOOKS'] = int(int(fullXmlDict['WIDTH']) / int(xmlDict['WIDTH']))
@@ -113,7 +126,7 @@ def extract_isce_metadata(meta_file, geom_dir=None, rsc_file=None, update_mode=T
 
     # check existing rsc_file
     if update_mode and ut.run_or_skip(rsc_file, in_file=meta_file, readable=False) == 'skip':
-        return readfile.read_roipac_rsc(rsc_file)
+        return read_roipac_rsc(rsc_file)
 
     # 1. extract metadata from XML / shelve file
     processor = isce_utils.get_processor(meta_file)
@@ -291,7 +304,8 @@ def prepare_geometry(geom_dir, geom_files=[], metadata=dict(), processor='tops',
     return metadata
 
 
-def prepare_stack(inputDir, filePattern, processor='tops', metadata=dict(), baseline_dict=dict(), update_mode=True):
+def prepare_stack(inputDir, filePattern, processor='tops', metadata=dict(), baseline_dict=dict(), update_mode=True,
+                  num_workers=1):
 
     if not os.path.exists(glob.glob(os.path.join(os.path.abspath(inputDir), '*', filePattern + '.xml'))[0]):
         filePattern = filePattern.split('.full')[0]
@@ -310,27 +324,122 @@ def prepare_stack(inputDir, filePattern, processor='tops', metadata=dict(), base
     # write .rsc file for each interferogram file
     num_file = len(isce_files)
     slc_dates = np.sort(os.listdir(inputDir))
-    prog_bar = ptime.progressBar(maxValue=num_file)
-    for i in range(num_file):
-        # prepare metadata for current file
-        isce_file = isce_files[i].split('.xml')[0]
+    jobs = []
+    for isce_file in isce_files:
+        isce_file = isce_file.split('.xml')[0]
         dates = [slc_dates[0], os.path.basename(os.path.dirname(isce_file))]
-        slc_metadata = read_attribute(isce_file, metafile_ext='.xml')
-        slc_metadata.update(metadata)
-        slc_metadata = add_slc_metadata(slc_metadata, dates, baseline_dict)
+        jobs.append((isce_file, dates))
 
-        # write .rsc file
-        rsc_file = isce_file + '.rsc'
-        writefile.write_roipac_rsc(slc_metadata, rsc_file,
-                                   update_mode=update_mode,
-                                   print_msg=False)
-        prog_bar.update(i + 1, suffix='{}_{}'.format(dates[0], dates[1]))
+    prog_bar = ptime.progressBar(maxValue=num_file)
+    num_skip = 0
+    if num_workers > 1 and num_file > 1:
+        # common metadata and baselines are passed once per worker
+        with mp.Pool(min(num_workers, num_file), initializer=init_rsc_worker,
+                     initargs=(metadata, baseline_dict, update_mode)) as pool:
+            for i, (dates, written) in enumerate(pool.imap_unordered(write_slc_rsc, jobs, chunksize=4)):
+                num_skip += not written
+                prog_bar.update(i + 1, suffix='{}_{}'.format(dates[0], dates[1]))
+    else:
+        init_rsc_worker(metadata, baseline_dict, update_mode)
+        for i, job in enumerate(jobs):
+            dates, written = write_slc_rsc(job)
+            num_skip += not written
+            prog_bar.update(i + 1, suffix='{}_{}'.format(dates[0], dates[1]))
     prog_bar.close()
-
+    print('{} of {} .rsc files already up to date'.format(num_skip, num_file))
 
     return
 
 
+RSC_WORKER_INPUTS = {}
+
+
+def init_rsc_worker(metadata, baseline_dict, update_mode):
+    """Share the stack metadata and baselines with the current process."""
+    RSC_WORKER_INPUTS['metadata'] = metadata
+    RSC_WORKER_INPUTS['baseline_dict'] = baseline_dict
+    RSC_WORKER_INPUTS['update_mode'] = update_mode
+
+
+def rsc_is_current(rsc_file, xml_file, stack_metadata):
+    """True if rsc_file is newer than xml_file and contains the stack metadata of this date."""
+    if not os.path.isfile(rsc_file) or os.path.getmtime(rsc_file) < os.path.getmtime(xml_file):
+        return False
+    rsc_dict = readfile.read_roipac_rsc(rsc_file)
+    return all(rsc_dict.get(key) == str(value) for key, value in stack_metadata.items())
+
+
+def write_slc_rsc(job):
+    """Write the .rsc file of one SLC; returns the date pair and False if the file was current."""
+    isce_file, dates = job
+    metadata = RSC_WORKER_INPUTS['metadata']
+    baseline_dict = RSC_WORKER_INPUTS['baseline_dict']
+    update_mode = RSC_WORKER_INPUTS['update_mode']
+    rsc_file = isce_file + '.rsc'
+
+    if update_mode and rsc_is_current(rsc_file, isce_file + '.xml', add_slc_metadata(metadata, dates, baseline_dict)):
+        return dates, False
+
+    # prepare metadata for current file
+    slc_metadata = read_attribute(isce_file, metafile_ext='.xml')
+    slc_metadata.update(metadata)
+    slc_metadata = add_slc_metadata(slc_metadata, dates, baseline_dict)
+
+    # write .rsc file
+    writefile.write_roipac_rsc(slc_metadata, rsc_file,
+                               update_mode=update_mode,
+                               print_msg=False)
+    return dates, True
+
+
+def benchmark_prepare_stack(num_dates=300, num_workers=BENCHMARK_WORKERS, file_pattern='*.slc.full'):
+    """Time serial and parallel .rsc generation on a synthetic stack and check identical output."""
+    xml_template = """<imageFile>
+    <property name="width"><value>{width}</value></property>
+    <property name="length"><value>{length}</value></property>
+    <property name="data_type"><value>CFLOAT</value></property>
+    <property name="number_bands"><value>1</value></property>
+    <property name="scheme"><value>BIP</value></property>
+    <property name="byte_order"><value>l</value></property>
+    <property name="file_name"><value>{fname}</value></property>
+</imageFile>
+"""
+    dates = [(np.datetime64('2016-01-01') + 12 * i).astype(object).strftime('%Y%m%d') for i in range(num_dates)]
+    baseline_dict = {d: [float(b), float(b)] for d, b in zip(dates, np.random.default_rng(0).normal(0, 50, num_dates))}
+    metadata = {'PROCESSOR': 'isce', 'PLATFORM': 'sen', 'WAVELENGTH': '0.05546576', 'ALOOKS': '1', 'RLOOKS': '1'}
+
+    timing = {}
+    outputs = {}
+    for label, workers in [('serial', 1), ('parallel', num_workers)]:
+        slc_dir = tempfile.mkdtemp(prefix='prep_slc_benchmark_')
+        for date in dates:
+            os.makedirs(os.path.join(slc_dir, date))
+            fname = os.path.join(slc_dir, date, date + '.slc.full')
+            with open(fname + '.xml', 'w') as f:
+                f.write(xml_template.format(width=25000, length=1500, fname=fname))
+
+        time0 = time.time()
+        prepare_stack(slc_dir, file_pattern, metadata=metadata, baseline_dict=baseline_dict, num_workers=workers)
+        timing[label] = time.time() - time0
+
+        time0 = time.time()
+        prepare_stack(slc_dir, file_pattern, metadata=metadata, baseline_dict=baseline_dict, num_workers=workers)
+        timing[label + ' (rerun)'] = time.time() - time0
+
+        outputs[label] = {}
+        for date in dates:
+            with open(os.path.join(slc_dir, date, date + '.slc.full.rsc'), 'r') as f:
+                outputs[label][date] = f.read().replace(slc_dir, '')
+        shutil.rmtree(slc_dir)
+
+    identical = outputs['serial'] == outputs['parallel']
+    print('benchmark with {} dates:'.format(num_dates))
+    for label, seconds in timing.items():
+        print('  {:<20s} {:8.2f} s'.format(label, seconds))
+    print('  identical output: {}'.format(identical))
+    return timing, identical
+
+
 def gen_random_baseline_timeseries(dset_dir, dset_file, max_bperp=10):
     """Generate a baseline time series with random values.
     """
@@ -354,6 +463,11 @@ def gen_random_baseline_timeseries(dset_dir, dset_file, max_bperp=10):
 #########################################################################
 def main(iargs=None):
     inps = cmd_line_parse(iargs)
+    if inps.benchmark:
+        num_workers = inps.num_workers if inps.num_workers > 1 else BENCHMARK_WORKERS
+        benchmark_prepare_stack(inps.benchmark, num_workers=num_workers)
+        return
+
     inps.processor = isce_utils.get_processor(inps.metaFile)
 
     # read common metadata
@@ -393,7 +507,9 @@ def main(iargs=None):
                           metadata=metadata,
                           baseline_dict=baseline_dict,
                           processor=inps.processor,
-                          update_mode=inps.update_mode)
+                          update_mode=inps.update_mode,
+                          num_workers=inps.num_workers)
+    print('metadata cache: {}'.format(get_metadata_cache_info()))
     print('Done.')
     return
 
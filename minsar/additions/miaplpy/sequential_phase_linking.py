@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+############################################################
+# Incremental phase linking with the sequential estimator  #
+############################################################
+# EXPERIMENTAL standalone tool. It is not MiaplPy's phase linking and is not run by
+# miaplpyApp.py or minsarApp.bash: coherence matrices are estimated with a boxcar window
+# (no SHP selection), the phases are the leading eigenvector (EVD, not EMI) and the ministacks
+# are consecutive groups of dates. Use it to try incremental updates on a slcStack.h5.
+#
+# The stack is divided into ministacks of --ministack-size dates. Each ministack is inverted
+# together with the compressed SLCs (datums) of earlier ministacks, and is then itself
+# compressed to one datum. Completed ministacks keep their datum and phases in the state
+# directory, so new acquisitions only require the inversion of the newest ministack plus the
+# datums. At most --max-datums datums are used (the first one, which is the phase reference,
+# and the latest ones), so the size of the coherence matrices and the cost of an update stay
+# bounded as the archive grows. Blocks are tiled in rows and columns so that their coherence
+# matrices stay below MAX_BLOCK_MB.
+
+import os
+import sys
+import time
+import json
+import argparse
+import h5py
+import numpy as np
+
+EXAMPLE = """example:
+  sequential_phase_linking.py -s ./miaplpy/inputs/slcStack.h5 -w ./miaplpy/sequential
+  sequential_phase_linking.py -s ./miaplpy/inputs/slcStack.h5 -w ./miaplpy/sequential --ministack-size 10 -r 15 -a 9
+  sequential_phase_linking.py -s ./miaplpy/inputs/slcStack.h5 -w ./miaplpy/sequential --max-datums 5
+"""
+
+STATE_FILE = 'sequential_state.json'
+DATUM_FILE = 'datums.h5'
+PHASE_FILE = 'phase_series.h5'
+# memory of the coherence matrices of a block, HDF5 chunk rows of the datums and phases
+MAX_BLOCK_MB = 512
+CHUNK_ROWS = 128
+MAX_DATUMS = 10
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Incremental phase linking of new acquisitions (sequential estimator).\n'
+                                                 'EXPERIMENTAL standalone tool: boxcar windows and EVD, not '
+                                                 'MiaplPy\'s SHP/EMI phase linking',
+                                     formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+    parser.add_argument('-s', '--slc-stack', dest='slc_stack', required=True, help='slcStack.h5 file')
+    parser.add_argument('-w', '--work-dir', dest='work_dir', required=True,
+                        help='directory with the datums and phase time series')
+    parser.add_argument('--ministack-size', dest='ministack_size', type=int, default=10,
+                        help='number of dates per ministack (miaplpy.inversion.ministackSize, default: %(default)s)')
+    parser.add_argument('-r', '--range-window', dest='range_window', type=int, default=15,
+                        help='coherence estimation window in range (default: %(default)s)')
+    parser.add_argument('-a', '--azimuth-window', dest='azimuth_window', type=int, default=9,
+                        help='coherence estimation window in azimuth (default: %(default)s)')
+    parser.add_argument('--max-datums', dest='max_datums', type=int, default=MAX_DATUMS,
+                        help='maximum number of datums inverted with a ministack: the first and the latest\n'
+                             '(default: %(default)s)')
+    parser.add_argument('--block-rows', dest='block_rows', type=int, default=64,
+                        help='maximum number of rows processed at a time (default: %(default)s)')
+    return parser
+
+
+def cmd_line_parse(iargs=None):
+    parser = create_parser()
+    inps = parser.parse_args(args=iargs)
+    if inps.max_datums < 1:
+        parser.error('--max-datums must be at least 1')
+    return inps
+
+
+def get_ministacks(date_list, ministack_size):
+    """Consecutive date groups of ministack_size; the last one may be incomplete."""
+    return [list(date_list[i:i + ministack_size]) for i in range(0, len(date_list), ministack_size)]
+
+
+def get_datum_index(num_datum, max_datums):
+    """Datums inverted with the next ministack: the first (phase reference) and the latest ones."""
+    if num_datum <= max_datums:
+        return list(range(num_datum))
+    return [0] + list(range(num_datum - max_datums + 1, num_datum))
+
+
+def read_state(work_dir):
+    state_file = os.path.join(work_dir, STATE_FILE)
+    if os.path.isfile(state_file):
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    return {'ministacks': [], 'dates': []}
+
+
+def write_state(work_dir, state):
+    tmp_file = os.path.join(work_dir, STATE_FILE + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_file, os.path.join(work_dir, STATE_FILE))
+
+
+def boxcar(data, range_window, azimuth_window):
+    """Sum over a (azimuth_window, range_window) window along the last two axes (zero padded)."""
+    ha, hr = azimuth_window // 2, range_window // 2
+    pad = [(0, 0)] * (data.ndim - 2) + [(ha + 1, ha), (hr + 1, hr)]
+    csum = np.pad(data, pad).cumsum(axis=-2).cumsum(axis=-1)
+    return (csum[..., azimuth_window:, range_window:] - csum[..., :-azimuth_window, range_window:] -
+            csum[..., azimuth_window:, :-range_window] + csum[..., :-azimuth_window, :-range_window])
+
+
+def estimate_phases(data, range_window, azimuth_window):
+    """Phase linking of a block: data (N, rows, cols) complex -> phases (N, rows, cols) referenced to data[0]."""
+    num, rows, cols = data.shape
+    coh = np.zeros((rows, cols, num, num), dtype=np.complex64)
+    power = boxcar(np.abs(data) ** 2, range_window, azimuth_window)
+    for i in range(num):
+        for j in range(i, num):
+            cov = boxcar(data[i] * np.conj(data[j]), range_window, azimuth_window)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cov = cov / np.sqrt(power[i] * power[j])
+            coh[:, :, i, j] = np.nan_to_num(cov)
+            coh[:, :, j, i] = np.conj(coh[:, :, i, j])
+
+    vec = np.linalg.eigh(coh)[1][..., -1]
+    vec = vec * np.exp(-1j * np.angle(vec[..., :1]))
+    return np.angle(vec).transpose(2, 0, 1).astype(np.float32)
+
+
+def compress(data, phases):
+    """Compressed SLC (datum) of a ministack: phase-compensated mean of its SLCs."""
+    return np.mean(data * np.exp(-1j * phases), axis=0).astype(np.complex64)
+
+
+def get_block_shape(num, width, block_rows, max_mb=MAX_BLOCK_MB):
+    """Rows and columns per block so that the coherence matrices of num images and their eigenvectors
+    stay below max_mb (complex64, num x num per pixel)."""
+    num_pixel = max(1, int(max_mb * 1024 ** 2 / (num * num * 8 * 2)))
+    cols = min(width, num_pixel)
+    rows = max(1, min(block_rows, num_pixel // cols))
+    return rows, cols
+
+
+def get_chunks(shape):
+    """Row-tiled chunks of one image, below the HDF5 chunk size limit for full-resolution frames."""
+    return (1, min(CHUNK_ROWS, shape[0]), shape[1])
+
+
+def invert_ministack(slc_dset, date_index, datum_dset, datum_index, phase_dset, first_index, new_datum,
+                     length, width, inps):
+    """Invert one ministack with the datums of datum_index in blocks; phases are written to phase_dset and
+    the compressed SLC (datum) of the ministack to datum_dset[new_datum] (if not None) per block."""
+    halo_row, halo_col = inps.azimuth_window // 2, inps.range_window // 2
+    num_datum = len(datum_index)
+    block_rows, block_cols = get_block_shape(num_datum + len(date_index), width, inps.block_rows)
+    for row0 in range(0, length, block_rows):
+        row1 = min(row0 + block_rows, length)
+        r0, r1 = max(row0 - halo_row, 0), min(row1 + halo_row, length)
+        for col0 in range(0, width, block_cols):
+            col1 = min(col0 + block_cols, width)
+            c0, c1 = max(col0 - halo_col, 0), min(col1 + halo_col, width)
+            data = slc_dset[date_index, r0:r1, c0:c1]
+            if num_datum:
+                data = np.concatenate([datum_dset[datum_index, r0:r1, c0:c1], data], axis=0)
+            block_phases = estimate_phases(data, inps.range_window, inps.azimuth_window)
+            box = (slice(row0 - r0, row1 - r0), slice(col0 - c0, col1 - c0))
+            new_phases = block_phases[num_datum:, box[0], box[1]]
+            phase_dset[first_index:first_index + len(date_index), row0:row1, col0:col1] = new_phases
+            if new_datum is not None:
+                datum_dset[new_datum, row0:row1, col0:col1] = compress(data[num_datum:, box[0], box[1]], new_phases)
+    return
+
+
+def prepare_phases(fp, dates, first_index, length, width):
+    """Phase and date datasets of the phase time series, resized to hold dates from first_index."""
+    num_dates = first_index + len(dates)
+    if 'phase' not in fp:
+        fp.create_dataset('phase', shape=(0, length, width), maxshape=(None, length, width),
+                          dtype=np.float32, chunks=get_chunks((length, width)))
+        fp.create_dataset('date', shape=(0,), maxshape=(None,), dtype='S8')
+    fp['phase'].resize(num_dates, axis=0)
+    fp['date'].resize(num_dates, axis=0)
+    fp['date'][first_index:num_dates] = np.array(dates, dtype='S8')
+    return fp['phase']
+
+
+def run_sequential(inps):
+    os.makedirs(inps.work_dir, exist_ok=True)
+    state = read_state(inps.work_dir)
+    datum_file = os.path.join(inps.work_dir, DATUM_FILE)
+    phase_file = os.path.join(inps.work_dir, PHASE_FILE)
+
+    with h5py.File(inps.slc_stack, 'r') as fs:
+        date_list = [d.decode() if isinstance(d, bytes) else str(d) for d in fs['date'][:]]
+        slc_dset = fs['slc']
+        length, width = slc_dset.shape[1:]
+
+        ministacks = get_ministacks(date_list, inps.ministack_size)
+        done = state['ministacks']
+        if any(ms != done_ms for ms, done_ms in zip(ministacks, done)):
+            raise ValueError('dates of completed ministacks changed, remove {} to restart'.format(inps.work_dir))
+        if done and state.get('max_datums', inps.max_datums) != inps.max_datums:
+            raise ValueError('--max-datums differs from the completed ministacks ({}), remove {} to restart'.format(
+                             state['max_datums'], inps.work_dir))
+        todo = ministacks[len(done):]
+        if not todo:
+            print('phase linking up to date ({} ministacks, {} dates)'.format(len(done), len(date_list)))
+            return
+
+        print('{} completed ministacks, inverting {} ministack(s) with {} dates'.format(
+              len(done), len(todo), sum(len(ms) for ms in todo)))
+        for ms_dates in todo:
+            time0 = time.time()
+            date_index = [date_list.index(d) for d in ms_dates]
+            num_datum = len(done)
+            datum_index = get_datum_index(num_datum, inps.max_datums)
+            first_index = sum(len(ms) for ms in done)
+            # only complete ministacks are compressed; an incomplete one is redone with the next dates
+            complete = len(ms_dates) == inps.ministack_size
+
+            # datums are read and written per block
+            with h5py.File(datum_file, 'a') as fd, h5py.File(phase_file, 'a') as fp:
+                if 'datum' not in fd:
+                    fd.create_dataset('datum', shape=(0, length, width), maxshape=(None, length, width),
+                                      dtype=np.complex64, chunks=get_chunks((length, width)))
+                if complete:
+                    fd['datum'].resize(num_datum + 1, axis=0)
+                phase_dset = prepare_phases(fp, ms_dates, first_index, length, width)
+                invert_ministack(slc_dset, date_index, fd['datum'], datum_index, phase_dset, first_index,
+                                 num_datum if complete else None, length, width, inps)
+
+            if complete:
+                done.append(ms_dates)
+                state['ministacks'] = done
+            state['dates'] = date_list
+            state['max_datums'] = inps.max_datums
+            write_state(inps.work_dir, state)
+            print('ministack {} - {} ({} dates, {} of {} datums): {:.1f} s'.format(
+                  ms_dates[0], ms_dates[-1], len(ms_dates), len(datum_index), num_datum, time.time() - time0))
+    return
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+    run_sequential(inps)
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
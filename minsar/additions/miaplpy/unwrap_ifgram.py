@@ -9,6 +9,7 @@
 import os
 import sys
 import shutil
+import argparse
 
 # Disable
 def blockPrint():
@@ -30,16 +31,31 @@ import subprocess
 import glob
 import time
 import datetime
+import json
+import re
+import shlex
+import hashlib
 enablePrint()
 
+# adaptive tiling: target number of valid pixels per snaphu tile and overlap limits
+TARGET_TILE_PIXELS = 2000 * 2000
+MIN_TILE_OVERLAP = 100
+MAX_TILE_OVERLAP = 400
+MASK_COHERENCE_THRESHOLD = 0.3
+# snaphu messages after which only the (serial) tile reassembly is running
+REASSEMBLY_MARKERS = ['Assembling tiles', 'Running optimizer for secondary network']
+TILE_TIMINGS_FILE = 'snaphu_tile_timings.json'
+UNWRAP_CACHE_FILE = 'unwrap_fingerprint.json'
+# snaphu config keys set by the tiling, which depends on the number of cores
+TILING_CONFIG_KEYS = ['SINGLETILEREOPTIMIZE', 'TILEDIR']
+HASH_BLOCK_SIZE = 64 * 1024 * 1024
+CACHE_REPORT = {'hits': [], 'misses': []}
+
 def main(iargs=None):
     """
         Unwrap interferograms.
     """
-    Parser = MiaplPyParser(iargs, script='unwrap_miaplpy')
-    inps = Parser.parse()
-    if not 'unwrap_2stage' in inps:
-        inps.unwrap_2stage = False
+    sched_inps, iargs = cmd_line_parse_scheduler(iargs)
 
     dateStr = datetime.datetime.strftime(datetime.datetime.now(), '%Y%m%d:%H%M%S')
 
@@ -54,11 +70,24 @@ def main(iargs=None):
 
     time0 = time.time()
 
+    if sched_inps.batch_file:
+        unwrap_batch(sched_inps.batch_file, sched_inps)
+        print_cache_report()
+        print('Time spent: {} m'.format((time.time() - time0)/60))
+        return
+
+    Parser = MiaplPyParser(iargs, script='unwrap_miaplpy')
+    inps = Parser.parse()
+    if not 'unwrap_2stage' in inps:
+        inps.unwrap_2stage = False
+
     inps.work_dir = os.path.dirname(inps.input_ifg)
 
-    if not os.path.exists(inps.work_dir + '/filt_fine.unw.conncomp.vrt'):
+    if not is_unwrapped(inps.work_dir, sched_inps.use_cache):
        
-        unwObj = Snaphu(inps)
+        unwObj = Snaphu(inps, num_cores=sched_inps.num_cores, use_cache=sched_inps.use_cache)
+        if sched_inps.premask:
+            unwObj.apply_premask(sched_inps.premask_threshold, water_mask=sched_inps.water_mask)
         do_tiles, metadata = unwObj.need_to_split_tiles()
 
         try:
@@ -68,11 +97,90 @@ def main(iargs=None):
             else:
                 #print('2')
                 unwObj.unwrap()
+            unwObj.pad_to_full_size()
 
         except:
             #print('3')
             runUnwrap(inps.input_ifg, inps.unwrapped_ifg, inps.input_cor, metadata, inps.unwrap_2stage)
 
+    finalize_unwrap(inps)
+    print_cache_report()
+
+    print('Time spent: {} m'.format((time.time() - time0)/60))
+
+    return
+
+
+def cmd_line_parse_scheduler(iargs=None):
+    """Parse the tile scheduling options; all other arguments are passed to MiaplPyParser."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--batch-file', dest='batch_file', type=str, default=None,
+                        help='run file with one unwrap_ifgram.py command per line; the tiles of all '
+                             'interferograms are co-scheduled in one worker budget')
+    parser.add_argument('--num-cores', dest='num_cores', type=int, default=None,
+                        help='number of cores shared by all snaphu processes (default: all available)')
+    parser.add_argument('--premask', dest='premask', action='store_true',
+                        help='mask low coherence (and water) pixels before unwrapping and crop the unwrap '
+                             'extent to the bounding box of the valid pixels')
+    parser.add_argument('--premask-threshold', dest='premask_threshold', type=float,
+                        default=MASK_COHERENCE_THRESHOLD,
+                        help='coherence threshold of the pre-unwrap mask (default: %(default)s)')
+    parser.add_argument('--water-mask', dest='water_mask', type=str, default=None,
+                        help='water mask file (ISCE binary with .vrt, 0 for water) for the pre-unwrap mask')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        help='unwrap even if the input fingerprint matches the existing output')
+    if iargs is None:
+        iargs = sys.argv[1:]
+    sched_inps, iargs = parser.parse_known_args(iargs)
+    if sched_inps.num_cores is None:
+        sched_inps.num_cores = get_available_cores()
+    return sched_inps, iargs
+
+
+def is_unwrapped(work_dir, use_cache=True):
+    """True for outputs without fingerprint record (unwrapped before caching); others are checked by Snaphu.
+    Always False without cache (--no-cache), which forces unwrapping.
+    """
+    if not use_cache or not os.path.exists(work_dir + '/filt_fine.unw.conncomp.vrt'):
+        return False
+    return not (use_cache and os.path.exists(os.path.join(work_dir, UNWRAP_CACHE_FILE)))
+
+
+def file_hash(fname, block_size=HASH_BLOCK_SIZE):
+    """sha256 of the file content, None if the file does not exist."""
+    if not fname or not os.path.exists(fname):
+        return None
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def print_cache_report():
+    """Print the interferograms whose unwrapping was skipped (hits) or run (misses)."""
+    hits, misses = CACHE_REPORT['hits'], CACHE_REPORT['misses']
+    if not hits and not misses:
+        return
+    print('unwrap cache: {} hits, {} misses'.format(len(hits), len(misses)))
+    for item in hits:
+        print('  hit:  {}'.format(item))
+    for item in misses:
+        print('  miss: {}'.format(item))
+    return
+
+
+def get_available_cores():
+    """Number of cores available to this process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def finalize_unwrap(inps):
+    """Post-unwrapping steps: 2-stage unwrapping and filter removal."""
+
     if inps.unwrap_2stage:
         temp_unwrap = os.path.dirname(inps.unwrapped_ifg) + '/temp_filt_fine.unw'
         inpFile = temp_unwrap
@@ -84,22 +192,75 @@ def main(iargs=None):
         input_ifg_nofilter = os.path.join(os.path.dirname(inps.input_ifg), 'fine.int')
         remove_filter(input_ifg_nofilter, inps.input_ifg, inps.unwrapped_ifg)
 
-    print('Time spent: {} m'.format((time.time() - time0)/60))
+    return
+
+
+def unwrap_batch(batch_file, sched_inps):
+    """Unwrap all interferograms of a run file, co-scheduling their snaphu tiles in one core budget."""
+    num_cores = sched_inps.num_cores
+
+    with open(batch_file, 'r') as f:
+        lines = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    jobs = []
+    inps_list = []
+    for line in lines:
+        args = shlex.split(line)
+        cmd_index = [i for i, arg in enumerate(args) if 'unwrap_ifgram' in arg]
+        if cmd_index:
+            args = args[cmd_index[0] + 1:]
+        args = cmd_line_parse_scheduler(args)[1]
+
+        inps = MiaplPyParser(args, script='unwrap_miaplpy').parse()
+        if not 'unwrap_2stage' in inps:
+            inps.unwrap_2stage = False
+        inps.work_dir = os.path.dirname(inps.input_ifg)
+        inps_list.append(inps)
+        if is_unwrapped(inps.work_dir, sched_inps.use_cache):
+            print('skip {}: already unwrapped'.format(inps.work_dir))
+            continue
+
+        unwObj = Snaphu(inps, num_cores=num_cores, use_cache=sched_inps.use_cache)
+        if sched_inps.premask:
+            unwObj.apply_premask(sched_inps.premask_threshold, water_mask=sched_inps.water_mask)
+        unwObj.need_to_split_tiles()
+        jobs.append((inps, unwObj))
+
+    scheduler = TileScheduler(num_cores=num_cores)
+    failed = scheduler.run([unwObj for inps, unwObj in jobs if not unwObj.is_cached()])
+
+    for inps, unwObj in jobs:
+        if not unwObj in failed:
+            unwObj.pad_to_full_size()
+        else:
+            runUnwrap(inps.input_ifg, inps.unwrapped_ifg, inps.input_cor, unwObj.metadata, inps.unwrap_2stage)
+
+    for inps in inps_list:
+        finalize_unwrap(inps)
 
     return
 
 
 class Snaphu:
 
-    def __init__(self, inps):
+    def __init__(self, inps, num_cores=None, use_cache=True):
 
         self.config_file = os.path.join(inps.work_dir, 'config_all')
         LENGTH = inps.ref_length
         WIDTH = inps.ref_width
         self.num_tiles = inps.num_tiles
+        self.num_cores = num_cores if num_cores else max(inps.num_tiles, 1)
+        self.work_dir = inps.work_dir
         self.out_unwrapped = inps.unwrapped_ifg
         self.inp_wrapped = inps.input_ifg
+        self.inp_coherence = inps.input_cor
+        self.unwrap_mask = inps.unwrap_mask
         self.conncomp = inps.unwrapped_ifg + '.conncomp'
+        self.tile_dir = os.path.join(inps.work_dir, 'snaphu_tiles')
+        self.crop_box = None
+        self.unwrap_seconds = None
+        self.use_cache = use_cache
+        self.fingerprint = None
         if inps.unwrap_2stage:
             self.out_unwrapped = os.path.dirname(inps.unwrapped_ifg) + '/temp_filt_fine.unw'
 
@@ -137,7 +298,8 @@ class Snaphu:
         self.config_default.append('NCORRLOOKS   {}\n'.format(inps.nlooks))
         if inps.copy_to_tmp:
             os.system('rm -rf /tmp/{}'.format(os.path.basename(inps.work_dir)))
-            self.config_default.append('TILEDIR   /tmp/{}\n'.format(os.path.basename(inps.work_dir)))
+            self.tile_dir = '/tmp/{}'.format(os.path.basename(inps.work_dir))
+        self.config_default.append('TILEDIR   {}\n'.format(self.tile_dir))
         if not inps.unwrap_mask is None:
             self.config_default.append('BYTEMASKFILE   {}\n'.format(inps.unwrap_mask))
 
@@ -150,6 +312,143 @@ class Snaphu:
         del dg
         return length, width
 
+    def set_config(self, key, value):
+        """Replace (or add) a keyword of the snaphu configuration."""
+        line = '{}   {}\n'.format(key, value)
+        for indx, item in enumerate(self.config_default):
+            if item.split() and item.split()[0] == key:
+                self.config_default[indx] = line
+                return
+        self.config_default.append(line)
+
+    def apply_premask(self, coherence_threshold=MASK_COHERENCE_THRESHOLD, water_mask=None, block_rows=512):
+        """Mask incoherent/water pixels and crop the unwrap extent to the bounding box of valid pixels.
+
+        A byte mask is built block-wise from the coherence, the water mask and an existing
+        unwrap mask. If the valid pixels do not cover the full image, the wrapped phase,
+        coherence and mask are cropped to their bounding box and snaphu runs on the crop;
+        pad_to_full_size() writes the results back at full size.
+        """
+        time0 = time.time()
+        mask_dir = os.path.join(self.work_dir, 'premask')
+        os.makedirs(mask_dir, exist_ok=True)
+        mask_file = os.path.join(mask_dir, 'unwrap_mask.byt')
+        mask_files = [water_mask, self.unwrap_mask]
+        num_valid, box = create_unwrap_mask(self.inp_coherence, mask_file, coherence_threshold,
+                                            mask_files=[i for i in mask_files if i], block_rows=block_rows)
+
+        self.full_size = (self.length, self.width)
+        self.num_valid = num_valid
+        if num_valid == 0:
+            print('WARNING: no pixel above coherence threshold {}, unwrap without pre-mask'.format(coherence_threshold))
+            return
+
+        row0, row1, col0, col1 = box
+        self.crop_box = box
+        self.full_files = {'unw': self.out_unwrapped, 'conncomp': self.conncomp}
+        crop_ifg = os.path.join(mask_dir, os.path.basename(self.inp_wrapped))
+        crop_cor = os.path.join(mask_dir, os.path.basename(self.inp_coherence))
+        crop_mask = os.path.join(mask_dir, 'unwrap_mask_crop.byt')
+        crop_file(self.inp_wrapped, crop_ifg, box, np.complex64, 'CFLOAT', block_rows=block_rows)
+        crop_file(self.inp_coherence, crop_cor, box, np.float32, 'FLOAT', block_rows=block_rows)
+        crop_file(mask_file, crop_mask, box, np.uint8, 'BYTE', block_rows=block_rows)
+
+        self.inp_wrapped = crop_ifg
+        self.out_unwrapped = os.path.join(mask_dir, os.path.basename(self.out_unwrapped))
+        self.conncomp = self.out_unwrapped + '.conncomp'
+        self.length, self.width = row1 - row0, col1 - col0
+        self.unwrap_mask = crop_mask
+        self.set_config('CORRFILE', crop_cor)
+        self.set_config('CONNCOMPFILE', self.conncomp)
+        self.set_config('BYTEMASKFILE', crop_mask)
+
+        full_pixels = self.full_size[0] * self.full_size[1]
+        print('pre-unwrap mask: {} of {} pixels valid ({:.1f} %), unwrap extent {} x {} -> {} x {} '
+              '(-{:.1f} % pixels), mask/crop time: {:.1f} s'.format(
+              num_valid, full_pixels, 100. * num_valid / full_pixels, self.full_size[0], self.full_size[1],
+              self.length, self.width, 100. * (1 - self.length * self.width / full_pixels), time.time() - time0))
+        return
+
+    def pad_to_full_size(self):
+        """Write the unwrapped phase and connected components of the cropped extent at full size."""
+        if self.crop_box is None:
+            return
+
+        row0, row1, col0, col1 = self.crop_box
+        length, width = self.full_size
+
+        unw_crop = np.memmap(self.out_unwrapped, dtype=np.float32, mode='r', shape=(self.length, 2, self.width))
+        unw = np.memmap(self.full_files['unw'], dtype=np.float32, mode='w+', shape=(length, 2, width))
+        unw[row0:row1, :, col0:col1] = unw_crop
+        del unw, unw_crop
+
+        cc_crop = np.memmap(self.conncomp, dtype=np.uint8, mode='r', shape=(self.length, self.width))
+        cc = np.memmap(self.full_files['conncomp'], dtype=np.uint8, mode='w+', shape=(length, width))
+        cc[row0:row1, col0:col1] = cc_crop
+        del cc, cc_crop
+
+        crop_pixels = self.length * self.width
+        IML.renderISCEXML(self.full_files['unw'], bands=2, nyy=length, nxx=width, datatype='float32', scheme='BIL')
+        IML.renderISCEXML(self.full_files['conncomp'], bands=1, nyy=length, nxx=width, datatype='BYTE', scheme='BIL')
+
+        self.out_unwrapped = self.full_files['unw']
+        self.conncomp = self.full_files['conncomp']
+        self.length, self.width = length, width
+        self.crop_box = None
+
+        if self.unwrap_seconds:
+            saved = self.unwrap_seconds * (length * width / crop_pixels - 1)
+            print('pre-unwrap mask: unwrapped {} instead of {} pixels in {:.1f} s, '
+                  'estimated time saved: {:.1f} s'.format(crop_pixels, length * width, self.unwrap_seconds, saved))
+        return
+
+    def get_fingerprint(self):
+        """Hash of the wrapped phase, coherence, mask and snaphu parameters.
+        The tiling (and the config keys set by it) depends on the number of cores and is not included.
+        """
+        if self.fingerprint is None:
+            config = [line for line in self.config_default
+                      if not (line.split() and line.split()[0] in TILING_CONFIG_KEYS)]
+            inputs = {'wrapped': file_hash(self.inp_wrapped),
+                      'coherence': file_hash(self.inp_coherence),
+                      'mask': file_hash(self.unwrap_mask),
+                      'config': ''.join(config),
+                      'size': [self.length, self.width]}
+            self.fingerprint = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+        return self.fingerprint
+
+    def has_valid_output(self):
+        """Unwrapped phase and connected components exist with the expected size."""
+        expected = {self.out_unwrapped: self.length * self.width * 8,
+                    self.conncomp: self.length * self.width}
+        return all(os.path.exists(fname) and os.path.getsize(fname) == size for fname, size in expected.items())
+
+    def is_cached(self):
+        """True if the output of an unwrapping with the same fingerprint exists (recorded in CACHE_REPORT)."""
+        if not self.use_cache:
+            return False
+        cache_file = os.path.join(self.work_dir, UNWRAP_CACHE_FILE)
+        cached = False
+        if os.path.exists(cache_file) and self.has_valid_output():
+            with open(cache_file, 'r') as f:
+                cached = json.load(f).get('fingerprint') == self.get_fingerprint()
+        CACHE_REPORT['hits' if cached else 'misses'].append(self.inp_wrapped)
+        if cached:
+            print('skip {}: fingerprint matches existing output'.format(self.inp_wrapped))
+        return cached
+
+    def save_fingerprint(self):
+        """Record the fingerprint of a successful unwrapping."""
+        if not self.use_cache:
+            return
+        record = {'fingerprint': self.get_fingerprint(),
+                  'unwrapped': self.out_unwrapped,
+                  'conncomp': self.conncomp,
+                  'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        with open(os.path.join(self.work_dir, UNWRAP_CACHE_FILE), 'w') as f:
+            json.dump(record, f, indent=2)
+        return
+
     def need_to_split_tiles(self):
 
         do_tiles, self.y_tile, self.x_tile = self.get_nproc_tile()
@@ -166,36 +465,69 @@ class Snaphu:
 
 
     def get_nproc_tile(self):
+        """Pick snaphu tile geometry from the image size, the valid pixel coverage and the cores.
 
-        if self.num_tiles > 1:
-            do_tiles = True
-            if np.mod(self.num_tiles, 2) == 0:
-                y_tile = int(np.sqrt(self.num_tiles))
-            else:
-                y_tile = int(np.sqrt(self.num_tiles + 1))
-            x_tile = self.num_tiles // y_tile
-        else:
-            do_tiles = False
-            x_tile = 1
-            y_tile = 1
+        The number of tiles is chosen such that each tile holds about TARGET_TILE_PIXELS valid
+        pixels (at most one tile per core); tiles are split along azimuth/range to be as square
+        as possible and the overlap scales with the tile size.
+        """
+
+        max_tiles = min(self.num_tiles, self.num_cores) if self.num_tiles > 1 else 1
+        self.valid_fraction = self.get_valid_fraction()
+        valid_pixels = self.length * self.width * self.valid_fraction
+        num_tiles = int(min(max_tiles, max(1, np.round(valid_pixels / TARGET_TILE_PIXELS))))
+
+        # largest usable number of tiles first, then the most square tiles
+        candidates = [(ny, num_tiles // ny) for ny in range(1, num_tiles + 1)]
+        y_tile, x_tile = max(candidates, key=lambda t: (t[0] * t[1],
+                             -abs(np.log((self.length / t[0]) / (self.width / t[1])))))
+
+        self.y_overlap = int(np.clip(0.1 * self.length / y_tile, MIN_TILE_OVERLAP, MAX_TILE_OVERLAP))
+        self.x_overlap = int(np.clip(0.1 * self.width / x_tile, MIN_TILE_OVERLAP, MAX_TILE_OVERLAP))
+        self.nproc = y_tile * x_tile
+        do_tiles = self.nproc > 1
+
+        print('valid pixels: {:.1f} %, tiles: {} x {}, overlap: {} x {}, nproc: {}'.format(
+              self.valid_fraction * 100, y_tile, x_tile, self.y_overlap, self.x_overlap, self.nproc))
 
         return do_tiles, y_tile, x_tile
 
-    def unwrap(self):
+    def get_valid_fraction(self, row_step=8):
+        """Fraction of pixels to be unwrapped, from the byte mask or the coherence (sampled rows)."""
+
+        if self.unwrap_mask is not None and os.path.exists(self.unwrap_mask + '.vrt'):
+            fname, threshold = self.unwrap_mask + '.vrt', 0
+        elif self.inp_coherence is not None and os.path.exists(self.inp_coherence + '.vrt'):
+            fname, threshold = self.inp_coherence + '.vrt', MASK_COHERENCE_THRESHOLD
+        else:
+            return 1.0
+
+        ds = gdal.Open(fname, gdal.GA_ReadOnly)
+        band = ds.GetRasterBand(1)
+        num_valid = 0
+        num_total = 0
+        # only the sampled rows are read
+        for row in range(0, ds.RasterYSize, row_step):
+            data = band.ReadAsArray(0, row, ds.RasterXSize, 1)
+            num_valid += np.sum(data > threshold)
+            num_total += data.size
+        del ds
+        return max(float(num_valid) / max(num_total, 1), 0.01)
+
+    def get_command(self, nproc=None):
+        """snaphu command line, tiled if the image was split into tiles."""
 
         cmd = 'snaphu -f {config_file} -d {wrapped_file} {line_length} -o ' \
               '{unwrapped_file}'.format(config_file=self.config_file, wrapped_file=self.inp_wrapped,
                                         line_length=self.width, unwrapped_file=self.out_unwrapped)
+        if self.y_tile * self.x_tile > 1:
+            cmd += ' --tile {ytile} {xtile} {yover} {xover} --nproc {num_proc}'.format(
+                ytile=self.y_tile, xtile=self.x_tile, yover=self.y_overlap, xover=self.x_overlap,
+                num_proc=nproc if nproc else self.nproc)
+        return cmd
 
-        print(cmd)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output, error = p.communicate()
-        print(error)
-        if 'ERROR' in error.decode('UTF-8') or 'Error' in error.decode('UTF-8'): # or len(error.decode('UTF-8'))>0:
-            raise RuntimeError(error)
-
+    def render_xml(self):
 
-        
         if os.path.exists(self.out_unwrapped):
 
             IML.renderISCEXML(self.out_unwrapped, bands=2, nyy=self.length, nxx=self.width,
@@ -203,36 +535,187 @@ class Snaphu:
 
             IML.renderISCEXML(self.conncomp, bands=1, nyy=self.length, nxx=self.width,
                               datatype='BYTE', scheme='BIL')
+        return
 
-        return 
+    def unwrap(self):
 
-    def unwrap_tile(self):
+        if self.is_cached():
+            return
+
+        cmd = self.get_command()
 
-        cmd = 'snaphu -f {config_file} -d {wrapped_file} {line_length} -o ' \
-              '{unwrapped_file} --tile {ytile} {xtile} 400 400 ' \
-              '--nproc {num_proc}'.format(config_file=self.config_file, wrapped_file=self.inp_wrapped,
-                                          line_length=self.width, unwrapped_file=self.out_unwrapped, ytile=self.y_tile,
-                                          xtile=self.x_tile, num_proc=self.num_tiles)
         print(cmd)
-        
+        time0 = time.time()
         p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         output, error = p.communicate()
+        self.unwrap_seconds = time.time() - time0
         print(error)
+        if 'ERROR' in error.decode('UTF-8') or 'Error' in error.decode('UTF-8'): # or len(error.decode('UTF-8'))>0:
+            raise RuntimeError(error)
 
-        if 'ERROR' in error.decode('UTF-8') or 'Error' in error.decode('UTF-8'):  # or len(error.decode('UTF-8'))>0:
-           raise RuntimeError(error)  
-        
-        if os.path.exists(self.out_unwrapped):
-  
-            IML.renderISCEXML(self.out_unwrapped, bands=2, nyy=self.length, nxx=self.width,
-                              datatype='float32', scheme='BIL')
+        self.render_xml()
+        self.save_fingerprint()
 
-            IML.renderISCEXML(self.conncomp, bands=1, nyy=self.length, nxx=self.width,
-                              datatype='BYTE', scheme='BIL')
+        return 
+
+    def unwrap_tile(self):
+
+        if self.is_cached():
+            return
+
+        failed = TileScheduler(num_cores=self.num_cores).run([self])
+        if failed:
+            raise RuntimeError('snaphu failed for {}'.format(self.inp_wrapped))
 
         return
 
 
+class TileScheduler:
+    """Run tiled snaphu processes of several interferograms in one shared core budget.
+
+    A job occupies nproc cores while its tiles are unwrapped and a single core once snaphu
+    reports the (serial) tile reassembly, so the next interferogram starts on the freed cores.
+    Completion times of the tile outputs in TILEDIR are recorded per interferogram in
+    TILE_TIMINGS_FILE for tuning of the tiling parameters.
+    """
+
+    def __init__(self, num_cores, poll_seconds=2):
+        self.num_cores = max(int(num_cores), 1)
+        self.poll_seconds = poll_seconds
+
+    def run(self, jobs):
+        """Run all Snaphu objects; returns the list of failed ones."""
+
+        pending = list(jobs)
+        running = []
+        failed = []
+        while pending or running:
+            busy = sum(job['cores'] for job in running)
+            while pending and busy < self.num_cores:
+                unwObj = pending.pop(0)
+                nproc = max(1, min(unwObj.nproc, self.num_cores - busy))
+                running.append(self.start(unwObj, nproc))
+                busy += nproc
+
+            time.sleep(self.poll_seconds)
+
+            for job in list(running):
+                self.update(job)
+                if job['process'].poll() is not None:
+                    running.remove(job)
+                    if not self.finish(job):
+                        failed.append(job['unwObj'])
+        return failed
+
+    def start(self, unwObj, nproc):
+        cmd = unwObj.get_command(nproc=nproc)
+        print(cmd)
+        # snaphu creates TILEDIR itself
+        shutil.rmtree(unwObj.tile_dir, ignore_errors=True)
+        log_file = os.path.join(unwObj.work_dir, 'snaphu.log')
+        err_file = os.path.join(unwObj.work_dir, 'snaphu.err')
+        stdout = open(log_file, 'w')
+        stderr = open(err_file, 'w')
+        process = subprocess.Popen(cmd, shell=True, stdout=stdout, stderr=stderr)
+        return {'unwObj': unwObj, 'process': process, 'stdout': stdout, 'stderr': stderr,
+                'log_file': log_file, 'err_file': err_file, 'cores': nproc, 'nproc': nproc, 'start': time.time(), 'reassembly': None, 'tiles': {}}
+
+    def update(self, job):
+        """Record finished tiles and release cores once the reassembly has started."""
+
+        if os.path.isdir(job['unwObj'].tile_dir):
+            for fname in os.listdir(job['unwObj'].tile_dir):
+                match = re.search(r'_(\d+)_(\d+)', fname)
+                if match and fname.startswith('tmptile'):
+                    tile = '{}_{}'.format(match.group(1), match.group(2))
+                    if tile not in job['tiles']:
+                        job['tiles'][tile] = time.time() - job['start']
+
+        if job['reassembly'] is None:
+            with open(job['log_file'], 'r') as f:
+                log = f.read()
+            if any(marker in log for marker in REASSEMBLY_MARKERS):
+                job['reassembly'] = time.time() - job['start']
+                job['cores'] = 1
+
+    def finish(self, job):
+        job['stdout'].close()
+        job['stderr'].close()
+        with open(job['err_file'], 'r') as f:
+            error = f.read()
+        unwObj = job['unwObj']
+        total = time.time() - job['start']
+        unwObj.unwrap_seconds = total
+        print('{}: snaphu finished in {:.1f} s'.format(unwObj.work_dir, total))
+
+        timings = {'interferogram': unwObj.inp_wrapped,
+                   'length': unwObj.length,
+                   'width': unwObj.width,
+                   'valid_fraction': getattr(unwObj, 'valid_fraction', 1.0),
+                   'crop_box': list(unwObj.crop_box) if unwObj.crop_box else None,
+                   'tiles': [unwObj.y_tile, unwObj.x_tile],
+                   'overlap': [getattr(unwObj, 'y_overlap', 0), getattr(unwObj, 'x_overlap', 0)],
+                   'nproc': job['nproc'],
+                   'tile_seconds': job['tiles'],
+                   'reassembly_start_seconds': job['reassembly'],
+                   'total_seconds': total}
+        with open(os.path.join(unwObj.work_dir, TILE_TIMINGS_FILE), 'w') as f:
+            json.dump(timings, f, indent=2)
+
+        if 'ERROR' in error or 'Error' in error:
+            print(error)
+            return False
+
+        unwObj.render_xml()
+        unwObj.save_fingerprint()
+        return True
+
+
+def create_unwrap_mask(coherence_file, out_file, threshold, mask_files=[], block_rows=512):
+    """Write a byte mask (1: unwrap, 0: skip) from coherence and mask layers, reading row blocks.
+
+    Returns the number of valid pixels and their bounding box (row0, row1, col0, col1).
+    """
+    ds_cor = gdal.Open(coherence_file + '.vrt', gdal.GA_ReadOnly)
+    length, width = ds_cor.RasterYSize, ds_cor.RasterXSize
+    ds_masks = [gdal.Open(fname + '.vrt', gdal.GA_ReadOnly) for fname in mask_files]
+
+    mask = np.memmap(out_file, dtype=np.uint8, mode='w+', shape=(length, width))
+    valid_rows = np.zeros(length, dtype=np.bool_)
+    valid_cols = np.zeros(width, dtype=np.bool_)
+    num_valid = 0
+    for row in range(0, length, block_rows):
+        nrows = min(block_rows, length - row)
+        block = ds_cor.GetRasterBand(1).ReadAsArray(0, row, width, nrows) >= threshold
+        for ds in ds_masks:
+            block *= ds.GetRasterBand(1).ReadAsArray(0, row, width, nrows) > 0
+        mask[row:row + nrows, :] = block
+        valid_rows[row:row + nrows] = np.any(block, axis=1)
+        valid_cols += np.any(block, axis=0)
+        num_valid += int(np.sum(block))
+    del mask, ds_cor, ds_masks
+    IML.renderISCEXML(out_file, bands=1, nyy=length, nxx=width, datatype='BYTE', scheme='BIL')
+
+    if num_valid == 0:
+        return 0, (0, length, 0, width)
+    rows = np.flatnonzero(valid_rows)
+    cols = np.flatnonzero(valid_cols)
+    return num_valid, (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+
+
+def crop_file(in_file, out_file, box, dtype, isce_datatype, block_rows=512):
+    """Crop a single band ISCE file to box = (row0, row1, col0, col1), reading row blocks."""
+    row0, row1, col0, col1 = box
+    ds = gdal.Open(in_file + '.vrt', gdal.GA_ReadOnly)
+    out = np.memmap(out_file, dtype=dtype, mode='w+', shape=(row1 - row0, col1 - col0))
+    for row in range(row0, row1, block_rows):
+        nrows = min(block_rows, row1 - row)
+        out[row - row0:row - row0 + nrows, :] = ds.GetRasterBand(1).ReadAsArray(col0, row, col1 - col0, nrows)
+    del out, ds
+    IML.renderISCEXML(out_file, bands=1, nyy=row1 - row0, nxx=col1 - col0, datatype=isce_datatype, scheme='BIL')
+    return out_file
+
+
 def runUnwrap(infile, outfile, corfile, config, unwrap_2stage=False):
     from contrib.Snaphu.Snaphu import Snaphu
 
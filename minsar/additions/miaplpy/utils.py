@@ -11,6 +11,13 @@ import h5py
 from osgeo import gdal
 import datetime
 import re
+import time
+import json
+import atexit
+import collections
+import functools
+import xml.etree.ElementTree as ET
+import multiprocessing as mp
 import numpy as np
 from miaplpy.objects.arg_parser import MiaplPyParser
 from mintpy.utils import readfile, ptime, utils as ut
@@ -27,6 +34,19 @@ from mintpy.objects import (
     HDFEOS
 )
 
+# GDAL / ISCE data types that can be mapped to numpy for memory-mapped reading
+GDAL2NUMPY_DATATYPE = {'Byte': 'uint8', 'Int8': 'int8', 'UInt16': 'uint16', 'Int16': 'int16',
+                       'UInt32': 'uint32', 'Int32': 'int32', 'Float32': 'float32', 'Float64': 'float64',
+                       'CFloat32': 'complex64', 'CFloat64': 'complex128'}
+ISCE2NUMPY_DATATYPE = {'byte': 'uint8', 'short': 'int16', 'int': 'int32', 'float': 'float32',
+                       'double': 'float64', 'cfloat': 'complex64', 'cdouble': 'complex128'}
+# process-level metadata cache, MIAPLPY_METADATA_CACHE_FILE enables a persistent json sidecar
+METADATA_CACHE_SIZE = 8192
+METADATA_CACHE_FILE = os.getenv('MIAPLPY_METADATA_CACHE_FILE')
+
+# numpy multilook engine: output lines per block and ISCE data type of the output
+MULTILOOK_BLOCK_LINES = 256
+NUMPY2ISCE_DATATYPE = {'float32': 'FLOAT', 'float64': 'DOUBLE', 'complex64': 'CFLOAT', 'complex128': 'CDOUBLE'}
 
 datasetName2templateKey = {'slc': 'miaplpy.load.slcFile',
                                'unwrapPhase': 'miaplpy.load.unwFile',
@@ -202,7 +222,128 @@ def file_len(fname):
 ###############################################################################
 
 
+class MetadataCache:
+    """LRU cache of parsed metadata; entries are invalidated when mtime or size of their files change."""
+
+    def __init__(self, max_size=METADATA_CACHE_SIZE, sidecar_file=None):
+        self.max_size = max_size
+        self.sidecar_file = sidecar_file
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        if sidecar_file:
+            self.load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def stamp(files):
+        stamp = []
+        for fname in files:
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            stamp.append([os.path.abspath(fname), st.st_mtime_ns, st.st_size])
+        return stamp
+
+    def get(self, key, files, func, *args, **kwargs):
+        """Return a copy of func(*args, **kwargs), cached under key and the stamp of files."""
+        key = json.dumps(key)
+        stamp = self.stamp(files)
+        if key in self.entries:
+            if self.entries[key][0] == stamp:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return dict(self.entries[key][1])
+            self.invalidations += 1
+
+        self.misses += 1
+        value = func(*args, **kwargs)
+        self.entries[key] = (stamp, dict(value))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return value
+
+    def info(self):
+        num_read = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'size': len(self.entries),
+                'hit_rate': self.hits / num_read if num_read else 0.0}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.invalidations = 0
+
+    def load(self):
+        if not os.path.isfile(self.sidecar_file):
+            return
+        try:
+            with open(self.sidecar_file, 'r') as f:
+                for key, (stamp, value) in json.load(f).items():
+                    self.entries[key] = (stamp, value)
+        except (ValueError, OSError):
+            print('WARNING: ignore unreadable metadata cache file: {}'.format(self.sidecar_file))
+
+    def save(self):
+        """Write the json serializable entries to the sidecar file."""
+        if not self.sidecar_file:
+            return
+        entries = {}
+        for key, (stamp, value) in self.entries.items():
+            try:
+                json.dumps(value)
+            except TypeError:
+                continue
+            entries[key] = (stamp, value)
+        tmp_file = '{}.{}.tmp'.format(self.sidecar_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_file, self.sidecar_file)
+
+
+metadata_cache = MetadataCache(sidecar_file=METADATA_CACHE_FILE)
+
+
+def get_metadata_cache_info():
+    """Hits, misses, invalidations and hit rate of the metadata cache (for profiling)."""
+    return metadata_cache.info()
+
+
+def get_metafiles(fname, metafile_ext=None):
+    """Data file and all potential metadata files a read_attribute result depends on."""
+    files = [fname]
+    if metafile_ext:
+        files.append(fname + metafile_ext)
+    files += [fname + ext for ext in ['.rsc', '.xml', '.par', '.vrt', '.aux.xml']]
+    files.append(os.path.splitext(fname)[0] + '.hdr')
+    return files
+
+
+def read_isce_xml(fname):
+    """Cached readfile.read_isce_xml."""
+    return metadata_cache.get(['read_isce_xml', os.path.abspath(fname)], [fname],
+                              readfile.read_isce_xml, fname)
+
+
+def read_roipac_rsc(fname):
+    """Cached readfile.read_roipac_rsc."""
+    return metadata_cache.get(['read_roipac_rsc', os.path.abspath(fname)], [fname],
+                              readfile.read_roipac_rsc, fname)
+
+
 def read_attribute(fname, datasetName=None, standardize=True, metafile_ext=None):
+    """Read attributes of input file into a dictionary, cached in metadata_cache (see _read_attribute)."""
+    key = ['read_attribute', os.path.abspath(fname), datasetName, standardize, metafile_ext]
+    return metadata_cache.get(key, get_metafiles(fname, metafile_ext), _read_attribute,
+                              fname, datasetName=datasetName, standardize=standardize,
+                              metafile_ext=metafile_ext)
+
+
+def _read_attribute(fname, datasetName=None, standardize=True, metafile_ext=None):
     """Read attributes of input file into a dictionary
         Parameters: fname : str, path/name of data file
                     datasetName : str, name of dataset of interest, for file with multiple datasets
@@ -348,7 +489,7 @@ def read_attribute(fname, datasetName=None, standardize=True, metafile_ext=None)
             atr['PROCESSOR'] = 'isce'
             xml_files = [i for i in metafiles if i.endswith('.xml')]
             if len(xml_files) > 0:
-                atr.update(readfile.read_isce_xml(xml_files[0]))
+                atr.update(read_isce_xml(xml_files[0]))
 
         elif any(i.endswith('.par') for i in metafiles):
             atr['PROCESSOR'] = 'gamma'
@@ -368,12 +509,12 @@ def read_attribute(fname, datasetName=None, standardize=True, metafile_ext=None)
             fext = fbase
 
         if metafile.endswith('.rsc'):
-            atr.update(readfile.read_roipac_rsc(metafile))
+            atr.update(read_roipac_rsc(metafile))
             if 'FILE_TYPE' not in atr.keys():
                 atr['FILE_TYPE'] = fext
 
         elif metafile.endswith('.xml'):
-            atr.update(readfile.read_isce_xml(metafile))
+            atr.update(read_isce_xml(metafile))
             if 'FILE_TYPE' not in atr.keys():
                 atr['FILE_TYPE'] = fext
 
@@ -978,12 +1119,22 @@ def log_message(logdir, msg):
 
 
 def read_image(image_file, box=None, band=1):
-    """ Reads images from isce. """
+    """ Reads images from isce.
+    Memory-maps the band and returns a (copy-on-write) view of box = (x0, y0, x1, y1),
+    falls back to a windowed GDAL read for layouts that can not be mapped.
+    """
+
+    layout = get_image_layout(image_file, band=band)
+    if layout is not None:
+        image = memmap_image(layout)
+        if not box is None:
+            image = image[box[1]:box[3], box[0]:box[2]]
+        return image
 
     ds = gdal.Open(image_file + '.vrt', gdal.GA_ReadOnly)
     if not box is None:
         imds = ds.GetRasterBand(band)
-        image = imds.ReadAsArray()[box[1]:box[3], box[0]:box[2]]
+        image = imds.ReadAsArray(int(box[0]), int(box[1]), int(box[2] - box[0]), int(box[3] - box[1]))
     else:
         image = ds.GetRasterBand(band).ReadAsArray()
 
@@ -992,6 +1143,118 @@ def read_image(image_file, box=None, band=1):
     return image
 
 
+def get_image_layout(image_file, band=1):
+    """ Byte layout of one band of an ISCE binary file from its .vrt (or .xml).
+    Returns dict with file, dtype, length, width, offset, pixel_stride and line_stride in bytes,
+    None if the band can not be memory-mapped (e.g. VRT mosaics, CInt16).
+    """
+
+    if os.path.exists(image_file + '.vrt'):
+        root = ET.parse(image_file + '.vrt').getroot()
+        bands = root.findall('VRTRasterBand')
+        if band > len(bands):
+            return None
+        node = bands[band - 1]
+        if node.get('subClass') != 'VRTRawRasterBand' or node.get('dataType') not in GDAL2NUMPY_DATATYPE:
+            return None
+        src = node.find('SourceFilename')
+        fname = src.text
+        if src.get('relativeToVRT', '0') == '1':
+            fname = os.path.join(os.path.dirname(image_file + '.vrt'), fname)
+        dtype = np.dtype(GDAL2NUMPY_DATATYPE[node.get('dataType')])
+        byte_order = node.findtext('ByteOrder', 'LSB')
+        layout = {'file': fname,
+                  'dtype': dtype.newbyteorder('>' if byte_order.upper() == 'MSB' else '<'),
+                  'length': int(root.get('rasterYSize')),
+                  'width': int(root.get('rasterXSize')),
+                  'offset': int(node.findtext('ImageOffset', '0')),
+                  'pixel_stride': int(node.findtext('PixelOffset', str(dtype.itemsize))),
+                  'line_stride': int(node.findtext('LineOffset'))}
+
+    elif os.path.exists(image_file + '.xml'):
+        atr = read_attribute(image_file, metafile_ext='.xml')
+        data_type = atr.get('DATA_TYPE', 'float32').lower()
+        data_type = ISCE2NUMPY_DATATYPE.get(data_type, data_type)
+        try:
+            dtype = np.dtype(data_type)
+        except TypeError:
+            return None
+        num_band = int(atr.get('number_bands', '1'))
+        if band > num_band:
+            return None
+        length, width = int(atr['LENGTH']), int(atr['WIDTH'])
+        scheme = atr.get('scheme', 'BIL').upper()
+        size = dtype.itemsize
+        if scheme == 'BIP':
+            offset, pixel_stride, line_stride = (band - 1) * size, num_band * size, num_band * width * size
+        elif scheme == 'BSQ':
+            offset, pixel_stride, line_stride = (band - 1) * length * width * size, size, width * size
+        else:
+            offset, pixel_stride, line_stride = (band - 1) * width * size, size, num_band * width * size
+        big_endian = atr.get('BYTE_ORDER', 'little-endian').lower().startswith(('b', 'msb'))
+        layout = {'file': image_file,
+                  'dtype': dtype.newbyteorder('>' if big_endian else '<'),
+                  'length': length,
+                  'width': width,
+                  'offset': offset,
+                  'pixel_stride': pixel_stride,
+                  'line_stride': line_stride}
+    else:
+        return None
+
+    # the band must be contained in the file
+    last_byte = layout['offset'] + (layout['length'] - 1) * layout['line_stride'] + \
+                (layout['width'] - 1) * layout['pixel_stride'] + layout['dtype'].itemsize
+    if not os.path.exists(layout['file']) or os.path.getsize(layout['file']) < last_byte:
+        return None
+    return layout
+
+
+def memmap_image(layout):
+    """ (length, width) copy-on-write memmap of an image band described by get_image_layout. """
+
+    if layout['pixel_stride'] == layout['dtype'].itemsize and \
+            layout['line_stride'] == layout['width'] * layout['dtype'].itemsize:
+        return np.memmap(layout['file'], dtype=layout['dtype'], mode='c', offset=layout['offset'],
+                         shape=(layout['length'], layout['width']))
+
+    # interleaved bands: strided view on the raw bytes
+    raw = np.memmap(layout['file'], dtype=np.uint8, mode='c')
+    return np.ndarray(shape=(layout['length'], layout['width']), dtype=layout['dtype'], buffer=raw,
+                      offset=layout['offset'], strides=(layout['line_stride'], layout['pixel_stride']))
+
+
+def benchmark_read_image(image_file, band=1, box_size=(256, 256), num_reads=100, seed=0):
+    """ Time random box reads through the memmap reader and through GDAL. """
+
+    ds = gdal.Open(image_file + '.vrt', gdal.GA_ReadOnly)
+    length, width = ds.RasterYSize, ds.RasterXSize
+    rng = np.random.default_rng(seed)
+    ny, nx = min(box_size[0], length), min(box_size[1], width)
+    boxes = []
+    for i in range(num_reads):
+        y0 = int(rng.integers(0, length - ny + 1))
+        x0 = int(rng.integers(0, width - nx + 1))
+        boxes.append((x0, y0, x0 + nx, y0 + ny))
+
+    time0 = time.time()
+    for box in boxes:
+        data = np.array(read_image(image_file, box=box, band=band))
+    t_memmap = time.time() - time0
+
+    time0 = time.time()
+    for box in boxes:
+        data_gdal = ds.GetRasterBand(band).ReadAsArray()[box[1]:box[3], box[0]:box[2]]
+    t_gdal = time.time() - time0
+    del ds
+
+    if not np.array_equal(data, data_gdal, equal_nan=True):
+        print('WARNING: memmap and GDAL reads differ for {}'.format(image_file))
+    print('{} random {}x{} reads of {}: memmap {:.3f} s, GDAL {:.3f} s ({:.1f}x)'.format(
+          num_reads, ny, nx, image_file, t_memmap, t_gdal, t_gdal / max(t_memmap, 1e-9)))
+    return t_memmap, t_gdal
+
+
 def custom_cmap(vmin=0, vmax=1):
     """ create a custom colormap based on visible portion of electromagnetive wave."""
 
@@ -1378,11 +1641,13 @@ def prepare_metadata(inpsDict):
     return
 
 
-def multilook(infile, outfile, rlks, alks, multilook_tool='gdal'):
-    from mroipac.looks.Looks import Looks
+def multilook(infile, outfile, rlks, alks, multilook_tool='gdal', method='mean'):
     import isceobj
 
-    if multilook_tool == "gdal":
+    if multilook_tool == "numpy":
+        multilook_numpy(infile, outfile, rlks, alks, method=method)
+
+    elif multilook_tool == "gdal":
 
         print(infile)
         ds = gdal.Open(infile + ".vrt", gdal.GA_ReadOnly)
@@ -1403,6 +1668,7 @@ def multilook(infile, outfile, rlks, alks, multilook_tool='gdal'):
         ds = None
 
     else:
+        from mroipac.looks.Looks import Looks
 
         print('Multilooking {0} ...'.format(infile))
 
@@ -1416,18 +1682,101 @@ def multilook(infile, outfile, rlks, alks, multilook_tool='gdal'):
         lkObj.setOutputFilename(outfile)
         lkObj.looks()
 
-    return outfilie
+    return outfile
+
+
+def block_reduce(data, rlks, alks, method='mean'):
+    """ Average non-overlapping alks x rlks windows of data (lines must be a multiple of alks).
+    method: mean, nanmean (ignores nan, nan if all are nan) or complex (mean of complex values).
+    """
+
+    length, width = data.shape[0] // alks, data.shape[1] // rlks
+    data = data[:length * alks, :width * rlks]
+    if method == 'complex' or np.iscomplexobj(data):
+        data = data.astype(np.complex64 if data.dtype.itemsize <= 8 else np.complex128)
+    elif data.dtype != np.float64:
+        data = data.astype(np.float32)
+    data = data.reshape(length, alks, width, rlks)
+
+    if method == 'nanmean':
+        valid = ~np.isnan(data)
+        count = valid.sum(axis=(1, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = np.where(valid, data, 0).sum(axis=(1, 3)) / count
+        return out.astype(data.dtype)
+    return (data.sum(axis=(1, 3)) / (alks * rlks)).astype(data.dtype)
+
+
+def multilook_numpy(infile, outfile, rlks, alks, method='mean', block_lines=MULTILOOK_BLOCK_LINES):
+    """ Multilook an ISCE binary file in process, with bounded memory.
+    Input bands are memory-mapped and reduced in row blocks of block_lines * alks lines;
+    each block is written to the (BIL) output file before the next one is read.
+    """
+    import isceobj
 
+    rlks, alks = int(rlks), int(alks)
+    layouts = []
+    while True:
+        layout = get_image_layout(infile, band=len(layouts) + 1)
+        if layout is None:
+            break
+        layouts.append(layout)
+    if not layouts:
+        raise ValueError('can not memory-map {}, use multilook_tool="gdal"'.format(infile))
+
+    in_length, in_width = layouts[0]['length'], layouts[0]['width']
+    length, width = in_length // alks, in_width // rlks
+    num_band = len(layouts)
+    out_dtype = block_reduce(np.zeros((alks, rlks), dtype=layouts[0]['dtype']), rlks, alks, method).dtype
+
+    print('Multilooking {} ({} x {} looks, {}) ...'.format(infile, alks, rlks, method))
+    images = [memmap_image(layout) for layout in layouts]
+    out = np.memmap(outfile, dtype=out_dtype, mode='w+', shape=(length, num_band, width))
+    for line in range(0, length, block_lines):
+        num_lines = min(block_lines, length - line)
+        for band, image in enumerate(images):
+            block = image[line * alks:(line + num_lines) * alks, :]
+            out[line:line + num_lines, band, :] = block_reduce(block, rlks, alks, method)
+        out.flush()
+    del out, images
+
+    outimg = isceobj.createImage()
+    outimg.setFilename(outfile)
+    outimg.setWidth(width)
+    outimg.setLength(length)
+    outimg.bands = num_band
+    outimg.scheme = 'BIL'
+    outimg.dataType = NUMPY2ISCE_DATATYPE[out_dtype.name]
+    outimg.setAccessMode('read')
+    outimg.renderHdr()
+    outimg.renderVRT()
+    return outfile
+
+
+def _multilook_numpy_job(args):
+    infile, outfile, rlks, alks, method = args
+    return multilook_numpy(infile, outfile, rlks, alks, method=method)
+
+
+def multilook_files(infiles, outfiles, rlks, alks, method='mean', num_workers=1):
+    """ Multilook several files with the numpy engine, num_workers files at a time. """
+
+    jobs = [(infile, outfile, rlks, alks, method) for infile, outfile in zip(infiles, outfiles)]
+    if num_workers > 1 and len(jobs) > 1:
+        with mp.Pool(min(num_workers, len(jobs))) as pool:
+            return pool.map(_multilook_numpy_job, jobs)
+    return [_multilook_numpy_job(job) for job in jobs]
+
+
+@functools.lru_cache(maxsize=None)
 def ks_lut(N1, N2, alpha=0.05):
+    """ Critical KS distance for sample sizes N1, N2; computed once per process for each input. """
     N = (N1 * N2) / float(N1 + N2)
     distances = np.arange(0.01, 1, 1/1000)
     lamda = distances*(np.sqrt(N) + 0.12 + 0.11/np.sqrt(N))
-    alpha_c = np.zeros([len(distances)])
-    for value in lamda:
-        n = np.ogrid[1:101]
-        pvalue = 2*np.sum(((-1)**(n-1))*np.exp(-2*(value**2)*(n**2)))
-        pvalue = np.amin(np.amax(pvalue, initial=0), initial=1)
-        alpha_c[lamda == value] = pvalue
+    n = np.ogrid[1:101]
+    pvalue = 2*np.sum(((-1)**(n-1))*np.exp(-2*(lamda[:, None]**2)*(n**2)), axis=1)
+    alpha_c = np.clip(pvalue, 0, 1)
     critical_distance = distances[alpha_c <= (alpha)]
     return np.min(critical_distance)
 
@@ -1450,13 +1799,83 @@ def est_corr(CCGsam):
 def cov2corr(cov_matrix):
     """ Converts covariance matrix to correlation/coherence matrix. """
 
-    D = LA.pinv(np.diagflat(np.sqrt(np.diag(cov_matrix))))
+    D = np.linalg.pinv(np.diagflat(np.sqrt(np.diag(cov_matrix))))
     y = np.matmul(D, cov_matrix)
     corr_matrix = np.matmul(y, np.transpose(D))
 
     return corr_matrix
 
 
+def est_corr_batch(CCGsam):
+    """ Correlation matrices of a stack of ensembles, CCGsam: (npix, nimg, nsamples) -> (npix, nimg, nimg). """
+
+    cov_mat = np.matmul(CCGsam, np.conj(CCGsam).transpose(0, 2, 1)) / CCGsam.shape[2]
+
+    return cov2corr_batch(cov_mat)
+
+
+def cov2corr_batch(cov_matrix):
+    """ Converts a stack of covariance matrices (npix, nimg, nimg) to correlation/coherence matrices. """
+
+    std = np.sqrt(np.abs(np.einsum('pii->pi', cov_matrix)))
+    inv_std = np.zeros_like(std)
+    np.divide(1, std, out=inv_std, where=std > 0)
+    corr_matrix = cov_matrix * inv_std[:, :, None] * inv_std[:, None, :]
+
+    return corr_matrix
+
+
+def ks_distance_batch(ref_sample, samples):
+    """ Two-sample KS distances between equally sized samples.
+    ref_sample: (npix, nimg), samples: (npix, nsamples, nimg) -> distances (npix, nsamples).
+    """
+
+    npix, nsamples, nimg = samples.shape
+    ref_sample = np.broadcast_to(ref_sample[:, None, :], samples.shape)
+    values = np.concatenate([ref_sample, samples], axis=2)
+    order = np.argsort(values, axis=2, kind='stable')
+    steps = np.where(order < nimg, 1, -1).astype(np.int32)
+    cdf_diff = np.cumsum(steps, axis=2)
+
+    # the ECDFs are compared only after the last of equal values
+    sorted_values = np.take_along_axis(values, order, axis=2)
+    tie = np.zeros(sorted_values.shape, dtype=np.bool_)
+    tie[:, :, :-1] = sorted_values[:, :, 1:] == sorted_values[:, :, :-1]
+    cdf_diff[tie] = 0
+
+    return np.abs(cdf_diff).max(axis=2) / float(nimg)
+
+
+def benchmark_correlation(npix=1000, nimg=100, nsamples=50, seed=0):
+    """ Per-patch throughput of est_corr (pixel loop) and est_corr_batch, plus the batched KS test. """
+
+    rng = np.random.default_rng(seed)
+    CCGsam = (rng.normal(size=(npix, nimg, nsamples)) + 1j * rng.normal(size=(npix, nimg, nsamples))).astype(np.complex64)
+
+    time0 = time.time()
+    corr_loop = [est_corr(CCGsam[i]) for i in range(npix)]
+    t_loop = time.time() - time0
+
+    time0 = time.time()
+    corr_batch = est_corr_batch(CCGsam)
+    t_batch = time.time() - time0
+
+    amplitude = np.abs(CCGsam).transpose(0, 2, 1)
+    time0 = time.time()
+    distances = ks_distance_batch(amplitude[:, 0, :], amplitude[:, 1:, :])
+    shp = distances <= ks_lut(nimg, nimg)
+    t_ks = time.time() - time0
+
+    max_diff = np.max(np.abs(np.array(corr_loop) - corr_batch))
+    print('{} pixels, {} images, {} samples:'.format(npix, nimg, nsamples))
+    print('  est_corr loop  {:8.3f} s ({:10.0f} pixel/s)'.format(t_loop, npix / t_loop))
+    print('  est_corr batch {:8.3f} s ({:10.0f} pixel/s), max difference {:.2e}'.format(t_batch, npix / t_batch,
+                                                                                     max_diff))
+    print('  KS test batch  {:8.3f} s ({:10.0f} pixel/s), {} of {} samples accepted'.format(
+          t_ks, npix / t_ks, np.sum(shp), shp.size))
+    return t_loop, t_batch, t_ks
+
+
 def read_inps_dict2slc_stack_dict_object(inpsDict):
     """Read input arguments into dict of slcStackDict object"""
     # inpsDict --> dsPathDict
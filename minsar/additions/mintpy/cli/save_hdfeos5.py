@@ -19,6 +19,8 @@ EXAMPLE = """example:
   save_hdfeos5.py geo/geo_timeseries_ERA5_ramp_demErr.h5
   save_hdfeos5.py timeseries_ERA5_ramp_demErr.h5 --tc temporalCoherence.h5 --asc avgSpatialCoh.h5 -m maskTempCoh.h5 -g inputs/geometryGeo.h5
   save_hdfeos5.py timeseries_ERA5_ramp_demErr.h5 --tc temporalCoherence.h5 --asc avgSpatialCoh.h5 -m maskTempCoh.h5 -g inputs/geometryRadar.h5
+  save_hdfeos5.py geo/geo_timeseries_ERA5_ramp_demErr.h5 --update --append
+  save_hdfeos5.py geo/geo_timeseries_ERA5_ramp_demErr.h5 --profile timeseries
 """
 
 NOTE = """
@@ -50,6 +52,17 @@ def create_parser(subparsers=None):
                         help='Enable update mode, a.k.a. put XXXXXXXX as endDate in filename if endDate < 1 year')
     parser.add_argument('--subset', action='store_true',
                         help='Enable subset mode, a.k.a. put suffix _N31700_N32100_E130500_E131100')
+    parser.add_argument('--append', action='store_true',
+                        help='Enable append mode, a.k.a. write only the new acquisitions into an existing file\n'
+                             'of the same product (any endDate), if the existing dates are unchanged and it was\n'
+                             'written with the same --profile')
+    parser.add_argument('--profile', dest='profile', choices=['default', 'timeseries', 'map', 'balanced'],
+                        help='Storage profile (chunk shape and compression) for the expected access pattern:\n'
+                             'default   : h5py auto-chunking and lzf\n'
+                             'timeseries: pixel time-series reads (insarmaps ingestion, point queries)\n'
+                             'map       : per-date map reads (viewers)\n'
+                             'balanced  : both access patterns\n'
+                             'Compare them with hdfeos5_profile_benchmark.py')
     return parser
 
 
@@ -6,7 +6,12 @@
 
 
 import datetime as dt
+import glob
+import multiprocessing as mp
 import os
+import shutil
+import tempfile
+from queue import Empty
 
 import h5py
 import numpy as np
@@ -21,6 +26,28 @@ FLOAT_ZERO = np.float32(0.0)
 CPX_ZERO = np.complex64(0.0)
 COMPRESSION = 'lzf'
 
+# storage profiles: chunk shape of 3D (time, row, col) and 2D (row, col) datasets and codec
+#   None in a chunk shape: full size of that dimension, True: h5py auto-chunking
+#   timeseries: pixel time-series reads (insarmaps ingestion, point queries)
+#   map       : one date / one map at a time (viewers, tsview)
+#   balanced  : both access patterns at moderate cost
+STORAGE_PROFILES = {
+    'default'   : {'chunks_3d': True, 'chunks_2d': True,
+                   'compression': COMPRESSION, 'compression_opts': None, 'shuffle': False},
+    'timeseries': {'chunks_3d': (None, 16, 16), 'chunks_2d': (256, 256),
+                   'compression': 'gzip', 'compression_opts': 4, 'shuffle': True},
+    'map'       : {'chunks_3d': (1, 512, 512), 'chunks_2d': (512, 512),
+                   'compression': 'lzf', 'compression_opts': None, 'shuffle': True},
+    'balanced'  : {'chunks_3d': (8, 64, 64), 'chunks_2d': (256, 256),
+                   'compression': 'lzf', 'compression_opts': None, 'shuffle': True},
+}
+DEFAULT_PROFILE = 'default'
+# memory of one block of the displacement copy and number of blocks held in the queue
+MAX_BLOCK_MB = 64
+QUEUE_SIZE = 2
+# processes reading and compressing the quality and geometry datasets
+NUM_WORKER = min(4, os.cpu_count() or 1)
+
 
 ################################################################
 def read_template2inps(template_file, inps):
@@ -43,6 +70,14 @@ def read_template2inps(template_file, inps):
     if key in template.keys() and template[key] == 'yes':
         inps.subset = True
 
+    key = prefix+'append'
+    if key in template.keys() and template[key] == 'yes':
+        inps.append = True
+
+    key = prefix+'profile'
+    if key in template.keys() and template[key] in STORAGE_PROFILES.keys():
+        inps.profile = template[key]
+
     return inps, template
 
 
@@ -277,179 +312,449 @@ def get_output_filename(metadata, template, suffix=None, update_mode=False, subs
     return outName
 
 
-def create_hdf5_dataset(group, dsName, data, max_digit=55, compression=COMPRESSION):
-    """Create HDF5 dataset and print out message."""
+def get_storage_options(profile, shape):
+    """create_dataset() keyword arguments (chunks, compression, shuffle) of a storage profile for shape."""
+    if profile not in STORAGE_PROFILES.keys():
+        raise ValueError(f'unknown storage profile: {profile}, use one of {list(STORAGE_PROFILES.keys())}')
+    prof = STORAGE_PROFILES[profile]
 
-    msg = 'create dataset {d:<{w}}'.format(d=f'{group.name}/{dsName}', w=max_digit)
-    msg += f' of {str(data.dtype):<10} in size of {data.shape} with compression={compression}'
-    print(msg)
+    opts = {'compression': prof['compression']}
+    if prof['compression_opts'] is not None:
+        opts['compression_opts'] = prof['compression_opts']
+    if prof['shuffle']:
+        opts['shuffle'] = True
 
-    if data.ndim == 1:
-        dset = group.create_dataset(
-            dsName,
-            data=data,
-            compression=compression,
-        )
-
-    elif data.ndim == 2:
-        dset = group.create_dataset(
-            dsName,
-            data=data,
-            chunks=True,
-            compression=compression,
-        )
+    if len(shape) > 1:
+        chunks = prof['chunks_3d'] if len(shape) == 3 else prof['chunks_2d']
+        if chunks is not True:
+            chunks = tuple(min(c, n) if c else n for c, n in zip(chunks, shape))
+        opts['chunks'] = chunks
+    return opts
 
-    return dset
 
+def get_codec_name(profile):
+    """Codec description of a storage profile, e.g. gzip4+shuffle."""
+    prof = STORAGE_PROFILES[profile]
+    name = prof['compression'] + (str(prof['compression_opts']) if prof['compression_opts'] is not None else '')
+    return name + ('+shuffle' if prof['shuffle'] else '')
 
-def write_hdf5_file(metadata, out_file, ts_file, tcoh_file, scoh_file, mask_file, geom_file):
-    """Write HDF5 file in HDF-EOS5 format."""
 
-    ts_obj = timeseries(ts_file)
-    ts_obj.open(print_msg=False)
-    dateList = ts_obj.dateList
-    numDate = len(dateList)
+def create_hdf5_dataset(group, dsName, data, max_digit=55, profile=DEFAULT_PROFILE):
+    """Create HDF5 dataset and print out message."""
 
-    # Open HDF5 File
-    print(f'create HDF5 file: {out_file} with w mode')
-    max_digit = 55
+    msg = 'create dataset {d:<{w}}'.format(d=f'{group.name}/{dsName}', w=max_digit)
+    msg += f' of {str(data.dtype):<10} in size of {data.shape} with compression={get_codec_name(profile)}'
+    print(msg)
 
-    with h5py.File(out_file, 'w') as f:
+    dset = group.create_dataset(
+        dsName,
+        data=data,
+        **get_storage_options(profile, data.shape),
+    )
 
-        ##### Group - Observation
-        gName = 'HDFEOS/GRIDS/timeseries/observation'
-        print(f'create group   /{gName}')
-        group = f.create_group(gName)
+    return dset
 
-        ## O1 - displacement
-        dsName = 'displacement'
-        dsShape = (numDate, ts_obj.length, ts_obj.width)
-        dsDataType = np.float32
-        msg = 'create dataset /{d:<{w}}'.format(d=f'{gName}/{dsName}', w=max_digit)
-        msg += f' of {"float32":<10} in size of {dsShape} with compression={COMPRESSION}'
-        print(msg)
-
-        dset = group.create_dataset(
-            dsName,
-            shape=dsShape,
-            maxshape=(None, dsShape[1], dsShape[2]),
-            dtype=dsDataType,
-            chunks=True,
-            compression=COMPRESSION,
-        )
 
+def get_block_boxes(shape, chunks, src_chunks=None, itemsize=4, max_mb=MAX_BLOCK_MB):
+    """Spatial boxes (x0, y0, x1, y1) covering all dates in blocks of at most max_mb.
+    Block edges fall on the chunk edges of the output and, if the memory allows, of the source.
+    Rows are used first; columns are split only if one row of chunks over the full width is too large.
+    """
+    num_date, length, width = shape
+    chunk_rows, chunk_cols = chunks[1], chunks[2]
+    if src_chunks:
+        rows, cols = np.lcm(chunk_rows, src_chunks[1]), np.lcm(chunk_cols, src_chunks[2])
+        if rows * width * num_date * itemsize <= max_mb * 1024 ** 2:
+            chunk_rows, chunk_cols = int(min(rows, length)), int(min(cols, width))
+    max_pixels = max(1, int(max_mb * 1024 ** 2 / (itemsize * num_date)))
+
+    num_cols = width
+    if chunk_rows * width > max_pixels:
+        num_cols = max(1, max_pixels // (chunk_rows * chunk_cols)) * chunk_cols
+    num_rows = max(1, max_pixels // (chunk_rows * num_cols)) * chunk_rows
+
+    boxes = []
+    for y0 in range(0, length, num_rows):
+        for x0 in range(0, width, num_cols):
+            boxes.append((x0, y0, min(x0 + num_cols, width), min(y0 + num_rows, length)))
+    return boxes
+
+
+def read_blocks(ts_file, ds_name, box_queue, queue):
+    """Read the blocks of all dates requested in box_queue into the queue (runs in a separate process).
+    None marks the end of both queues.
+    """
+    with h5py.File(ts_file, 'r') as f:
+        dset = f[ds_name]
+        for box in iter(box_queue.get, None):
+            x0, y0, x1, y1 = box
+            queue.put((box, dset[:, y0:y1, x0:x1].astype(np.float32)))
+    queue.put(None)
+
+
+def start_displacement_reader(ts_file, shape):
+    """Start the process reading the time-series blocks for write_displacement().
+    It must be started before the output file is opened, so that it does not inherit its handle.
+    Returns (process, box queue, block queue, source chunks), None if the time-series is not one 3D
+    dataset of shape (it is then read date by date).
+    """
+    with h5py.File(ts_file, 'r') as f:
+        if 'timeseries' not in f or f['timeseries'].shape != shape:
+            return None
+        src_chunks = f['timeseries'].chunks
+
+    box_queue = mp.Queue()
+    queue = mp.Queue(maxsize=QUEUE_SIZE)
+    reader = mp.Process(target=read_blocks, args=(ts_file, 'timeseries', box_queue, queue), daemon=True)
+    reader.start()
+    return reader, box_queue, queue, src_chunks
+
+
+def write_displacement(dset, ts_file, dateList, reader=None):
+    """Copy the time-series into the displacement dataset block by block.
+    The reader process (start_displacement_reader) decompresses the source while the main process
+    compresses and writes; the bounded queue limits the memory to (QUEUE_SIZE + 2) blocks.
+    Without reader the time-series is copied date by date.
+    """
+    if reader is None:
+        numDate = len(dateList)
         print('write data acquition by acquition ...')
         prog_bar = ptime.progressBar(maxValue=numDate)
         for i in range(numDate):
             dset[i, :, :] = readfile.read(ts_file, datasetName=dateList[i])[0]
             prog_bar.update(i+1, suffix=f'{i+1}/{numDate} {dateList[i]}')
         prog_bar.close()
+        return
 
-        # attributes
-        dset.attrs['Title'] = dsName
-        dset.attrs['MissingValue'] = FLOAT_ZERO
-        dset.attrs['_FillValue'] = FLOAT_ZERO
-        dset.attrs['Units'] = 'meters'
+    reader, box_queue, queue, src_chunks = reader
+    boxes = get_block_boxes(dset.shape, dset.chunks, src_chunks=src_chunks, itemsize=dset.dtype.itemsize)
+    print(f'write data in {len(boxes)} blocks of all acquisitions ...')
+    for box in boxes + [None]:
+        box_queue.put(box)
 
-        ## O2 - date
-        dsName = 'date'
-        data = np.array(dateList, dtype=np.string_)
-        dset = create_hdf5_dataset(group, dsName, data)
+    prog_bar = ptime.progressBar(maxValue=len(boxes))
+    num_block = 0
+    while True:
+        try:
+            item = queue.get(timeout=10)
+        except Empty:
+            if not reader.is_alive():
+                raise RuntimeError(f'reading {ts_file} failed with exit code {reader.exitcode}')
+            continue
+        if item is None:
+            break
+        (x0, y0, x1, y1), data = item
+        dset[:, y0:y1, x0:x1] = data
+        num_block += 1
+        prog_bar.update(num_block, suffix=f'{num_block}/{len(boxes)} rows {y0}-{y1}')
+    prog_bar.close()
+    reader.join()
+    if reader.exitcode != 0:
+        raise RuntimeError(f'reading {ts_file} failed with exit code {reader.exitcode}')
+    return
 
-        ## O3 - perp baseline
-        dsName = 'bperp'
-        data = np.array(ts_obj.pbase, dtype=np.float32)
-        dset = create_hdf5_dataset(group, dsName, data)
 
-        ##### Group - Quality
-        gName = 'HDFEOS/GRIDS/timeseries/quality'
-        print(f'create group   /{gName}')
-        group = f.create_group(gName)
+def get_dataset_attrs(dsName):
+    """HDF-EOS5 attributes (Title, MissingValue, _FillValue, Units) of quality and geometry datasets."""
+    attrs = {'Title': dsName}
+    if dsName in ['temporalCoherence', 'avgSpatialCoherence']:
+        attrs.update({'MissingValue': FLOAT_ZERO, '_FillValue': FLOAT_ZERO, 'Units': '1'})
 
-        ## Q1 - temporalCoherence
-        dsName = 'temporalCoherence'
-        # read
-        data = readfile.read(tcoh_file)[0]
-        # write
-        dset = create_hdf5_dataset(group, dsName, data)
-        # attributes
-        dset.attrs['Title'] = dsName
-        dset.attrs['MissingValue'] = FLOAT_ZERO
-        dset.attrs['_FillValue'] = FLOAT_ZERO
-        dset.attrs['Units'] = '1'
+    elif dsName in ['height', 'slantRangeDistance', 'bperp']:
+        attrs.update({'MissingValue': FLOAT_ZERO, '_FillValue': FLOAT_ZERO, 'Units': 'meters'})
 
-        ## Q2 - avgSpatialCoherence
-        dsName = 'avgSpatialCoherence'
-        # read
-        data = readfile.read(scoh_file)[0]
-        # write
-        dset = create_hdf5_dataset(group, dsName, data)
-        # attributes
-        dset.attrs['Title'] = dsName
-        dset.attrs['MissingValue'] = FLOAT_ZERO
-        dset.attrs['_FillValue'] = FLOAT_ZERO
-        dset.attrs['Units'] = '1'
+    elif dsName in ['incidenceAngle', 'azimuthAngle', 'latitude', 'longitude']:
+        attrs.update({'MissingValue': FLOAT_ZERO, '_FillValue': FLOAT_ZERO, 'Units': 'degrees'})
 
-        ## Q3 - mask
-        dsName = 'mask'
+    elif dsName in ['rangeCoord', 'azimuthCoord']:
+        attrs.update({'MissingValue': FLOAT_ZERO, '_FillValue': FLOAT_ZERO, 'Units': '1'})
+
+    elif dsName in ['mask', 'waterMask', 'shadowMask']:
+        attrs.update({'MissingValue': BOOL_ZERO, '_FillValue': BOOL_ZERO, 'Units': '1'})
+    return attrs
+
+
+def get_quality_datasets(tcoh_file, scoh_file, mask_file):
+    """(dsName, file, datasetName) of the quality group."""
+    return [('temporalCoherence', tcoh_file, None),
+            ('avgSpatialCoherence', scoh_file, None),
+            ('mask', mask_file, 'mask')]
+
+
+def write_quality_datasets(group, tcoh_file, scoh_file, mask_file, profile=DEFAULT_PROFILE):
+    """Write (or overwrite) temporalCoherence, avgSpatialCoherence and mask of the quality group."""
+    for dsName, fname, dsetName in get_quality_datasets(tcoh_file, scoh_file, mask_file):
         # read
-        data = readfile.read(mask_file, datasetName='mask')[0]
+        data = readfile.read(fname, datasetName=dsetName)[0]
         # write
-        dset = create_hdf5_dataset(group, dsName, data)
+        if dsName in group:
+            print(f'overwrite dataset {group.name}/{dsName}')
+            dset = group[dsName]
+            dset[:] = data
+        else:
+            dset = create_hdf5_dataset(group, dsName, data, profile=profile)
         # attributes
-        dset.attrs['Title'] = dsName
-        dset.attrs['MissingValue'] = BOOL_ZERO
-        dset.attrs['_FillValue'] = BOOL_ZERO
-        dset.attrs['Units'] = '1'
-
-        ##### Group - Write Geometry
-        # Required: height, incidenceAngle
-        # Optional: rangeCoord, azimuthCoord, azimuthAngle, slantRangeDistance,
-        #           waterMask, shadowMask
-        gName = 'HDFEOS/GRIDS/timeseries/geometry'
-        print(f'create group   /{gName}')
-        group = f.create_group(gName)
-
-        geom_obj = geometry(geom_file)
+        for key, value in get_dataset_attrs(dsName).items():
+            dset.attrs[key] = value
+    return
+
+
+def compress_static_dataset(args):
+    """Read one quality/geometry dataset and write it compressed into its own temporary file (runs in a worker)."""
+    fname, dsetName, dsName, is_geometry, profile, tmp_file = args
+    if is_geometry:
+        geom_obj = geometry(fname)
         geom_obj.open(print_msg=False)
-        for dsName in geom_obj.datasetNames:
-            # read
-            data = geom_obj.read(datasetName=dsName, print_msg=False)
-            # write
-            dset = create_hdf5_dataset(group, dsName, data)
+        data = geom_obj.read(datasetName=dsetName, print_msg=False)
+    else:
+        data = readfile.read(fname, datasetName=dsetName)[0]
+
+    with h5py.File(tmp_file, 'w') as f:
+        dset = f.create_dataset(dsName, data=data, **get_storage_options(profile, data.shape))
+        for key, value in get_dataset_attrs(dsName).items():
+            dset.attrs[key] = value
+    return tmp_file, str(data.dtype), data.shape
+
+
+def start_static_datasets(tcoh_file, scoh_file, mask_file, geom_file, profile, tmp_dir, num_worker=NUM_WORKER):
+    """Submit the quality and geometry datasets to a pool of workers.
+    Returns the pool and a list of (group name, dataset name, async result) in writing order.
+    """
+    # Required: height, incidenceAngle
+    # Optional: rangeCoord, azimuthCoord, azimuthAngle, slantRangeDistance,
+    #           waterMask, shadowMask
+    geom_obj = geometry(geom_file)
+    geom_obj.open(print_msg=False)
+
+    jobs = []
+    for dsName, fname, dsetName in get_quality_datasets(tcoh_file, scoh_file, mask_file):
+        jobs.append(('HDFEOS/GRIDS/timeseries/quality', dsName, (fname, dsetName, dsName, False)))
+    for dsName in geom_obj.datasetNames:
+        jobs.append(('HDFEOS/GRIDS/timeseries/geometry', dsName, (geom_file, dsName, dsName, True)))
+
+    pool = mp.Pool(max(1, min(num_worker, len(jobs))))
+    results = []
+    for i, (gName, dsName, args) in enumerate(jobs):
+        tmp_file = os.path.join(tmp_dir, f'{i:02d}_{dsName}.h5')
+        results.append((gName, dsName, pool.apply_async(compress_static_dataset, (args + (profile, tmp_file),))))
+    pool.close()
+    return pool, results
+
+
+def write_hdf5_file(metadata, out_file, ts_file, tcoh_file, scoh_file, mask_file, geom_file,
+                    profile=DEFAULT_PROFILE, num_worker=NUM_WORKER):
+    """Write HDF5 file in HDF-EOS5 format.
+    The quality and geometry datasets are read and compressed by worker processes while the displacement
+    is copied; the main process is the only writer and copies their compressed chunks into out_file.
+    """
+
+    ts_obj = timeseries(ts_file)
+    ts_obj.open(print_msg=False)
+    dateList = ts_obj.dateList
+    numDate = len(dateList)
+
+    # start the displacement reader and the quality and geometry workers before out_file is opened
+    dsShape = (numDate, ts_obj.length, ts_obj.width)
+    reader = start_displacement_reader(ts_file, dsShape)
+    tmp_dir = tempfile.mkdtemp(prefix='tmp_hdfeos5_', dir=os.path.dirname(os.path.abspath(out_file)))
+    pool, static_results = start_static_datasets(tcoh_file, scoh_file, mask_file, geom_file,
+                                                 profile, tmp_dir, num_worker=num_worker)
+
+    # Open HDF5 File
+    print(f'create HDF5 file: {out_file} with w mode')
+    max_digit = 55
+
+    try:
+        with h5py.File(out_file, 'w') as f:
+
+            ##### Group - Observation
+            gName = 'HDFEOS/GRIDS/timeseries/observation'
+            print(f'create group   /{gName}')
+            group = f.create_group(gName)
+
+            ## O1 - displacement
+            dsName = 'displacement'
+            dsDataType = np.float32
+            msg = 'create dataset /{d:<{w}}'.format(d=f'{gName}/{dsName}', w=max_digit)
+            msg += f' of {"float32":<10} in size of {dsShape} with compression={get_codec_name(profile)}'
+            print(msg)
+
+            dset = group.create_dataset(
+                dsName,
+                shape=dsShape,
+                maxshape=(None, dsShape[1], dsShape[2]),
+                dtype=dsDataType,
+                **get_storage_options(profile, dsShape),
+            )
+            print(f'storage profile: {profile}, chunks: {dset.chunks}')
+
+            write_displacement(dset, ts_file, dateList, reader=reader)
 
             # attributes
             dset.attrs['Title'] = dsName
-            if dsName in ['height', 'slantRangeDistance', 'bperp']:
-                dset.attrs['MissingValue'] = FLOAT_ZERO
-                dset.attrs['_FillValue'] = FLOAT_ZERO
-                dset.attrs['Units'] = 'meters'
-
-            elif dsName in ['incidenceAngle', 'azimuthAngle', 'latitude', 'longitude']:
-                dset.attrs['MissingValue'] = FLOAT_ZERO
-                dset.attrs['_FillValue'] = FLOAT_ZERO
-                dset.attrs['Units'] = 'degrees'
-
-            elif dsName in ['rangeCoord', 'azimuthCoord']:
-                dset.attrs['MissingValue'] = FLOAT_ZERO
-                dset.attrs['_FillValue'] = FLOAT_ZERO
-                dset.attrs['Units'] = '1'
-
-            elif dsName in ['waterMask', 'shadowMask']:
-                dset.attrs['MissingValue'] = BOOL_ZERO
-                dset.attrs['_FillValue'] = BOOL_ZERO
-                dset.attrs['Units'] = '1'
-
-        # Write Attributes to the HDF File
-        print('write metadata to root level')
-        for key, value in iter(metadata.items()):
-            f.attrs[key] = value
+            dset.attrs['MissingValue'] = FLOAT_ZERO
+            dset.attrs['_FillValue'] = FLOAT_ZERO
+            dset.attrs['Units'] = 'meters'
+
+            ## O2 - date
+            dsName = 'date'
+            data = np.array(dateList, dtype=np.string_)
+            dset = create_hdf5_dataset(group, dsName, data, profile=profile)
+
+            ## O3 - perp baseline
+            dsName = 'bperp'
+            data = np.array(ts_obj.pbase, dtype=np.float32)
+            dset = create_hdf5_dataset(group, dsName, data, profile=profile)
+
+            ##### Group - Quality and Geometry (compressed by the workers)
+            for gName, dsName, result in static_results:
+                if gName not in f:
+                    print(f'create group   /{gName}')
+                    f.create_group(gName)
+                tmp_file, dtype, shape = result.get()
+                msg = 'create dataset /{d:<{w}}'.format(d=f'{gName}/{dsName}', w=max_digit)
+                msg += f' of {dtype:<10} in size of {shape} with compression={get_codec_name(profile)}'
+                print(msg)
+                with h5py.File(tmp_file, 'r') as ft:
+                    f.copy(ft[dsName], f[gName], name=dsName)
+                os.remove(tmp_file)
+
+            # Write Attributes to the HDF File
+            print('write metadata to root level')
+            for key, value in iter(metadata.items()):
+                f.attrs[key] = value
+
+    finally:
+        if reader:
+            reader[0].terminate()
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
     print(f'finished writing to {out_file}')
 
     return out_file
 
 
+def find_existing_file(out_file, metadata):
+    """Existing HDF-EOS5 file of the same product with any end date (newest first), None if missing.
+    Copies left by an interrupted append (*.appending) are removed if the product exists; otherwise
+    they are kept (they may be the only copy of the product, e.g. from an older version of append).
+    """
+    DATE1 = dt.datetime.strptime(metadata['first_date'], '%Y-%m-%d').strftime('%Y%m%d')
+    DATE2 = dt.datetime.strptime(metadata['last_date'], '%Y-%m-%d').strftime('%Y%m%d')
+    pattern = out_file
+    for date2 in [DATE2, 'XXXXXXXX']:
+        pattern = pattern.replace(f'_{DATE1}_{date2}', f'_{DATE1}_' + '?' * 8)
+
+    files = sorted(glob.glob(pattern), key=os.path.getmtime, reverse=True)
+    for fname in glob.glob(pattern + '.appending'):
+        if files:
+            print(f'WARNING: remove {fname} left by an interrupted append')
+            os.remove(fname)
+        else:
+            print(f'WARNING: keep {fname} left by an interrupted append, no product file found; '
+                  f'rename it to recover the product')
+    return files[0] if files else None
+
+
+def has_storage_profile(dset, profile):
+    """True if the compression and the chunks of an existing dataset are those of a storage profile.
+    The time dimension of the chunks is not compared if the profile uses the full size (it grows with
+    appended dates), auto-chunking (default profile) is not compared at all.
+    """
+    opts = get_storage_options(profile, dset.shape)
+    if (dset.compression != opts['compression'] or dset.shuffle != opts.get('shuffle', False)
+            or dset.compression_opts != opts.get('compression_opts', dset.compression_opts)):
+        return False
+    chunks = STORAGE_PROFILES[profile]['chunks_3d']
+    if chunks is True:
+        return True
+    first = 0 if chunks[0] else 1
+    return dset.chunks is not None and tuple(dset.chunks[first:]) == tuple(opts['chunks'][first:])
+
+
+def append_hdf5_file(metadata, out_file, existing_file, ts_file, tcoh_file, scoh_file, mask_file,
+                     profile=DEFAULT_PROFILE):
+    """Append the new acquisitions of ts_file to existing_file and rename it to out_file.
+    Only the new displacement slices, date, bperp, quality datasets and root attributes are written.
+    Returns None (nothing written) if the existing file is not a prefix of the time-series, i.e. if
+    dates were removed or the displacement of existing dates changed, or if its displacement was not
+    written with the storage profile.
+    """
+    ts_obj = timeseries(ts_file)
+    ts_obj.open(print_msg=False)
+    dateList = ts_obj.dateList
+    gName = 'HDFEOS/GRIDS/timeseries/observation'
+
+    with h5py.File(existing_file, 'r') as f:
+        dset = f[f'{gName}/displacement']
+        oldDateList = [i.decode('utf8') for i in f[f'{gName}/date'][:]]
+        numOld = len(oldDateList)
+        if not has_storage_profile(dset, profile):
+            print(f'{existing_file} was not written with storage profile {profile}, append is not possible')
+            return None
+        if dateList[:numOld] != oldDateList or dset.shape[1:] != (ts_obj.length, ts_obj.width):
+            print(f'dates or size of {existing_file} do not match {ts_file}, append is not possible')
+            return None
+        # the displacement of sampled existing dates must be unchanged (same reference and network)
+        for i in {0, numOld // 2, numOld - 1}:
+            if not np.array_equal(dset[i], readfile.read(ts_file, datasetName=dateList[i])[0]):
+                print(f'displacement of {dateList[i]} changed in {ts_file}, append is not possible')
+                return None
+
+    newDateList = dateList[numOld:]
+    # append into a copy; existing_file is untouched until the copy replaces it
+    tmp_file = out_file + '.appending'
+    print(f'append {len(newDateList)} acquisitions to a copy of {existing_file}')
+    shutil.copy2(existing_file, tmp_file)
+    try:
+        append_to_copy(tmp_file, gName, ts_file, ts_obj, dateList, numOld, tcoh_file, scoh_file, mask_file,
+                       metadata, profile)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+    os.replace(tmp_file, out_file)
+    if os.path.abspath(existing_file) != os.path.abspath(out_file):
+        os.remove(existing_file)
+    print(f'finished appending to {out_file}')
+    return out_file
+
+
+def append_to_copy(tmp_file, gName, ts_file, ts_obj, dateList, numOld, tcoh_file, scoh_file, mask_file,
+                   metadata, profile):
+    """Write the new acquisitions, date, bperp, quality datasets and root attributes into tmp_file."""
+    newDateList = dateList[numOld:]
+    with h5py.File(tmp_file, 'a') as f:
+        group = f[gName]
+
+        ## O1 - displacement
+        dset = group['displacement']
+        dset.resize(len(dateList), axis=0)
+        if newDateList:
+            prog_bar = ptime.progressBar(maxValue=len(newDateList))
+            for i, date in enumerate(newDateList):
+                dset[numOld + i, :, :] = readfile.read(ts_file, datasetName=date)[0]
+                prog_bar.update(i+1, suffix=f'{i+1}/{len(newDateList)} {date}')
+            prog_bar.close()
+
+        ## O2, O3 - date and perp baseline
+        for dsName, data in [('date', np.array(dateList, dtype=np.string_)),
+                             ('bperp', np.array(ts_obj.pbase, dtype=np.float32))]:
+            del group[dsName]
+            create_hdf5_dataset(group, dsName, data, profile=profile)
+
+        ##### Group - Quality
+        write_quality_datasets(f['HDFEOS/GRIDS/timeseries/quality'], tcoh_file, scoh_file, mask_file,
+                               profile=profile)
+
+        print('update metadata at root level')
+        for key, value in iter(metadata.items()):
+            f.attrs[key] = value
+    return
+
+
 ################################################################
 def save_hdfeos5(inps):
 
@@ -470,6 +775,25 @@ def save_hdfeos5(inps):
         update_mode=inps.update,
         subset_mode=inps.subset)
 
+    profile = getattr(inps, 'profile', None) or DEFAULT_PROFILE
+
+    # append new acquisitions to an existing file of the same product
+    if getattr(inps, 'append', False):
+        existing_file = find_existing_file(out_file, meta)
+        if existing_file:
+            appended = append_hdf5_file(
+                metadata=meta,
+                out_file=out_file,
+                existing_file=existing_file,
+                ts_file=inps.ts_file,
+                tcoh_file=inps.tcoh_file,
+                scoh_file=inps.scoh_file,
+                mask_file=inps.mask_file,
+                profile=profile)
+            if appended:
+                return
+        print('write the full HDF-EOS5 file')
+
     # write HDF5 File
     write_hdf5_file(
         metadata=meta,
@@ -478,6 +802,7 @@ def save_hdfeos5(inps):
         tcoh_file=inps.tcoh_file,
         scoh_file=inps.scoh_file,
         mask_file=inps.mask_file,
-        geom_file=inps.geom_file)
+        geom_file=inps.geom_file,
+        profile=profile)
 
     return
@@ -11,6 +11,7 @@ import glob
 import argparse
 from minsar.objects.auto_defaults import PathFind
 from minsar.utils.process_utilities import xmlread, cmd_line_parse
+from minsar.utils.geocode_lookup import get_lookup, geocode_files
 from minsar.objects import message_rsmas
 
 pathObj = PathFind()
@@ -18,6 +19,7 @@ pathObj = PathFind()
 
 EXAMPLE = """example:
   create_amplitude_tif.py LombokSenAT156VV.template 
+  export_amplitude_tif.py LombokSenAT156VV.template -f 20190101 20190113 20190125 -y 0.0002 -x 0.0002 -t ortho --num-workers 4
 """
 
 
@@ -41,51 +43,72 @@ def main(iargs=None):
 
     message_rsmas.log(pic_dir, os.path.basename(__file__) + ' ' + ' '.join(input_arguments))
 
-    os.chdir(secondary_dir)
-
-    try:
-        os.system('rm '+ inps.input_file + '/geo*')
-    except:
-        print('geocoding ...')
-
-    slc = inps.input_file
-
     if inps.im_type == 'ortho':
         inps.geo_reference_dir = os.path.join(inps.work_dir, pathObj.georeferencedir)
     else:
         inps.geo_reference_dir = os.path.join(inps.work_dir, pathObj.geomlatlondir)
 
-    os.chdir(os.path.join(secondary_dir, inps.input_file))
+    xmlfile = glob.glob(os.path.join(inps.work_dir, pathObj.referencedir, '*.xml'))[0]
+    attributes = xmlread(xmlfile)
 
-    geocode_file(inps)
+    if inps.resampling_method == 'near':
+        # the lookup is computed once for the stack and shared by all SLCs (and export jobs)
+        lookup_file = get_lookup(os.path.join(inps.geo_reference_dir, inps.lat_file),
+                                 os.path.join(inps.geo_reference_dir, inps.lon_file),
+                                 inps.cropbox, inps.lat_step, inps.lon_step)
+        slc_files = [os.path.join(secondary_dir, slc, slc + '.slc.ml') for slc in inps.input_file]
+        for slc_file, array, transform in geocode_files(slc_files, lookup_file, num_workers=inps.num_workers):
+            slc = os.path.basename(os.path.dirname(slc_file))
+            print('geocoded ' + slc_file)
+            write_backscatter(array, transform, slc, inps.im_type, attributes, pic_dir)
+    else:
+        for slc in inps.input_file:
+            geocode_with_gdalwarp(slc, inps, attributes, secondary_dir, pic_dir)
 
-    gfile = 'geo_' + slc + '.slc.ml'
-    ds = gdal.Open(gfile + '.vrt', gdal.GA_ReadOnly)
-    array = np.abs(ds.GetRasterBand(1).ReadAsArray())
-    del ds
+    print('Find the output in {}'.format(pic_dir))
+
+    return
 
-    ##
+
+def write_backscatter(array, transform, slc, im_type, attributes, pic_dir):
+    """
+    Writes the geocoded amplitude of an SLC as backscatter geotiff.
+    """
     array = np.where(array > 0, 10.0 * np.log10(pow(array, 2)) - 83.0, array)
 
-    if inps.im_type == 'ortho':
+    if im_type == 'ortho':
         dst_file = 'orthorectified_' + slc + '_backscatter.tif'
     else:
         dst_file = 'georectified_' + slc + '_backscatter.tif'
 
-    data = gdal.Open(gfile, gdal.GA_ReadOnly)
-    transform = data.GetGeoTransform()
-
-    ##
-    xmlfile = glob.glob(os.path.join(inps.work_dir, pathObj.referencedir, '*.xml'))[0]
-    attributes = xmlread(xmlfile)
     Metadata = {'SAT': attributes['missionname'], 'Mode': attributes['passdirection'],
-                'Image_Type': '{}_BackScatter'.format(inps.im_type), 'Date': slc}
+                'Image_Type': '{}_BackScatter'.format(im_type), 'Date': slc}
 
-    raster2geotiff(dst_file, transform, array, Metadata)
+    raster2geotiff(os.path.join(pic_dir, dst_file), transform, array, Metadata)
 
-    print('Find the output in {}'.format(pic_dir))
+    return
+
+
+def geocode_with_gdalwarp(slc, inps, attributes, secondary_dir, pic_dir):
+    """
+    Geocodes one SLC with gdalwarp (resampling methods other than nearest neighbour).
+    """
+    slc_dir = os.path.join(secondary_dir, slc)
+    os.system('rm ' + slc_dir + '/geo*')
+    os.chdir(slc_dir)
+
+    geocode_file(argparse.Namespace(**dict(vars(inps), input_file=slc)))
+
+    gfile = 'geo_' + slc + '.slc.ml'
+    ds = gdal.Open(gfile + '.vrt', gdal.GA_ReadOnly)
+    array = np.abs(ds.GetRasterBand(1).ReadAsArray())
+    del ds
+
+    data = gdal.Open(gfile, gdal.GA_ReadOnly)
+    transform = data.GetGeoTransform()
+    del data
 
-    os.system('mv *.tif {}'.format(pic_dir))
+    write_backscatter(array, transform, slc, inps.im_type, attributes, pic_dir)
     os.system('rm geo*')
 
     return
@@ -156,8 +179,8 @@ def geocode_file(inps):
     outFile = os.path.join(os.path.dirname(infile), "geo_" + os.path.basename(infile))
     gg.writeVRT(infile, latFile, lonFile)
 
-    cmd = 'gdalwarp -of ENVI -geoloc  -te ' + WSEN + ' -tr ' + str(inps.lat_step) + ' ' + \
-          str(inps.lon_step) + ' -srcnodata 0 -dstnodata 0 ' + ' -r ' + inps.resampling_method + \
+    cmd = 'gdalwarp -of ENVI -geoloc  -te ' + WSEN + ' -tr ' + str(inps.lon_step) + ' ' + \
+          str(inps.lat_step) + ' -srcnodata 0 -dstnodata 0 ' + ' -r ' + inps.resampling_method + \
           ' -co INTERLEAVE=BIL ' + infile + '.vrt ' + outFile
     print(cmd)
     os.system(cmd)
@@ -230,18 +230,20 @@ def make_run_list(inps):
 
     ifgram_cmd = 'ifgramStack_to_ifgram_and_coherence.py {}'.format(inps.custom_template_file)
 
+    # one command for all SLCs: the geocoding lookup is computed once and the SLCs are geocoded with
+    # --num-workers processes, instead of concurrent jobs that each compute the same lookup
+    dates = ' '.join(sorted(slc_list))
+
     with open(run_orthorectify, 'w') as f:
-        for item in slc_list:
-            cmd = 'export_amplitude_tif.py {a0} -f {a1} -y {a2} -x {a3}  -t ortho \n'.format(
-                a0=inps.custom_template_file, a1=item, a2=latstep, a3=lonstep)
-            f.write(cmd)
+        cmd = 'export_amplitude_tif.py {a0} -f {a1} -y {a2} -x {a3}  -t ortho \n'.format(
+            a0=inps.custom_template_file, a1=dates, a2=latstep, a3=lonstep)
+        f.write(cmd)
         f.write(ifgram_cmd)
 
     with open(run_georectify, 'w') as f:
-        for item in slc_list:
-            cmd = 'export_amplitude_tif.py {a0} -f {a1} -y {a2} -x {a3} -t geo \n'.format(
-                a0=inps.custom_template_file, a1=item, a2=latstep, a3=lonstep)
-            f.write(cmd)
+        cmd = 'export_amplitude_tif.py {a0} -f {a1} -y {a2} -x {a3} -t geo \n'.format(
+            a0=inps.custom_template_file, a1=dates, a2=latstep, a3=lonstep)
+        f.write(cmd)
 
     run_file_list = [run_orthorectify, run_georectify]
 
@@ -9,6 +9,11 @@ import os
 import sys
 import glob
 import time
+import json
+import hashlib
+import multiprocessing as mp
+import h5py
+import numpy as np
 from osgeo import gdal, osr, ogr
 import mintpy
 import mintpy.workflow  # dynamic import for modules used by smallbaselineApp workflow
@@ -21,13 +26,19 @@ from minsar.job_submission import JOB_SUBMIT
 
 pathObj = PathFind()
 
+# rows per block read from the geocoded stack (rounded to whole HDF5 chunks)
+BLOCK_ROWS = 512
+# Cloud-Optimized GeoTIFF: internal tiles, DEFLATE and overviews down to ~256 pixels
+COG_OPTIONS = ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'BLOCKSIZE=512', 'OVERVIEWS=AUTO', 'RESAMPLING=AVERAGE']
+EXPORT_TYPES = {'coherence': 'coherence', 'unwrapPhase': 'interferogram'}
+
 ###############################################################################
 
 
 def main(iargs=None):
     """ generates interferograms and coherence images in GeoTiff format """
 
-    inps = putils.cmd_line_parse(iargs)
+    inps = putils.cmd_line_parse(iargs, script='ifgramStack_to_ifgram_and_coherence')
 
     if not iargs is None:
         input_arguments = iargs
@@ -68,62 +79,145 @@ def main(iargs=None):
     if not os.path.isdir(inps.work_dir + '/mintpy/geo'):
         os.makedirs(inps.work_dir + '/mintpy/geo')
 
-    # geocode ifgramStack
+    # geocode ifgramStack (update mode: skipped if geo_file is newer than ifgramStack.h5 and the lookup file,
+    # so the GeoTIFF fingerprints, which include the time of geo_file, stay the same)
     geo_file = os.path.dirname(os.path.dirname(file)) + '/geo/geo_' + os.path.basename(file)
     lookup_file = os.path.dirname(os.path.dirname(file)) + '/inputs/geometryRadar.h5'
     template_file = os.path.dirname(os.path.dirname(file)) + '/smallbaselineApp_template.txt'
-    arg_string = file + ' -t ' + template_file + ' -l ' + lookup_file + ' -o ' + geo_file
+    arg_string = file + ' -t ' + template_file + ' -l ' + lookup_file + ' -o ' + geo_file + ' --update'
     print('geocode.py', arg_string)
     mintpy.geocode.main(arg_string.split())
 
-    # loop over all interferograms
+    # export all interferograms from the geocoded stack
     obj = ifgramStack(geo_file)
     obj.open()
     date12_list = obj.get_date12_list()
-    # dummy_data, atr = readfile.read(geo_file)
-
-    for i in range(len(date12_list)):
-        date_str = date12_list[i]
-        print('Working on ... ' + date_str)
-        data_coh = readfile.read(file, datasetName='coherence-' + date_str)[0]
-        data_unw = readfile.read(file, datasetName='unwrapPhase-' + date_str)[0]
 
-        fname_coh = out_dir + '/coherence_' + date_str + '.tif'
-        fname_unw = out_dir + '/interferogram_' + date_str + '.tif'
+    xmlfile = glob.glob(os.path.join(inps.work_dir, pathObj.referencedir, '*.xml'))[0]
+    attributes = putils.xmlread(xmlfile)
+    metadata = obj.get_metadata()
+    base_metadata = {'SAT': attributes['missionname'], 'Mode': attributes['passdirection'],
+                     'Date': metadata['START_DATE'] + '-' + metadata['END_DATE']}
 
-        create_geotiff(obj, data=data_coh, outfile=fname_coh, type='coherence', work_dir=inps.work_dir)
-        create_geotiff(obj, data=data_unw, outfile=fname_unw, type='interferogram', work_dir=inps.work_dir)
+    jobs = get_export_jobs(geo_file, date12_list, out_dir, base_metadata, force=inps.force)
+    export_geotiffs(jobs, num_workers=inps.num_workers)
     return
 
 
-def create_geotiff (obj, data, outfile, type, work_dir):
-    ''' creates a geo_tiff '''
+def get_export_jobs(geo_file, date12_list, out_dir, base_metadata, force=False):
+    """ one job per GeoTIFF: coherence_<date12>.tif and interferogram_<date12>.tif of each pair """
+
+    with h5py.File(geo_file, 'r') as f:
+        all_date12 = ['_'.join(d.decode('utf8') for d in dates) for dates in f['date'][:]]
+        atr = dict(f.attrs)
+    geo_transform = [float(atr['X_FIRST']), float(atr['X_STEP']), 0,
+                     float(atr['Y_FIRST']), 0, float(atr['Y_STEP'])]
+
+    jobs = []
+    for date12 in date12_list:
+        for dataset, type in EXPORT_TYPES.items():
+            jobs.append({'geo_file': geo_file,
+                         'dataset': dataset,
+                         'index': all_date12.index(date12),
+                         'date12': date12,
+                         'outfile': out_dir + '/' + type + '_' + date12 + '.tif',
+                         'geo_transform': geo_transform,
+                         'metadata': dict(base_metadata, Image_Type='ortho_{}'.format(type)),
+                         'force': force})
+    return jobs
+
+
+def export_geotiffs(jobs, num_workers=1):
+    """ writes the GeoTIFFs of all jobs in parallel and reports written/skipped files """
+
+    time0 = time.time()
+    if num_workers > 1 and len(jobs) > 1:
+        with mp.Pool(min(num_workers, len(jobs))) as pool:
+            results = pool.map(export_geotiff, jobs, chunksize=1)
+    else:
+        results = [export_geotiff(job) for job in jobs]
+
+    num_written = sum(1 for result in results if result == 'written')
+    print('wrote {} GeoTIFFs, skipped {} up-to-date GeoTIFFs in {:.1f} s ({} workers)'.format(
+          num_written, len(results) - num_written, time.time() - time0, num_workers))
+    return results
 
-    originX = float(obj.get_metadata()['X_FIRST'])
-    pixelWidth = float(obj.get_metadata()['X_STEP'])
-    originY = float(obj.get_metadata()['Y_FIRST'])
-    pixelHeight = float(obj.get_metadata()['Y_STEP'])
-    gt = [originX, pixelWidth, 0, originY, 0, pixelHeight]
-    driver = gdal.GetDriverByName('GTiff')
-    ds = driver.Create(outfile, data.shape[1], data.shape[0], 1, gdal.GDT_Float32, )
 
-    # this assumes the projection is Geographic lat/lon WGS 84
-    srs = osr.SpatialReference()
-    srs.ImportFromEPSG(4326)
-    ds.SetProjection(srs.ExportToWkt())
-    ds.SetGeoTransform(gt)
+def get_row_blocks(dset, block_rows=BLOCK_ROWS):
+    """ row windows of about block_rows, rounded to whole chunks of the HDF5 dataset """
 
-    # metadata consistent with Backscatter products:
-    xmlfile = glob.glob(os.path.join(work_dir, pathObj.referencedir, '*.xml'))[0]
-    attributes = putils.xmlread(xmlfile)
-    Metadata = {'SAT': attributes['missionname'], 'Mode': attributes['passdirection'],
-                'Image_Type': 'ortho_{}'.format(type),
-                'Date': obj.get_metadata()['START_DATE'] + '-' + obj.get_metadata()['END_DATE']}
-    ds.SetMetadata(Metadata)
-
-    outband = ds.GetRasterBand(1)
-    outband.WriteArray(data)
-    outband.FlushCache()
+    length = dset.shape[-2]
+    chunk_rows = dset.chunks[-2] if dset.chunks else 1
+    step = max(1, int(round(block_rows / chunk_rows))) * chunk_rows
+    return [(row0, min(row0 + step, length)) for row0 in range(0, length, step)]
+
+
+def get_fingerprint(job):
+    """ md5 of the geo file (path, size, time), pair, dataset attributes, geo transform and metadata """
+
+    stat = os.stat(job['geo_file'])
+    with h5py.File(job['geo_file'], 'r') as f:
+        dset = f[job['dataset']]
+        attrs = {key: str(value) for key, value in dset.attrs.items()}
+        shape, dtype = list(dset.shape), str(dset.dtype)
+    items = [os.path.abspath(job['geo_file']), stat.st_size, int(stat.st_mtime), job['dataset'], job['date12'],
+             shape, dtype, attrs, job['geo_transform'], job['metadata']]
+    return hashlib.md5(json.dumps(items, sort_keys=True).encode()).hexdigest()
+
+
+def export_geotiff(job):
+    """ writes one pair as Cloud-Optimized GeoTIFF; skipped if the existing file has the same fingerprint """
+
+    fingerprint = get_fingerprint(job)
+    if not job['force'] and os.path.isfile(job['outfile']):
+        ds = gdal.Open(job['outfile'])
+        existing = ds.GetMetadataItem('FINGERPRINT') if ds else None
+        ds = None
+        if existing == fingerprint:
+            return 'skipped'
+
+    print('Working on ... ' + os.path.basename(job['outfile']))
+    tmp_file = job['outfile'] + '.tmp.tif'
+    create_geotiff(job, tmp_file, metadata=dict(job['metadata'], FINGERPRINT=fingerprint))
+
+    cog_driver = gdal.GetDriverByName('COG')
+    if cog_driver is not None:
+        gdal.Translate(job['outfile'], tmp_file, format='COG', creationOptions=COG_OPTIONS)
+    else:
+        # GDAL < 3.1: tiled GeoTIFF with overviews copied in front of the data
+        ds = gdal.Open(tmp_file, gdal.GA_Update)
+        ds.BuildOverviews('AVERAGE', [2, 4, 8, 16, 32])
+        ds = None
+        gdal.Translate(job['outfile'], tmp_file, format='GTiff',
+                       creationOptions=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+                                        'COMPRESS=DEFLATE', 'COPY_SRC_OVERVIEWS=YES'])
+    gdal.GetDriverByName('GTiff').Delete(tmp_file)
+    return 'written'
+
+
+def create_geotiff(job, outfile, metadata):
+    ''' creates a tiled geo_tiff, reading the geocoded stack in chunk-aligned blocks '''
+
+    with h5py.File(job['geo_file'], 'r') as f:
+        dset = f[job['dataset']]
+        length, width = dset.shape[-2:]
+        driver = gdal.GetDriverByName('GTiff')
+        ds = driver.Create(outfile, width, length, 1, gdal.GDT_Float32,
+                           options=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512'])
+
+        # this assumes the projection is Geographic lat/lon WGS 84
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        ds.SetProjection(srs.ExportToWkt())
+        ds.SetGeoTransform(job['geo_transform'])
+
+        # metadata consistent with Backscatter products:
+        ds.SetMetadata(metadata)
+
+        outband = ds.GetRasterBand(1)
+        for row0, row1 in get_row_blocks(dset):
+            outband.WriteArray(dset[job['index'], row0:row1, :].astype(np.float32), 0, row0)
+        outband.FlushCache()
 
     ds = None
     return 
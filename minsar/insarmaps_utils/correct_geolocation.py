@@ -2,6 +2,8 @@
 # Author: Sara Mirzaee
 
 import os
+import itertools
+import multiprocessing as mp
 import numpy as np
 import argparse
 import h5py
@@ -10,6 +12,11 @@ import pandas as pd
 
 DESCRIPTION = "Correct for geolocation shift caused by DEM error."
 
+# HDF5 mode: row blocks of whole chunks with about MAX_BLOCK_MB per array
+MAX_BLOCK_MB = 32
+# CSV mode: rows per batch
+BATCH_ROWS = 100000
+
 EXAMPLE = """\
 Supports:
     - HDF5 input (default)
@@ -48,6 +55,8 @@ def cmd_line_parse(iargs=None):
     #arguments for csv
     parser.add_argument("input_file", type=str, help="Input CSV or HDF5 file")
     parser.add_argument("--outfile", type=str, help="Output file (for CSV mode only)")
+    parser.add_argument("--num-workers", dest="num_workers", type=int, default=min(4, os.cpu_count() or 1),
+                        help="number of processes for the blocks/row batches (default: %(default)s)")
 
     inps = parser.parse_args(args=iargs)
     return inps
@@ -70,144 +79,213 @@ def main(iargs=None):
     if inps.input_file.endswith(".csv"):
         correct_geolocation_csv(
             input_file=inps.input_file,
-            output_file=inps.outfile
+            output_file=inps.outfile,
+            num_workers=inps.num_workers
         )
         return
 
-    key = 'geolocation_corrected'
-
-    with h5py.File(inps.geometry_file, 'r') as f:
-        keys = f.attrs.keys()
-        latitude = f['latitude'][:, :]
-        longitude = f['longitude'][:, :]
+    correct_geolocation_hdf5(inps.geometry_file, inps.dem_error_file, reverse=inps.reverse,
+                             num_workers=inps.num_workers)
 
-        atr = readfile.read(inps.geometry_file, datasetName='azimuthAngle')[1]
+    return
 
-        if not key in keys or atr[key] == 'no':
-            status = 'run'
-            print('Run geolocation correction ...')
-        else:
-            status = 'skip'
-            print('Geolocation is already done, you may reverse it using --reverse. skip ...')
 
-        if inps.reverse:
-            if key in keys and atr[key] == 'yes':
-                status = 'run'
-                print('Run reversing geolocation correction ...')
-            else:
-                status = 'skip'
-                print('The file is not corrected for geolocation. skip ...')
+def get_row_blocks(dset, max_mb=MAX_BLOCK_MB):
+    """
+    Row blocks of whole HDF5 chunks with about max_mb of float64 data per array.
+    """
+    length, width = dset.shape
+    chunk_rows = dset.chunks[0] if dset.chunks else 1
+    num_rows = max(1, int(max_mb * 1024 ** 2 / (width * 8)) // chunk_rows) * chunk_rows
+    return [(row0, min(row0 + num_rows, length)) for row0 in range(0, length, num_rows)]
 
-    if status == 'run':
 
-        az_angle = np.deg2rad(float(atr['HEADING']))
-        inc_angle = np.deg2rad(readfile.read(inps.geometry_file, datasetName='incidenceAngle')[0])
+def compute_geolocation_shift(latitude, inc_angle, dem_error, az_angle):
+    """
+    Shift in longitude (dx) and latitude (dy) in degrees caused by the DEM error.
+    """
+    rad_latitude = np.deg2rad(latitude)
 
-        dem_error = readfile.read(inps.dem_error_file, datasetName='dem')[0]
+    one_degree_latitude = 111132.92 - 559.82 * np.cos(2*rad_latitude) + \
+                          1.175 * np.cos(4 * rad_latitude) - 0.0023 * np.cos(6 * rad_latitude)
 
-        rad_latitude = np.deg2rad(latitude)
+    one_degree_longitude = 111412.84 * np.cos(rad_latitude) - \
+                           93.5 * np.cos(3 * rad_latitude) + 0.118 * np.cos(5 * rad_latitude)
 
-        one_degree_latitude = 111132.92 - 559.82 * np.cos(2*rad_latitude) + \
-                              1.175 * np.cos(4 * rad_latitude) - 0.0023 * np.cos(6 * rad_latitude)
+    #one_degree_latitude = measure_d(latitude, latitude+1, 0, 0)
+    #one_degree_longitude = measure_d(latitude, latitude, 10, 11)
 
-        one_degree_longitude = 111412.84 * np.cos(rad_latitude) - \
-                               93.5 * np.cos(3 * rad_latitude) + 0.118 * np.cos(5 * rad_latitude)
+    dx = np.divide((dem_error) * (1 / np.tan(inc_angle)) * np.cos(az_angle), one_degree_longitude)  # converted to degree
+    dy = np.divide((dem_error) * (1 / np.tan(inc_angle)) * np.sin(az_angle), one_degree_latitude)  # converted to degree
 
-        print(np.mean(one_degree_latitude), np.mean(one_degree_longitude))
+    return dx, dy
 
-        #one_degree_latitude = measure_d(latitude, latitude+1, 0, 0)
-        #one_degree_longitude = measure_d(latitude, latitude, 10, 11)
 
-        #print(np.mean(one_degree_latitude), np.mean(one_degree_longitude))
-        
-        dx = np.divide((dem_error) * (1 / np.tan(inc_angle)) * np.cos(az_angle), one_degree_longitude)  # converted to degree
-        dy = np.divide((dem_error) * (1 / np.tan(inc_angle)) * np.sin(az_angle), one_degree_latitude)  # converted to degree
+def correct_block(args):
+    """
+    Corrected (or reversed) latitude and longitude of a row block (runs in a worker).
+    """
+    row0, latitude, longitude, inc_angle, dem_error, az_angle, reverse = args
 
-        if inps.reverse:
-            sign = np.sign(latitude)
-            latitude -= sign * dy
+    dx, dy = compute_geolocation_shift(latitude, np.deg2rad(inc_angle), dem_error, az_angle)
+    factor = -1 if reverse else 1
+    latitude += factor * np.sign(latitude) * dy
+    longitude += factor * np.sign(longitude) * dx
 
-            sign = np.sign(longitude)
-            longitude -= sign * dx
+    return row0, latitude, longitude
 
-            atr[key] = 'no'
-            block = [0, latitude.shape[0], 0, latitude.shape[1]]
-            writefile.write_hdf5_block(inps.geometry_file,
-                                       data=latitude,
-                                       datasetName='latitude',
-                                       block=block)
 
-            writefile.write_hdf5_block(inps.geometry_file,
-                                       data=longitude,
-                                       datasetName='longitude',
-                                       block=block)
+def correct_geolocation_hdf5(geometry_file, dem_error_file, reverse=False, num_workers=1):
+    """
+    Correct latitude and longitude of the geometry file in place, in chunk-aligned row blocks.
+    """
+    key = 'geolocation_corrected'
 
-            ut.add_attribute(inps.geometry_file, atr_new=atr)
+    atr = readfile.read_attribute(geometry_file, datasetName='azimuthAngle')
 
+    if not key in atr or atr[key] == 'no':
+        status = 'run'
+        print('Run geolocation correction ...')
+    else:
+        status = 'skip'
+        print('Geolocation is already done, you may reverse it using --reverse. skip ...')
 
+    if reverse:
+        if key in atr and atr[key] == 'yes':
+            status = 'run'
+            print('Run reversing geolocation correction ...')
         else:
-            sign = np.sign(latitude)
-            latitude += sign * dy
-
-            sign = np.sign(longitude)
-            longitude += sign * dx
-
-            atr[key] = 'yes'
-            block = [0, latitude.shape[0], 0, latitude.shape[1]]
-            writefile.write_hdf5_block(inps.geometry_file,
-                                       data=latitude,
-                                       datasetName='latitude',
-                                       block=block)
-            writefile.write_hdf5_block(inps.geometry_file,
-                                       data=longitude,
-                                       datasetName='longitude',
-                                       block=block)
-            ut.add_attribute(inps.geometry_file, atr_new=atr)
-
-    f.close()
-
-    return
+            status = 'skip'
+            print('The file is not corrected for geolocation. skip ...')
 
-def correct_geolocation_csv(input_file, output_file=None):
-    df = pd.read_csv(input_file)
+    if status == 'skip':
+        return
 
-    if "xcoord" in df.columns and "ycoord" in df.columns:
-        xcol, ycol = "xcoord", "ycoord"
-    elif "X" in df.columns and "Y" in df.columns:
-        xcol, ycol = "X", "Y"
-    else:
-        raise ValueError("CSV must contain either ('xcoord', 'ycoord') or ('X', 'Y') columns")
+    az_angle = np.deg2rad(float(atr['HEADING']))
+
+    with h5py.File(geometry_file, 'r') as f:
+        blocks = get_row_blocks(f['latitude'])
+        width = f['latitude'].shape[1]
+
+    #only this process reads and writes the geometry file, workers do the computation;
+    #the workers are started before the file is opened for writing so they do not inherit its handle
+    #batches of 2 blocks per worker bound the data held in memory
+    batch_size = 2 * max(num_workers, 1)
+    pool = mp.Pool(num_workers) if num_workers > 1 and len(blocks) > 1 else None
+    try:
+        with h5py.File(geometry_file, 'r+') as f:
+
+            def read_blocks(batch):
+                for row0, row1 in batch:
+                    box = (0, row0, width, row1)
+                    yield (row0,
+                           f['latitude'][row0:row1, :].astype(np.float64),
+                           f['longitude'][row0:row1, :].astype(np.float64),
+                           f['incidenceAngle'][row0:row1, :].astype(np.float64),
+                           readfile.read(dem_error_file, datasetName='dem', box=box)[0].astype(np.float64),
+                           az_angle,
+                           reverse)
+
+            for start in range(0, len(blocks), batch_size):
+                batch = blocks[start:start + batch_size]
+                jobs = list(read_blocks(batch))
+                results = pool.imap_unordered(correct_block, jobs) if pool else map(correct_block, jobs)
+                for row0, latitude, longitude in results:
+                    row1 = row0 + latitude.shape[0]
+                    f['latitude'][row0:row1, :] = latitude
+                    f['longitude'][row0:row1, :] = longitude
+                print('corrected {} of {} blocks'.format(min(start + batch_size, len(blocks)), len(blocks)))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    atr[key] = 'no' if reverse else 'yes'
+    ut.add_attribute(geometry_file, atr_new=atr)
 
-    if "dem_error" not in df.columns:
-        raise ValueError("Missing required column: 'dem_error'")
+    return
 
+def correct_coordinates(lon, lat, dem_error):
+    """
+    Geolocation correction of point coordinates (degrees) for the DEM error (m).
+    Returns corrected lon, lat arrays.
+    """
     #from the paper
     inc_angle = np.radians(42.85)
     az_angle = np.radians(350)
 
     cot_theta = 1 / np.tan(inc_angle)
 
-    dx_m = -df["dem_error"] * cot_theta * np.cos(az_angle)
-    dy_m =  df["dem_error"] * cot_theta * np.sin(az_angle)
+    dx_m = -dem_error * cot_theta * np.cos(az_angle)
+    dy_m =  dem_error * cot_theta * np.sin(az_angle)
 
     #degree conversion (per meter)
     meter_to_deg_lat = 1 / 111320
-    meter_to_deg_lon = 1 / (111320 * np.cos(np.radians(df[ycol])))
+    meter_to_deg_lon = 1 / (111320 * np.cos(np.radians(lat)))
+
+    return lon + dx_m * meter_to_deg_lon, lat + dy_m * meter_to_deg_lat
+
+
+def correct_csv_batch(args):
+    """
+    Add X_geocorr and Y_geocorr columns to a batch of CSV rows (runs in a worker).
+    """
+    df, xcol, ycol, cols = args
+    df["X_geocorr"], df["Y_geocorr"] = correct_coordinates(df[xcol].values, df[ycol].values,
+                                                           df["dem_error"].values)
+    return df[cols]
+
 
-    df["X_geocorr"] = df[xcol] + dx_m * meter_to_deg_lon
-    df["Y_geocorr"] = df[ycol] + dy_m * meter_to_deg_lat
+def correct_geolocation_csv(input_file, output_file=None, num_workers=1, batch_rows=BATCH_ROWS):
+    """
+    Correct a point CSV in batches of batch_rows rows; rows keep their order.
+    """
+    columns = pd.read_csv(input_file, nrows=0).columns.tolist()
 
-    insert_before = "point_id" if "point_id" in df.columns else "velocity"
-    insert_idx = df.columns.get_loc(insert_before)
-    cols = df.columns.tolist()
-    for col in ["X_geocorr", "Y_geocorr"]:
-        cols.insert(insert_idx, cols.pop(cols.index(col)))
-    df = df[cols]
-    
+    if "xcoord" in columns and "ycoord" in columns:
+        xcol, ycol = "xcoord", "ycoord"
+    elif "X" in columns and "Y" in columns:
+        xcol, ycol = "X", "Y"
+    else:
+        raise ValueError("CSV must contain either ('xcoord', 'ycoord') or ('X', 'Y') columns")
+
+    if "dem_error" not in columns:
+        raise ValueError("Missing required column: 'dem_error'")
+
+    insert_before = "point_id" if "point_id" in columns else "velocity"
+    cols = [col for col in columns if col not in ["X_geocorr", "Y_geocorr"]]
+    insert_idx = cols.index(insert_before)
+    cols[insert_idx:insert_idx] = ["Y_geocorr", "X_geocorr"]
 
     output_path = output_file or f"{os.path.splitext(input_file)[0]}_geocorr.csv"
-    df.to_csv(output_path, index=False)
+    tmp_path = output_path + ".tmp"
+
+    #batches of 2 row batches per worker bound the data held in memory
+    batch_size = 2 * max(num_workers, 1)
+    reader = pd.read_csv(input_file, chunksize=batch_rows)
+    pool = mp.Pool(num_workers) if num_workers > 1 else None
+    num_rows = 0
+    try:
+        with open(tmp_path, "w") as f:
+            #header first, so that a CSV without rows keeps its columns
+            pd.DataFrame(columns=cols).to_csv(f, index=False)
+            while True:
+                jobs = [(df, xcol, ycol, cols) for df in itertools.islice(reader, batch_size)]
+                if not jobs:
+                    break
+                results = pool.imap(correct_csv_batch, jobs) if pool else map(correct_csv_batch, jobs)
+                for df in results:
+                    df.to_csv(f, index=False, header=False)
+                    num_rows += len(df)
+                print(f"Corrected {num_rows} rows")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    os.replace(tmp_path, output_path)
     print(f"Geolocation-corrected CSV saved to: {output_path}")
 
+
 if __name__ == '__main__':
     main()
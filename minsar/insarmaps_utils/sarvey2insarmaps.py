@@ -11,6 +11,7 @@ from datetime import date
 from mintpy.utils import readfile
 import webbrowser
 import sys
+from minsar.insarmaps_utils.sarvey_pipeline import run_pipeline
 
 sys.path.insert(0, os.getenv("SSARAHOME"))
 import password_config as password
@@ -26,6 +27,7 @@ def create_parser():
         sarvey2insarmaps.py outputs/shp/p2_coh70_ts.shp --geocorr
         sarvey2insarmaps.py outputs/shp/p2_coh70_ts.shp --make-jobfile
         sarvey2insarmaps.py outputs/shp/p2_coh70_ts.shp --skip-upload
+        sarvey2insarmaps.py outputs/shp/p2_coh70_ts.shp --streaming-pipeline
 
         sarvey2insarmaps.py outputs/p2_coh80_ts.h5
         sarvey2insarmaps.py outputs/p2_coh80_ts.h5 --sarvey-geocorr
@@ -46,6 +48,10 @@ def create_parser():
     )
     parser.set_defaults(do_geocorr=False)
     parser.add_argument("--sarvey-geocorr", action="store_true", help="Apply geolocation correction for sarvey_export (--correct_geo)")
+    parser.add_argument("--streaming-pipeline", action="store_true",
+                        help="Convert SHP -> JSON -> MBTiles in-process without intermediate CSVs (experimental,\n"
+                             "check with sarvey_pipeline.py --compare-legacy; default: ogr2ogr, correct_geolocation.py\n"
+                             "and hdfeos5_or_csv_2json_mbtiles.py as separate steps; not used for --make-jobfile)")
 
     return parser
 
@@ -417,6 +423,8 @@ def main():
 
     if inps.make_jobfile:
             print("[INFO] Creating jobfile only, skipping execution.")
+            if inps.streaming_pipeline:
+                print("[WARN] --streaming-pipeline is ignored, the jobfile runs the separate steps.")
             create_jobfile(inps, input_path, (cmd0, cmd1, cmd2, cmd3, cmd4), json_dir, base_dir, mbtiles_path, dataset_name, metadata)
             return
     
@@ -424,11 +432,15 @@ def main():
     if input_path.suffix == ".h5":
         run_command(cmd0, cwd=h5_path.parent.parent)
 
-    #run all steps sequentially
-    run_command(cmd1)
-    if inps.do_geocorr:
-        run_command(cmd2)
-    run_command(cmd3)
+    if inps.streaming_pipeline:
+        #SHP -> (geolocation correction) -> JSON chunks + MBTiles in one pass, no intermediate CSV
+        run_pipeline(shp_path, json_dir, mbtiles_path, dataset_name, metadata, do_geocorr=inps.do_geocorr)
+    else:
+        #run all steps sequentially
+        run_command(cmd1)
+        if inps.do_geocorr:
+            run_command(cmd2)
+        run_command(cmd3)
 
     metadata = update_and_save_final_metadata(json_dir, outdir, dataset_name, metadata)
 
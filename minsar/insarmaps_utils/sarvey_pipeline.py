@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+In-process SARvey shapefile -> JSON chunks -> MBTiles conversion for Insarmaps.
+
+Alternative to the chain ogr2ogr (SHP -> CSV), correct_geolocation.py (CSV -> CSV) and
+hdfeos5_or_csv_2json_mbtiles.py (CSV -> JSON -> MBTiles): the point layer is read in record
+batches, coordinates are transformed to WGS84 and corrected for the DEM error in the stream, and
+every batch is written as one JSON chunk while its features are piped to tippecanoe. No
+intermediate CSV is written and no file is read twice.
+The JSON chunks and metadata.pickle follow the layout of hdfeos5_2json_mbtiles.py, so the
+result is uploaded with json_mbtiles2insarmaps.py as before.
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+import pickle
+import argparse
+import subprocess
+import numpy as np
+from pathlib import Path
+from mintpy.utils import ptime
+from minsar.insarmaps_utils.correct_geolocation import correct_coordinates
+
+# points per batch and per JSON chunk (CHUNK_SIZE of hdfeos5_2json_mbtiles.py)
+BATCH_SIZE = 20000
+# SARvey exports displacements in mm, Insarmaps expects m
+DISPLACEMENT_SCALE = 0.001
+TIPPECANOE_CMD = ["tippecanoe", "-l", "chunk_1", "-x", "d", "-pf", "-pk", "--force"]
+
+EXAMPLE = """\
+Examples:
+  sarvey_pipeline.py outputs/shp/p2_coh70_ts.shp outputs/JSON
+  sarvey_pipeline.py outputs/shp/p2_coh70_ts.shp outputs/JSON --geocorr --batch-size 50000
+  sarvey_pipeline.py outputs/shp/small_ts.shp JSON_new --compare-legacy outputs/JSON
+"""
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description="Convert a SARvey point shapefile to Insarmaps JSON chunks and MBTiles",
+        epilog=EXAMPLE,
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("shp_file", help="SARvey point shapefile")
+    parser.add_argument("json_dir", help="output directory for JSON chunks and MBTiles")
+    parser.add_argument("--geocorr", dest="do_geocorr", action="store_true",
+                        help="correct the point locations for the DEM error")
+    parser.add_argument("--dataset-name", help="dataset name (default: shapefile name)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help=f"points per batch and JSON chunk (default: {BATCH_SIZE})")
+    parser.add_argument("--compare-legacy", dest="legacy_dir", metavar="DIR",
+                        help="compare the output with the JSON directory written by sarvey2insarmaps.py (separate steps)\n"
+                             "for the same shapefile (exit status 1 if they differ)")
+    return parser
+
+
+def get_date_columns(fields):
+    """
+    Time-series fields of the point layer (D20160101 or 20160101), in date order.
+    """
+    date_fields = [name for name in fields if re.match(r"^D?\d{8}$", name)]
+    return sorted(date_fields, key=lambda name: name[-8:])
+
+
+def read_point_batches(shp_file, batch_size=BATCH_SIZE):
+    """
+    Read a point layer in record batches.
+    Yields dicts of column arrays, with X and Y (lon, lat) in WGS84 as written by ogr2ogr -t_srs EPSG:4326.
+    """
+    from osgeo import ogr, osr
+
+    ds = ogr.Open(str(shp_file))
+    if ds is None:
+        raise FileNotFoundError(f"Cannot open point layer: {shp_file}")
+    layer = ds.GetLayer()
+    defn = layer.GetLayerDefn()
+    fields = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+
+    transform = None
+    src_srs = layer.GetSpatialRef()
+    if src_srs is not None:
+        dst_srs = osr.SpatialReference()
+        dst_srs.ImportFromEPSG(4326)
+        for srs in [src_srs, dst_srs]:
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if not src_srs.IsSame(dst_srs):
+            transform = osr.CoordinateTransformation(src_srs, dst_srs)
+
+    xy, records = [], []
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        xy.append((geom.GetX(), geom.GetY()))
+        records.append([feature.GetField(i) for i in range(len(fields))])
+        if len(records) == batch_size:
+            yield make_batch(fields, xy, records, transform)
+            xy, records = [], []
+    if records:
+        yield make_batch(fields, xy, records, transform)
+    ds = None
+
+
+def make_batch(fields, xy, records, transform):
+    """
+    Column arrays of a record batch.
+    """
+    if transform is not None:
+        xy = transform.TransformPoints(xy)
+    xy = np.array(xy, dtype=np.float64)
+    batch = {name: to_array(column) for name, column in zip(fields, zip(*records))}
+    batch["X"], batch["Y"] = xy[:, 0], xy[:, 1]
+    return batch
+
+
+def to_array(column):
+    """
+    Array of a field column; OGR returns None for null fields, which become NaN (not an object array).
+    """
+    if any(value is None for value in column):
+        column = [np.nan if value is None else value for value in column]
+    return np.array(column)
+
+
+def get_slopes(displacements, decimal_dates):
+    """
+    Slope of the linear fit of each point time-series (the "m" property of Insarmaps points).
+    """
+    A = np.column_stack([decimal_dates, np.ones(len(decimal_dates))])
+    return np.linalg.lstsq(A, displacements.T, rcond=None)[0][0]
+
+
+def batch_to_features(batch, date_fields, decimal_dates, first_point, do_geocorr=False):
+    """
+    Serialized GeoJSON features of a batch; returns the feature strings and the batch bounds.
+    """
+    lon, lat = batch["X"], batch["Y"]
+    if do_geocorr:
+        lon, lat = correct_coordinates(lon, lat, batch["dem_error"].astype(np.float64))
+
+    displacements = np.column_stack([batch[name] for name in date_fields]).astype(np.float64) * DISPLACEMENT_SCALE
+    valid = np.all(np.isfinite(displacements), axis=1) * np.isfinite(lon) * np.isfinite(lat)
+    lon, lat, displacements = lon[valid], lat[valid], displacements[valid]
+    slopes = get_slopes(displacements, decimal_dates) if len(displacements) else []
+
+    features = []
+    for i in range(len(displacements)):
+        features.append(json.dumps({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [float(lon[i]), float(lat[i])]},
+            "properties": {"d": displacements[i].tolist(), "m": float(slopes[i]), "p": first_point + i}
+        }))
+    bounds = [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())] if len(features) else None
+    return features, bounds
+
+
+def write_json_chunk(json_dir, chunk_num, features, date_strings):
+    """
+    Write one FeatureCollection chunk_<num>.json as hdfeos5_2json_mbtiles.py does.
+    """
+    chunk = f"chunk_{chunk_num}.json"
+    with open(os.path.join(json_dir, chunk), "w") as f:
+        f.write('{"type": "FeatureCollection", "dates": ' + json.dumps(date_strings) +
+                ', "features": [' + ", ".join(features) + "]}")
+    return chunk
+
+
+def write_metadata(json_dir, dataset_name, metadata, date_strings, decimal_dates, bbox):
+    """
+    metadata.pickle read by json_mbtiles2insarmaps.py (and by sarvey2insarmaps.py afterwards).
+    """
+    west, south, east, north = bbox
+    attributes = dict(metadata)
+    attributes["first_date"] = date_strings[0]
+    attributes["last_date"] = date_strings[-1]
+    attributes["data_footprint"] = (f"POLYGON(({west} {north},{east} {north},{east} {south},"
+                                    f"{west} {south},{west} {north}))")
+    attributes.setdefault("REF_LAT", (south + north) / 2)
+    attributes.setdefault("REF_LON", (west + east) / 2)
+
+    meta = {
+        "area": dataset_name,
+        "project_name": dataset_name,
+        "mission": attributes.get("mission") or attributes.get("PLATFORM"),
+        "decimal_dates": decimal_dates,
+        "attributes": attributes,
+        "string_dates": date_strings,
+        "needed_attributes": sorted(attributes.keys()),
+    }
+    with open(os.path.join(json_dir, "metadata.pickle"), "wb") as f:
+        pickle.dump(meta, f)
+
+
+def print_throughput(stats, num_points):
+    """
+    Per-stage time and throughput of the pipeline.
+    """
+    print(f"\n{'stage':<13} {'seconds':>9} {'points/s':>12}")
+    for stage, seconds in stats.items():
+        rate = num_points / seconds if seconds > 0 else float("inf")
+        print(f"{stage:<13} {seconds:>9.2f} {rate:>12.0f}")
+    print(f"{'total':<13} {sum(stats.values()):>9.2f} {num_points / max(sum(stats.values()), 1e-6):>12.0f}")
+
+
+def run_pipeline(shp_file, json_dir, mbtiles_path, dataset_name, metadata=None, do_geocorr=False,
+                 batch_size=BATCH_SIZE):
+    """
+    Stream a SARvey shapefile into JSON chunks, metadata.pickle and MBTiles.
+    Returns the number of points.
+    """
+    json_dir = Path(json_dir)
+    json_dir.mkdir(parents=True, exist_ok=True)
+    for fname in glob.glob(str(json_dir / "chunk_*.json")):
+        os.remove(fname)
+
+    stats = {"read": 0.0, "geocorr+json": 0.0, "write": 0.0, "mbtiles": 0.0}
+    tippecanoe = subprocess.Popen(TIPPECANOE_CMD + ["-o", str(mbtiles_path)], stdin=subprocess.PIPE)
+
+    date_fields = date_strings = decimal_dates = None
+    bbox = None
+    num_points = 0
+    chunk_num = 0
+    try:
+        batches = read_point_batches(shp_file, batch_size=batch_size)
+        while True:
+            time0 = time.time()
+            batch = next(batches, None)
+            stats["read"] += time.time() - time0
+            if batch is None:
+                break
+
+            if date_fields is None:
+                date_fields = get_date_columns(batch.keys())
+                if not date_fields:
+                    raise ValueError(f"No time-series (DYYYYMMDD) fields found in {shp_file}")
+                if do_geocorr and "dem_error" not in batch:
+                    raise ValueError("Missing required field for --geocorr: 'dem_error'")
+                date_strings = [name[-8:] for name in date_fields]
+                decimal_dates = ptime.yyyymmdd2years(date_strings)
+
+            time0 = time.time()
+            features, bounds = batch_to_features(batch, date_fields, decimal_dates, num_points, do_geocorr)
+            stats["geocorr+json"] += time.time() - time0
+            if not features:
+                continue
+
+            time0 = time.time()
+            chunk_num += 1
+            write_json_chunk(json_dir, chunk_num, features, date_strings)
+            stats["write"] += time.time() - time0
+
+            time0 = time.time()
+            tippecanoe.stdin.write(("\n".join(features) + "\n").encode())
+            stats["mbtiles"] += time.time() - time0
+
+            num_points += len(features)
+            bbox = bounds if bbox is None else [min(bbox[0], bounds[0]), min(bbox[1], bounds[1]),
+                                                max(bbox[2], bounds[2]), max(bbox[3], bounds[3])]
+            print(f"[INFO] converted chunk {chunk_num}: {num_points} points")
+    finally:
+        time0 = time.time()
+        tippecanoe.stdin.close()
+        return_code = tippecanoe.wait()
+        stats["mbtiles"] += time.time() - time0
+
+    if return_code != 0:
+        raise RuntimeError(f"tippecanoe failed with return code {return_code}")
+    if num_points == 0:
+        raise ValueError(f"No valid points in {shp_file}")
+
+    write_metadata(json_dir, dataset_name, metadata or {}, date_strings, decimal_dates, bbox)
+    print(f"[INFO] {num_points} points in {chunk_num} JSON chunks, MBTiles: {mbtiles_path}")
+    print_throughput(stats, num_points)
+    return num_points
+
+
+def read_json_points(json_dir):
+    """
+    Coordinates, properties and dates of all points of the chunk_*.json files of a directory, sorted by "p".
+    """
+    files = sorted(glob.glob(os.path.join(json_dir, "chunk_*.json")),
+                   key=lambda fname: int(re.findall(r"chunk_(\d+)\.json", fname)[0]))
+    if not files:
+        raise FileNotFoundError(f"No chunk_*.json files in {json_dir}")
+    coords, d, m, p, keys, dates = [], [], [], [], set(), None
+    for fname in files:
+        with open(fname) as f:
+            chunk = json.load(f)
+        dates = dates or chunk.get("dates")
+        for feature in chunk["features"]:
+            properties = feature["properties"]
+            keys.add(tuple(sorted(properties.keys())))
+            coords.append(feature["geometry"]["coordinates"])
+            d.append(properties["d"])
+            m.append(properties["m"])
+            p.append(properties["p"])
+    order = np.argsort(p, kind="stable")
+    return {"coords": np.array(coords, dtype=np.float64)[order], "d": np.array(d, dtype=np.float64)[order],
+            "m": np.array(m, dtype=np.float64)[order], "p": np.array(p)[order], "keys": keys, "dates": dates}
+
+
+def compare_with_legacy(json_dir, legacy_dir, rtol=1e-5, atol=1e-6):
+    """
+    Compare the JSON chunks and metadata.pickle of json_dir with those written by the legacy pipeline
+    (sarvey2insarmaps.py without --streaming-pipeline) for the same shapefile.
+    Checks the point ids "p", the coordinates, the displacements "d" (DISPLACEMENT_SCALE), the
+    velocities "m" and the dates and attributes of metadata.pickle. Returns the list of differences.
+    """
+    new, old = read_json_points(json_dir), read_json_points(legacy_dir)
+    errors = []
+    if new["keys"] != old["keys"]:
+        errors.append(f"feature properties differ: {sorted(new['keys'])} vs legacy {sorted(old['keys'])}")
+    if new["dates"] != old["dates"]:
+        errors.append("chunk dates differ")
+    if len(new["p"]) != len(old["p"]):
+        errors.append(f"number of points differs: {len(new['p'])} vs legacy {len(old['p'])}")
+    else:
+        if not np.array_equal(new["p"], old["p"]):
+            errors.append(f"point ids p differ at {np.sum(new['p'] != old['p'])} points")
+        if not np.allclose(new["coords"], old["coords"], rtol=0, atol=atol):
+            errors.append(f"coordinates differ by up to {np.max(np.abs(new['coords'] - old['coords'])):.3g} deg")
+        if new["d"].shape != old["d"].shape:
+            errors.append(f"displacements d have {new['d'].shape[1]} vs legacy {old['d'].shape[1]} dates")
+        else:
+            differ = ~np.isclose(new["d"], old["d"], rtol=rtol, atol=atol, equal_nan=True)
+            if np.any(differ):
+                # a ratio of 1000 or 0.001 means the mm -> m conversion (DISPLACEMENT_SCALE) does not match
+                ratio = np.nanmedian(np.abs(new["d"][differ]) / np.abs(old["d"][differ]))
+                errors.append(f"displacements d differ at {np.sum(np.any(differ, axis=1))} points (median ratio "
+                              f"to legacy: {ratio:.4g}, DISPLACEMENT_SCALE = {DISPLACEMENT_SCALE})")
+        if not np.allclose(new["m"], old["m"], rtol=rtol, atol=atol, equal_nan=True):
+            errors.append(f"velocities m differ by up to {np.nanmax(np.abs(new['m'] - old['m'])):.3g}")
+
+    with open(os.path.join(json_dir, "metadata.pickle"), "rb") as f:
+        new_meta = pickle.load(f)
+    with open(os.path.join(legacy_dir, "metadata.pickle"), "rb") as f:
+        old_meta = pickle.load(f)
+    if list(new_meta["string_dates"]) != list(old_meta["string_dates"]):
+        errors.append("metadata string_dates differ")
+    if not np.allclose(new_meta["decimal_dates"], old_meta["decimal_dates"]):
+        errors.append("metadata decimal_dates differ")
+    for key in sorted(set(old_meta["attributes"]) - set(new_meta["attributes"])):
+        errors.append(f"metadata attribute {key} missing")
+    for key in ["first_date", "last_date", "REF_LAT", "REF_LON"]:
+        if key in old_meta["attributes"] and str(new_meta["attributes"].get(key)) != str(old_meta["attributes"][key]):
+            errors.append(f"metadata attribute {key} differs: {new_meta['attributes'].get(key)} "
+                          f"vs legacy {old_meta['attributes'][key]}")
+
+    for error in errors:
+        print(f"[DIFF] {error}")
+    print(f"[INFO] compared {len(new['p'])} points with {legacy_dir}: "
+          f"{len(errors)} difference{'s' if len(errors) != 1 else ''}")
+    return errors
+
+
+def main(iargs=None):
+    inps = create_parser().parse_args(args=iargs)
+    dataset_name = inps.dataset_name or Path(inps.shp_file).stem
+    suffix = "_geocorr" if inps.do_geocorr else ""
+    mbtiles_path = Path(inps.json_dir) / f"{dataset_name}{suffix}.mbtiles"
+    run_pipeline(inps.shp_file, inps.json_dir, mbtiles_path, dataset_name, do_geocorr=inps.do_geocorr,
+                 batch_size=inps.batch_size)
+    if inps.legacy_dir and compare_with_legacy(inps.json_dir, inps.legacy_dir):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -37,6 +37,7 @@ from minsar.objects import message_rsmas
 from minsar.objects.auto_defaults import queue_config_file, supported_platforms
 import warnings
 import minsar.utils.process_utilities as putils
+import minsar.utils.phase_linking_cost as plcost
 from datetime import datetime
 import re
 
@@ -239,6 +240,9 @@ class JOB_SUBMIT:
                 tasks = f.readlines()
                 number_of_tasks = len(tasks)
 
+            if 'concatenate_patches' in os.path.basename(batch_file):
+                tasks = self.add_parallel_concatenation(tasks)
+
             number_of_nodes = int(np.ceil(number_of_tasks * float(self.default_num_threads) / (
                     self.number_of_cores_per_node * self.number_of_threads_per_core)))
 
@@ -522,21 +526,26 @@ class JOB_SUBMIT:
         end_lines = [x + number_of_parallel_tasks for x in start_lines]
         end_lines[-1] = len(tasks)
 
+        job_tasks_list = [tasks[start_line:end_line] for start_line, end_line in zip(start_lines, end_lines)]
+        if 'phase_linking' in os.path.basename(batch_file):
+            job_tasks_list = self.balance_phase_linking_tasks(batch_file, tasks, len(job_tasks_list),
+                                                              max_tasks_per_job=number_of_parallel_tasks) \
+                             or job_tasks_list
+
         if not num_cores_per_task is None:
             self.number_of_parallel_tasks_per_node = self.number_of_cores_per_node // num_cores_per_task
         else:
-            self.number_of_parallel_tasks_per_node = math.ceil(number_of_parallel_tasks / number_of_nodes_per_job)
+            max_tasks_per_job = max(len(job_tasks) for job_tasks in job_tasks_list)
+            self.number_of_parallel_tasks_per_node = math.ceil(max_tasks_per_job / number_of_nodes_per_job)
 
-
-        for start_line, end_line in zip(start_lines, end_lines):
-            job_count = start_lines.index(start_line)
+        for job_count, job_tasks in enumerate(job_tasks_list):
             batch_file_name = batch_file + '_{}'.format(job_count)
             job_name = os.path.basename(batch_file_name)
 
-            job_file_lines = self.get_job_file_lines(job_name, batch_file_name, number_of_tasks=end_line-start_line,
+            job_file_lines = self.get_job_file_lines(job_name, batch_file_name, number_of_tasks=len(job_tasks),
                                                      number_of_nodes=number_of_nodes_per_job, work_dir=self.out_dir)
 
-            job_file_name = self.add_tasks_to_job_file_lines(job_file_lines, tasks[start_line:end_line],
+            job_file_name = self.add_tasks_to_job_file_lines(job_file_lines, job_tasks,
                                                              batch_file=batch_file_name,
                                                              number_of_nodes=number_of_nodes_per_job,
                                                              distribute=distribute)
@@ -545,6 +554,50 @@ class JOB_SUBMIT:
 
         return
 
+    def add_parallel_concatenation(self, tasks):
+        """
+        runs concatenate_patches_parallel.py before each miaplpy concatenate_patches task
+        (miaplpyApp.py TEMPLATE --dostep concatenate_patches --dir DIR); MiaplPy then finds the concatenated
+        inverted/phase_series.h5. Tasks without --dir are not changed.
+        :param tasks: task lines of the run file
+        :return: task lines
+        """
+        new_tasks = []
+        for task in tasks:
+            args = task.split()
+            app_index = [i for i, arg in enumerate(args) if os.path.basename(arg) == 'miaplpyApp.py']
+            if app_index and '--dir' in args[:-1] and app_index[0] + 1 < len(args):
+                template_file = args[app_index[0] + 1]
+                miaplpy_dir = args[args.index('--dir') + 1]
+                task = 'concatenate_patches_parallel.py --dir {} --template {} && {}\n'.format(
+                       miaplpy_dir, template_file, task.strip())
+            new_tasks.append(task)
+        return new_tasks
+
+    def balance_phase_linking_tasks(self, batch_file, tasks, number_of_jobs, max_tasks_per_job=None):
+        """
+        distributes miaplpy phase linking tasks among jobs by their predicted run time and adds timing of each task
+        (patch costs from phase_linking_cost.py). The cost file is created from the task options if it does
+        not exist. Returns None if it cannot be created.
+        :param batch_file: phase linking run file
+        :param tasks: task lines of the run file
+        :param number_of_jobs: number of jobs
+        :param max_tasks_per_job: maximum number of tasks of a job (limited by the node memory)
+        :return: list of task lines for each job
+        """
+        cost_file = plcost.find_cost_file(batch_file) or plcost.create_cost_file(tasks)
+        if cost_file is None:
+            return None
+
+        task_seconds = plcost.get_task_seconds(tasks, cost_file)
+        jobs, job_seconds = plcost.balance_tasks(task_seconds, number_of_jobs, max_tasks_per_job=max_tasks_per_job)
+        print('Distributing phase linking tasks by predicted time ({}): job time {:.0f} - {:.0f} s'.format(
+              cost_file, min(job_seconds), max(job_seconds)))
+
+        timings_file = os.path.join(os.path.dirname(os.path.abspath(batch_file)), plcost.TIMINGS_FILE)
+        return [[plcost.add_timing_to_task(tasks[i], plcost.get_task_index(tasks[i], i), timings_file) for i in job]
+                for job in jobs]
+
     def get_memory_walltime(self, job_name, job_type='batch'):
         """
         get memory, walltime and number of threads for the job from job_defaults.cfg
@@ -4,12 +4,16 @@ import glob
 import sys
 import os
 import shutil
+import resource
 import h5py
 import numpy as np  
 from pathlib import Path
-from mintpy.utils import readfile, writefile
+from mintpy.utils import readfile, writefile, attribute
 from mintpy.objects import HDFEOS
 
+# memory of one block (all dates of a group of rows) copied from the HDF-EOS5 file
+MAX_BLOCK_MB = 128
+
 def find_attribute(obj, key):
     """
     Recursively search for an attribute 'key' in the HDF5 object 'obj'.
@@ -42,51 +46,158 @@ def determine_coordinates(file_path):
     print("Detected coordinates: RADAR")
     return 'RADAR'
 
-def extract_mask(file_path, coords):
-    data, attr = readfile.read(file_path, datasetName='HDFEOS/GRIDS/timeseries/quality/mask')
+def get_row_blocks(row_start, row_end, row_bytes, chunk_rows=(), max_mb=MAX_BLOCK_MB):
+    """
+    Row windows (row0, row1) between row_start and row_end of at most max_mb. Window edges are
+    multiples of the chunk rows of the source and output datasets (or of the largest one if
+    their common multiple is too large).
+    """
+    chunk_rows = [int(c) for c in chunk_rows if c]
+    step = int(np.lcm.reduce(chunk_rows)) if chunk_rows else 1
+    max_rows = max(1, int(max_mb * 1024**2 // max(row_bytes, 1)))
+    if step > max_rows:
+        step = max(chunk_rows) if chunk_rows and max(chunk_rows) <= max_rows else 1
+    num_rows = max(1, max_rows // step) * step
+    edges = [row_start] + list(range((row_start // num_rows + 1) * num_rows, row_end, num_rows)) + [row_end]
+    return list(zip(edges[:-1], edges[1:]))
+
+def read_block(dset, rows, cols, index=None):
+    """
+    Read dset[..., rows, cols]; for 3D datasets index (optional) selects/reorders the first dimension.
+    Only the chunks intersecting the block are read.
+    """
+    if index is None or dset.ndim != 3:
+        return dset[..., rows, cols]
+    read_index = np.unique(index)
+    if read_index[-1] - read_index[0] + 1 == read_index.size:
+        data = dset[read_index[0]:read_index[-1]+1, rows, cols]
+    else:
+        data = dset[read_index.tolist(), rows, cols]
+    return data[np.searchsorted(read_index, index)]
+
+def copy_datasets_in_blocks(file_path, dset_dict, out_file, index=None, box=None, max_mb=MAX_BLOCK_MB):
+    """
+    Copy datasets of file_path into the (already laid out) out_file block by block.
+    dset_dict maps output dataset names to dataset paths in file_path. For 3D datasets,
+    index (optional) selects and orders the first dimension, e.g. to sort/subset the dates.
+    box (x0, y0, x1, y1, optional) is the spatial subset of the source.
+    """
+    with h5py.File(file_path, 'r') as fi, h5py.File(out_file, 'a') as fo:
+        for out_name, dset_path in dset_dict.items():
+            dsi, dso = fi[dset_path], fo[out_name]
+            x0, y0, x1, y1 = box if box else (0, 0, dsi.shape[-1], dsi.shape[-2])
+            num_layer = len(index) if index is not None and dsi.ndim == 3 else int(np.prod(dsi.shape[:-2]))
+            row_bytes = num_layer * (x1 - x0) * dsi.dtype.itemsize
+            chunk_rows = [c[-2] for c in [dsi.chunks, dso.chunks] if c]
+            for row0, row1 in get_row_blocks(y0, y1, row_bytes, chunk_rows, max_mb=max_mb):
+                dso[..., row0-y0:row1-y0, :] = read_block(dsi, slice(row0, row1), slice(x0, x1), index)
+    return out_file
+
+def get_subset_box(file_path, lalo, coords):
+    """
+    Subset box (x0, y0, x1, y1) of the lat/lon bounding box lalo = 'S:N,W:E' (as mintpy.subset.lalo).
+    GEO: from the Y/X_FIRST, Y/X_STEP grid attributes; RADAR: from the latitude/longitude datasets.
+    """
+    S, N = sorted(float(i) for i in lalo.split(',')[0].split(':'))
+    W, E = sorted(float(i) for i in lalo.split(',')[1].split(':'))
+    attr = readfile.read_attribute(file_path)
+    length, width = int(attr['LENGTH']), int(attr['WIDTH'])
+
+    if coords == "GEO":
+        y_first, y_step = float(attr['Y_FIRST']), float(attr['Y_STEP'])
+        x_first, x_step = float(attr['X_FIRST']), float(attr['X_STEP'])
+        # rounding avoids an extra row/column from floating point errors of the grid attributes
+        rows = sorted([round((N - y_first) / y_step, 6), round((S - y_first) / y_step, 6)])
+        cols = sorted([round((W - x_first) / x_step, 6), round((E - x_first) / x_step, 6)])
+        y0, y1 = int(np.floor(rows[0])), int(np.ceil(rows[1]))
+        x0, x1 = int(np.floor(cols[0])), int(np.ceil(cols[1]))
+    else:
+        geom_path = 'HDFEOS/GRIDS/timeseries/geometry'
+        y0, y1, x0, x1 = length, 0, width, 0
+        with h5py.File(file_path, 'r') as f:
+            lat, lon = f[f'{geom_path}/latitude'], f[f'{geom_path}/longitude']
+            for row0, row1 in get_row_blocks(0, length, 2 * width * lat.dtype.itemsize, [lat.chunks[0]]):
+                lat_block, lon_block = lat[row0:row1, :], lon[row0:row1, :]
+                inside = (lat_block >= S) & (lat_block <= N) & (lon_block >= W) & (lon_block <= E)
+                if np.any(inside):
+                    rows, cols = np.where(np.any(inside, axis=1))[0], np.where(np.any(inside, axis=0))[0]
+                    y0, y1 = min(y0, row0 + rows[0]), max(y1, row0 + rows[-1] + 1)
+                    x0, x1 = min(x0, cols[0]), max(x1, cols[-1] + 1)
+
+    y0, y1 = max(y0, 0), min(y1, length)
+    x0, x1 = max(x0, 0), min(x1, width)
+    if y1 <= y0 or x1 <= x0:
+        print(f"Error: --lalo {lalo} does not overlap with {file_path}.", file=sys.stderr)
+        sys.exit(1)
+    box = (int(x0), int(y0), int(x1), int(y1))
+    print(f"Subset lalo {lalo} -> box (x0, y0, x1, y1) = {box} of {width} x {length}")
+    return box
+
+def extract_datasets(file_path, dset_dict, out_file, attr, box=None):
+    """
+    Lay out out_file (MintPy format, as writefile.write) and stream the datasets of dset_dict into it.
+    """
+    ds_name_dict = {}
+    with h5py.File(file_path, 'r') as f:
+        for out_name, dset_path in dset_dict.items():
+            shape = f[dset_path].shape
+            if box:
+                shape = shape[:-2] + (box[3] - box[1], box[2] - box[0])
+            ds_name_dict[out_name] = [f[dset_path].dtype, shape, None]
+    if box:
+        attr = attribute.update_attribute4subset(attr, box, print_msg=False)
+    writefile.layout_hdf5(out_file, ds_name_dict, metadata=attr)
+    copy_datasets_in_blocks(file_path, dset_dict, out_file, box=box)
+    return out_file
+
+def extract_mask(file_path, coords, box=None):
+    dset_path = 'HDFEOS/GRIDS/timeseries/quality/mask'
+    attr = readfile.read_attribute(file_path, datasetName=dset_path)
     attr['FILE_TYPE'] = 'mask'
     out_file = "geo_mask.h5" if coords=="GEO" else "mask.h5"
-    writefile.write(data, out_file=out_file, metadata=attr)
+    extract_datasets(file_path, {'mask': dset_path}, out_file, attr, box=box)
     print(f"Extracted mask -> {out_file}")
 
     return out_file
 
-def extract_avgSpatialCoherence(file_path, coords):
-    data, attr = readfile.read(file_path, datasetName='HDFEOS/GRIDS/timeseries/quality/avgSpatialCoherence')
+def extract_avgSpatialCoherence(file_path, coords, box=None):
+    dset_path = 'HDFEOS/GRIDS/timeseries/quality/avgSpatialCoherence'
+    attr = readfile.read_attribute(file_path, datasetName=dset_path)
     attr['FILE_TYPE'] = 'avgSpatialCoherence'
     out_file = "geo_avgSpatialCoherence.h5" if coords=="GEO" else "avgSpatialCoherence.h5"
-    writefile.write(data, out_file=out_file, metadata=attr)
+    extract_datasets(file_path, {'avgSpatialCoherence': dset_path}, out_file, attr, box=box)
     print(f"Extracted avgSpatialCoherence -> {out_file}")
 
     return out_file
 
-def extract_temporalCoherence(file_path, coords):
-    data, attr = readfile.read(file_path, datasetName='HDFEOS/GRIDS/timeseries/quality/temporalCoherence')
+def extract_temporalCoherence(file_path, coords, box=None):
+    dset_path = 'HDFEOS/GRIDS/timeseries/quality/temporalCoherence'
+    attr = readfile.read_attribute(file_path, datasetName=dset_path)
     attr['FILE_TYPE'] = 'temporalCoherence'
     out_file = "geo_temporalCoherence.h5" if coords=="GEO" else "temporalCoherence.h5"
-    writefile.write(data, out_file=out_file, metadata=attr)
+    extract_datasets(file_path, {'temporalCoherence': dset_path}, out_file, attr, box=box)
     print(f"Extracted temporalCoherence -> {out_file}")
 
     return out_file
 
-def extract_geometry(file_path, coords):
+def extract_geometry(file_path, coords, box=None):
     group_path = 'HDFEOS/GRIDS/timeseries/geometry'
     slices = ['azimuthAngle', 'height', 'incidenceAngle', 'latitude', 'longitude', 'shadowMask', 'slantRangeDistance']
-    geo_data = {}
+    dset_dict = {}
     geo_attr = {}
-    for s in slices:
-        dset_path = f"{group_path}/{s}"
-        try:
-            data, attr = readfile.read(file_path, datasetName=dset_path)
-            geo_data[s] = data
-            if not geo_attr:
-                geo_attr = attr
-        except Exception as e:
-            print(f"Warning: Could not extract slice '{s}' from {dset_path}: {e}", file=sys.stderr)
+    with h5py.File(file_path, 'r') as f:
+        for s in slices:
+            dset_path = f"{group_path}/{s}"
+            if dset_path in f:
+                dset_dict[s] = dset_path
+            else:
+                print(f"Warning: Could not extract slice '{s}' from {dset_path}: dataset not found", file=sys.stderr)
+    if dset_dict:
+        geo_attr = readfile.read_attribute(file_path, datasetName=list(dset_dict.values())[0])
     geo_attr['FILE_TYPE'] = 'geometry'
     geo_attr['COORDINATES'] = coords
     out_file = "geo_geometryRadar.h5" if coords=="GEO" else "geometryRadar.h5"
-    writefile.write(geo_data, out_file=out_file, metadata=geo_attr)
+    extract_datasets(file_path, dset_dict, out_file, geo_attr, box=box)
     print(f"Extracted geometry -> {out_file}")
 
     return out_file
@@ -96,52 +207,66 @@ def extract_geometry(file_path, coords):
         shutil.copy('geometryRadar.h5', 'inputs')
         print("Copied geometryRadar.h5 into inputs")
 
-def extract_timeseries(file_path, coords):
+def extract_timeseries(file_path, coords, box=None, start_date=None, end_date=None):
     """
     Extract all displacement datasets from HDFEOS/GRIDS/timeseries/observation.
     Uses HDFEOS from mintpy.objects to obtain the date list.
-    Each displacement dataset (named as displacement-YYYYMMDD) is read with readfile.read,
-    then renamed to timeseries-YYYYMMDD. The sorted date list is forced into the metadata,
-    ensuring that the 'date' dataset exists.
+    The displacement cube is copied into the timeseries dataset in blocks of rows (all dates,
+    at most MAX_BLOCK_MB), so the memory does not grow with the size of the file. The dates
+    are sorted and written into the 'date' dataset.
+    box (x0, y0, x1, y1) and start_date/end_date (YYYYMMDD, inclusive) restrict the extraction
+    to a spatial and temporal subset; only the intersecting chunks are read. START_DATE and END_DATE
+    are those of the extracted dates.
     """
+    obs_path = 'HDFEOS/GRIDS/timeseries/observation'
     h = HDFEOS(file_path)
     date_list = h.get_date_list()
     if not date_list:
         print("Error: No displacement datasets found.", file=sys.stderr)
         sys.exit(1)
-    date_list = sorted(date_list)
-
-    dataset_name_list = []
-    for date_str in date_list:
-        dataset_name_list.append(f'HDFEOS/GRIDS/timeseries/observation/displacement-{date_str}')
+    # index of the sorted dates in the displacement cube
+    order = np.argsort(np.array(date_list), kind='stable')
+    order = [i for i in order if (not start_date or date_list[i] >= start_date)
+                             and (not end_date or date_list[i] <= end_date)]
+    if not order:
+        print(f"Error: No displacement datasets between {start_date} and {end_date}.", file=sys.stderr)
+        sys.exit(1)
+    order = np.array(order)
+    date_list = [date_list[i] for i in order]
 
-    data, attr  = readfile.read(file_path, datasetName=dataset_name_list)
+    attr = readfile.read_attribute(file_path, datasetName=f'{obs_path}/displacement')
 
     with h5py.File(file_path, 'r') as f:
         original_file_path = f.attrs.get('FILE_PATH')
         basename = Path(original_file_path).name
+        num_date_all, length, width = f[f'{obs_path}/displacement'].shape
+        bperp = f[f'{obs_path}/bperp'][()]
+    num_date = len(date_list)
+    if box:
+        attr = attribute.update_attribute4subset(attr, box, print_msg=False)
+        length, width = box[3] - box[1], box[2] - box[0]
 
     attr['FILE_TYPE'] = 'timeseries'
+    attr['START_DATE'] = date_list[0]
+    attr['END_DATE'] = date_list[-1]
+    ref_date = attr.get('REF_DATE')
+    if ref_date and not date_list[0] <= ref_date <= date_list[-1]:
+        print(f"Warning: reference date {ref_date} is outside of the extracted dates {date_list[0]} - {date_list[-1]}.",
+              file=sys.stderr)
     out_file = f"geo_{basename}" if coords=="GEO" else basename
 
     dates = np.array(date_list, dtype='S8')
 
-    num_date, length, width = data.shape
-
-    with h5py.File(file_path, 'r') as f:
-        bperp = f["HDFEOS/GRIDS/timeseries/observation/bperp"][()]
-
-    pbase = bperp 
+    pbase = bperp[order]
     ds_name_dict = {
         "date"       : [dates.dtype, (num_date,), dates],
         "bperp"      : [np.float32,  (num_date,), pbase],
         "timeseries" : [np.float32,  (num_date, length, width), None],
         }
 
-    box = [0, 0, data.shape[2], data.shape[1]]
-    block = [0, num_date, box[1], box[3], box[0], box[2]]
     writefile.layout_hdf5(out_file, ds_name_dict, metadata=attr)
-    writefile.write_hdf5_block(out_file, data=data, datasetName= 'timeseries', block=block)
+    index = None if num_date == num_date_all and np.all(order == np.arange(num_date)) else order
+    copy_datasets_in_blocks(file_path, {'timeseries': f'{obs_path}/displacement'}, out_file, index=index, box=box)
     print(f"Extracted timeseries (displacement) -> {out_file}")
 
     return out_file
@@ -155,7 +280,17 @@ def main():
     parser.add_argument("infile", help="Input S1* HDFEOS file.")
     parser.add_argument("--all", action="store_true",
                         help="Extract all slices including the displacement (timeseries) datasets.")
+    parser.add_argument("--lalo", dest="lalo", default=None, metavar="S:N,W:E",
+                        help="Extract the lat/lon bounding box only (as mintpy.subset.lalo, e.g. 19.3:19.5,-155.4:-155.1).")
+    parser.add_argument("--start-date", dest="start_date", default=None, metavar="YYYYMMDD",
+                        help="Extract displacement from this date on (inclusive).")
+    parser.add_argument("--end-date", dest="end_date", default=None, metavar="YYYYMMDD",
+                        help="Extract displacement up to this date (inclusive).")
+    parser.add_argument("--print-memory", dest="print_memory", action="store_true",
+                        help="Print the peak memory (max RSS) at the end.")
     args = parser.parse_args()
+    if (args.start_date or args.end_date) and not args.all:
+        parser.error("--start-date and --end-date require --all")
 
     file_list = glob.glob(args.infile)
     if not file_list:
@@ -164,13 +299,18 @@ def main():
     file_path = file_list[0]
 
     coords = determine_coordinates(file_path)
-    extract_mask(file_path, coords)
-    extract_avgSpatialCoherence(file_path, coords)
-    extract_temporalCoherence(file_path, coords)
-    extract_geometry(file_path, coords)
+    box = get_subset_box(file_path, args.lalo, coords) if args.lalo else None
+    extract_mask(file_path, coords, box=box)
+    extract_avgSpatialCoherence(file_path, coords, box=box)
+    extract_temporalCoherence(file_path, coords, box=box)
+    extract_geometry(file_path, coords, box=box)
 
     if args.all:
-        extract_timeseries(file_path, coords)
+        extract_timeseries(file_path, coords, box=box, start_date=args.start_date, end_date=args.end_date)
+
+    if args.print_memory:
+        # ru_maxrss is in KB on Linux
+        print(f"Peak memory (max RSS): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
 
 if __name__ == "__main__":
     main()
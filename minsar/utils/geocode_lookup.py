@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Geocoding lookup shared by all SLCs of a stack.
+
+gdalwarp -geoloc recomputes the inverse lat/lon transformation for every file it warps, although
+the geometry (geom_reference lat/lon) is the same for the whole stack. Here the nearest radar pixel
+of every output grid cell is computed once with a KD-tree and stored in a lookup file next to the
+lat/lon files. Geocoding an image is then a gather (image.ravel()[index]); the lookup is
+recomputed only when the lat/lon files or the output grid change.
+The output grid is the one of gdalwarp -te W S E N -tr LON_STEP LAT_STEP (nearest neighbour).
+"""
+import os
+import sys
+import time
+import json
+import hashlib
+import argparse
+import multiprocessing as mp
+import h5py
+import numpy as np
+from scipy.spatial import cKDTree
+
+LOOKUP_FILE = 'geocode_lookup.h5'
+BLOCK_ROWS = 256
+
+EXAMPLE = """example:
+  geocode_lookup.py merged/geom_reference/lat.rdr.ml merged/geom_reference/lon.rdr.ml -b "-8.7 -8.2 115.9 116.6" -y 0.0005 -x 0.0005
+  geocode_lookup.py merged/geom_reference/lat.rdr.ml merged/geom_reference/lon.rdr.ml -b "-8.7 -8.2 115.9 116.6" -y 0.0005 -x 0.0005 \\
+                    --benchmark merged/SLC/*/*.slc.ml
+"""
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Compute the radar to geo lookup of a stack and benchmark it against gdalwarp',
+                                     formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+    parser.add_argument('lat_file', help='latitude file in radar coordinates (lat.rdr.ml)')
+    parser.add_argument('lon_file', help='longitude file in radar coordinates (lon.rdr.ml)')
+    parser.add_argument('-b', '--bbox', dest='cropbox', required=True, help='output area "S N W E"')
+    parser.add_argument('-y', '--latStep', dest='lat_step', type=float, required=True,
+                        help='output pixel size in degree in latitude')
+    parser.add_argument('-x', '--lonStep', dest='lon_step', type=float, required=True,
+                        help='output pixel size in degree in longitude')
+    parser.add_argument('--benchmark', dest='benchmark_files', nargs='+', metavar='FILE',
+                        help='radar coded images: time the lookup against one gdalwarp call per image')
+    parser.add_argument('--num-workers', dest='num_workers', type=int, default=min(8, os.cpu_count() or 1),
+                        help='number of images geocoded in parallel (default: %(default)s)')
+    return parser
+
+
+def cmd_line_parse(iargs=None):
+    parser = create_parser()
+    return parser.parse_args(args=iargs)
+
+
+def get_output_grid(cropbox, lat_step, lon_step):
+    """Size and geotransform of the gdalwarp -te W S E N -tr lon_step lat_step grid."""
+    south, north, west, east = [float(val) for val in cropbox.split()] if isinstance(cropbox, str) else cropbox
+    width = int(round((east - west) / lon_step))
+    length = int(round((north - south) / lat_step))
+    transform = (west, lon_step, 0.0, north, 0.0, -lat_step)
+    return length, width, transform
+
+
+def read_raster(fname):
+    """First band of an ISCE/GDAL raster (through its .vrt if there is one)."""
+    from osgeo import gdal
+    ds = gdal.Open(fname + '.vrt' if os.path.isfile(fname + '.vrt') else fname, gdal.GA_ReadOnly)
+    data = ds.GetRasterBand(1).ReadAsArray()
+    ds = None
+    return data
+
+
+def get_fingerprint(lat_file, lon_file, cropbox, lat_step, lon_step):
+    """Identifies the lat/lon files (path, size, time) and the output grid."""
+    items = [get_output_grid(cropbox, lat_step, lon_step)]
+    for fname in [lat_file, lon_file]:
+        stat = os.stat(fname)
+        items.append([os.path.abspath(fname), stat.st_size, int(stat.st_mtime)])
+    return hashlib.md5(json.dumps(items).encode()).hexdigest()
+
+
+def compute_lookup(lat, lon, length, width, transform):
+    """Flat index of the nearest radar pixel of every output grid cell, -1 outside the radar coverage.
+    Distances are measured in output pixels; a cell is covered if its nearest radar pixel is closer
+    than half a radar pixel diagonal plus half an output pixel diagonal.
+    """
+    west, lon_step, _, north, _, lat_step = transform
+    lat_step = abs(lat_step)
+    rows = (north - lat) / lat_step - 0.5
+    cols = (lon - west) / lon_step - 0.5
+    valid = np.isfinite(rows) * np.isfinite(cols) * (lat != 0) * (lon != 0)
+    valid *= (rows > -2) * (rows < length + 1) * (cols > -2) * (cols < width + 1)
+
+    index = np.full((length, width), -1, dtype=np.int32)
+    if not np.any(valid):
+        return index
+
+    # radar pixel spacing in output pixels, for the coverage threshold
+    spacing = [np.nanmedian(np.hypot(np.diff(rows, axis=axis), np.diff(cols, axis=axis))) for axis in [0, 1]]
+    max_distance = 0.5 * (np.hypot(*spacing) + np.sqrt(2))
+
+    source_index = np.flatnonzero(valid)
+    tree = cKDTree(np.column_stack([rows.ravel()[source_index], cols.ravel()[source_index]]))
+    grid_cols = np.arange(width, dtype=np.float64)
+    for row0 in range(0, length, BLOCK_ROWS):
+        row1 = min(row0 + BLOCK_ROWS, length)
+        yy, xx = np.meshgrid(np.arange(row0, row1, dtype=np.float64), grid_cols, indexing='ij')
+        distance, nearest = tree.query(np.column_stack([yy.ravel(), xx.ravel()]),
+                                       distance_upper_bound=max_distance)
+        covered = np.isfinite(distance)
+        block = np.full(distance.shape, -1, dtype=np.int32)
+        block[covered] = source_index[nearest[covered]]
+        index[row0:row1, :] = block.reshape(row1 - row0, width)
+    return index
+
+
+def get_lookup(lat_file, lon_file, cropbox, lat_step, lon_step, lookup_file=None):
+    """Lookup file of the lat/lon files and output grid; computed only if missing or outdated."""
+    if lookup_file is None:
+        lookup_file = os.path.join(os.path.dirname(os.path.abspath(lat_file)), LOOKUP_FILE)
+    fingerprint = get_fingerprint(lat_file, lon_file, cropbox, lat_step, lon_step)
+    if os.path.isfile(lookup_file):
+        with h5py.File(lookup_file, 'r') as f:
+            if f.attrs.get('FINGERPRINT') == fingerprint:
+                return lookup_file
+
+    time0 = time.time()
+    lat = read_raster(lat_file).astype(np.float64)
+    lon = read_raster(lon_file).astype(np.float64)
+    length, width, transform = get_output_grid(cropbox, lat_step, lon_step)
+    index = compute_lookup(lat, lon, length, width, transform)
+
+    # several export jobs of the stack may start at the same time: write and rename
+    tmp_file = '{}.{}.tmp'.format(lookup_file, os.getpid())
+    with h5py.File(tmp_file, 'w') as f:
+        f.create_dataset('index', data=index, chunks=True, compression='lzf')
+        f.attrs['FINGERPRINT'] = fingerprint
+        f.attrs['SOURCE_SHAPE'] = lat.shape
+        f.attrs['TRANSFORM'] = transform
+    os.replace(tmp_file, lookup_file)
+    print('computed geocoding lookup {} ({} x {}) in {:.1f} s'.format(lookup_file, length, width,
+                                                                    time.time() - time0))
+    return lookup_file
+
+
+def read_lookup(lookup_file):
+    """Index array, radar shape and geotransform of a lookup file."""
+    with h5py.File(lookup_file, 'r') as f:
+        return f['index'][:], tuple(f.attrs['SOURCE_SHAPE']), tuple(float(val) for val in f.attrs['TRANSFORM'])
+
+
+def apply_lookup(data, index, nodata=0):
+    """Geocode a radar coded array with the lookup index (nearest neighbour)."""
+    geo_data = data.ravel()[np.maximum(index, 0)]
+    geo_data[index < 0] = nodata
+    return geo_data
+
+
+def geocode_with_lookup(args):
+    """Read a radar coded image and geocode it; returns the absolute amplitude (runs in a worker)."""
+    fname, lookup_file = args
+    index, source_shape, transform = read_lookup(lookup_file)
+    data = read_raster(fname)
+    if data.shape != source_shape:
+        raise ValueError('{} has shape {}, the lookup was computed for {}'.format(fname, data.shape, source_shape))
+    return fname, np.abs(apply_lookup(data, index)).astype(np.float32), transform
+
+
+def geocode_files(files, lookup_file, num_workers=1):
+    """Geocode several images of the stack in parallel; yields (file, array, geotransform)."""
+    jobs = [(fname, lookup_file) for fname in files]
+    if num_workers > 1 and len(jobs) > 1:
+        with mp.Pool(min(num_workers, len(jobs))) as pool:
+            for result in pool.imap(geocode_with_lookup, jobs):
+                yield result
+    else:
+        for job in jobs:
+            yield geocode_with_lookup(job)
+
+
+def run_gdalwarp(fname, lat_file, lon_file, cropbox, lat_step, lon_step, out_file):
+    """gdalwarp -geoloc of one image, as done by export_amplitude_tif.geocode_file."""
+    from osgeo import gdal
+    south, north, west, east = [float(val) for val in cropbox.split()]
+    vrt_file = out_file + '.geoloc.vrt'
+    ds = gdal.Translate(vrt_file, fname + '.vrt' if os.path.isfile(fname + '.vrt') else fname, format='VRT')
+    ds.SetMetadata({'X_DATASET': os.path.abspath(lon_file + '.vrt' if os.path.isfile(lon_file + '.vrt') else lon_file),
+                    'X_BAND': '1',
+                    'Y_DATASET': os.path.abspath(lat_file + '.vrt' if os.path.isfile(lat_file + '.vrt') else lat_file),
+                    'Y_BAND': '1', 'PIXEL_OFFSET': '0', 'LINE_OFFSET': '0', 'PIXEL_STEP': '1', 'LINE_STEP': '1'},
+                   'GEOLOCATION')
+    ds = None
+    gdal.Warp(out_file, vrt_file, format='ENVI', geoloc=True, outputBounds=(west, south, east, north),
+              xRes=lon_step, yRes=lat_step, srcNodata=0, dstNodata=0, resampleAlg='near')
+    os.remove(vrt_file)
+
+
+def benchmark(inps):
+    """Time N gdalwarp calls against one lookup computation plus N gathers."""
+    import tempfile
+    files = inps.benchmark_files
+
+    time0 = time.time()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, fname in enumerate(files):
+            run_gdalwarp(fname, inps.lat_file, inps.lon_file, inps.cropbox, inps.lat_step, inps.lon_step,
+                         os.path.join(tmp_dir, 'geo_{}'.format(i)))
+    gdalwarp_seconds = time.time() - time0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        time0 = time.time()
+        lookup_file = get_lookup(inps.lat_file, inps.lon_file, inps.cropbox, inps.lat_step, inps.lon_step,
+                                 lookup_file=os.path.join(tmp_dir, LOOKUP_FILE))
+        lookup_seconds = time.time() - time0
+        time0 = time.time()
+        for result in geocode_files(files, lookup_file, num_workers=inps.num_workers):
+            pass
+        gather_seconds = time.time() - time0
+
+    print('{} images'.format(len(files)))
+    print('gdalwarp -geoloc:        {:8.1f} s  ({:.2f} s per image)'.format(gdalwarp_seconds, gdalwarp_seconds / len(files)))
+    print('lookup (once) + gather:  {:8.1f} s  ({:.1f} s lookup, {:.2f} s per image, {} workers)'.format(
+          lookup_seconds + gather_seconds, lookup_seconds, gather_seconds / len(files), inps.num_workers))
+    return gdalwarp_seconds, lookup_seconds, gather_seconds
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+
+    if inps.benchmark_files:
+        benchmark(inps)
+    else:
+        get_lookup(inps.lat_file, inps.lon_file, inps.cropbox, inps.lat_step, inps.lon_step)
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
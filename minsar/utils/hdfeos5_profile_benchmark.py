@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Benchmark the HDF-EOS5 storage profiles of save_hdfeos5.py on a synthetic displacement cube.
+
+For every profile it reports the write time, the file size, and the read latency of pixel
+time-series (insarmaps ingestion, point queries) and of single-date maps (viewers).
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import h5py
+import numpy as np
+from mintpy.save_hdfeos5 import STORAGE_PROFILES, get_storage_options, get_codec_name
+
+EXAMPLE = """example:
+  hdfeos5_profile_benchmark.py
+  hdfeos5_profile_benchmark.py --shape 150 2000 2500 --profile timeseries map
+"""
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Benchmark HDF-EOS5 storage profiles (chunk shape and compression)',
+                                     formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+    parser.add_argument('--shape', dest='shape', type=int, nargs=3, default=[100, 1000, 1200],
+                        metavar=('NUM_DATE', 'LENGTH', 'WIDTH'), help='cube size (default: %(default)s)')
+    parser.add_argument('--profile', dest='profiles', nargs='+', default=list(STORAGE_PROFILES.keys()),
+                        choices=list(STORAGE_PROFILES.keys()), help='profiles to compare (default: all)')
+    parser.add_argument('--num-query', dest='num_query', type=int, default=50,
+                        help='number of pixel time-series and maps read (default: %(default)s)')
+    parser.add_argument('--dir', dest='work_dir', default=None, help='directory for the test files (default: tmp)')
+    return parser
+
+
+def cmd_line_parse(iargs=None):
+    parser = create_parser()
+    return parser.parse_args(args=iargs)
+
+
+def synthetic_cube(shape, seed=0):
+    """Smooth deformation plus noise, masked (zero) in one corner like water/no data."""
+    num_date, length, width = shape
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:length, 0:width]
+    rate = 0.02 * np.exp(-((yy - length / 2) ** 2 + (xx - width / 2) ** 2) / (0.1 * length * width))
+    years = np.arange(num_date) * 12 / 365.25
+    cube = np.empty(shape, dtype=np.float32)
+    for i in range(num_date):
+        cube[i] = rate * years[i] + rng.normal(0, 0.002, (length, width))
+    cube[:, :length // 4, :width // 4] = 0
+    return cube
+
+
+def benchmark_profile(cube, profile, out_file, num_query, seed=0):
+    """Write cube with a profile and time the reads; returns a dict of results."""
+    num_date, length, width = cube.shape
+    time0 = time.time()
+    with h5py.File(out_file, 'w') as f:
+        dset = f.create_dataset('displacement', shape=cube.shape, maxshape=(None, length, width),
+                                dtype=np.float32, **get_storage_options(profile, cube.shape))
+        # row blocks of whole chunks, as written by save_hdfeos5.write_displacement
+        step = dset.chunks[1] * max(1, 64 // dset.chunks[1])
+        for y0 in range(0, length, step):
+            dset[:, y0:y0 + step, :] = cube[:, y0:y0 + step, :]
+        chunks = dset.chunks
+    write_seconds = time.time() - time0
+
+    rng = np.random.default_rng(seed)
+    rows, cols = rng.integers(0, length, num_query), rng.integers(0, width, num_query)
+    dates = rng.integers(0, num_date, num_query)
+    # a new file handle per query type to start from an empty chunk cache
+    with h5py.File(out_file, 'r') as f:
+        time0 = time.time()
+        for y, x in zip(rows, cols):
+            f['displacement'][:, y, x]
+        point_ms = (time.time() - time0) / num_query * 1000
+    with h5py.File(out_file, 'r') as f:
+        time0 = time.time()
+        for i in dates:
+            f['displacement'][i, :, :]
+        map_ms = (time.time() - time0) / num_query * 1000
+
+    return {'profile': profile,
+            'codec': get_codec_name(profile),
+            'chunks': chunks,
+            'write_s': write_seconds,
+            'size_mb': os.path.getsize(out_file) / 1024 ** 2,
+            'point_ms': point_ms,
+            'map_ms': map_ms}
+
+
+def print_results(results, raw_mb):
+    print('{:<11} {:<14} {:<16} {:>8} {:>9} {:>6} {:>9} {:>9}'.format(
+          'profile', 'codec', 'chunks', 'write_s', 'size_MB', 'ratio', 'point_ms', 'map_ms'))
+    for res in results:
+        print('{:<11} {:<14} {:<16} {:>8.2f} {:>9.1f} {:>6.2f} {:>9.2f} {:>9.2f}'.format(
+              res['profile'], res['codec'], str(res['chunks']), res['write_s'], res['size_mb'],
+              raw_mb / res['size_mb'], res['point_ms'], res['map_ms']))
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+
+    cube = synthetic_cube(tuple(inps.shape))
+    raw_mb = cube.nbytes / 1024 ** 2
+    print('synthetic cube of {} ({:.1f} MB)'.format(cube.shape, raw_mb))
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=inps.work_dir) as tmp_dir:
+        for profile in inps.profiles:
+            out_file = os.path.join(tmp_dir, 'benchmark_{}.he5'.format(profile))
+            results.append(benchmark_profile(cube, profile, out_file, inps.num_query))
+            print('{}: done'.format(profile))
+    print_results(results, raw_mb)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Pixel time-series queries of HDF-EOS5 (*.he5) products.
+
+The first query of a product builds a sidecar index file (<product>.he5.pointindex.h5) with
+  - a time-series-major chunked copy of the displacement (all dates of a small pixel block per
+    chunk), so one point reads one chunk instead of one slice per date,
+  - for radar-coded products, the latitude/longitude of the pixels sorted into bins with a table
+    of bin offsets, so a point or small polygon reads only the few bins around it.
+Geocoded products are located with the Y/X_FIRST, Y/X_STEP grid attributes. The index is rebuilt
+when the product changes (size or modification time).
+"""
+import os
+import sys
+import csv
+import time
+import argparse
+import h5py
+import numpy as np
+from matplotlib.path import Path as PolygonPath
+from minsar.utils.url2plot import parse_insarmaps_url
+
+INDEX_SUFFIX = '.pointindex.h5'
+GROUP = 'HDFEOS/GRIDS/timeseries'
+# all dates of CHUNK_SIZE x CHUNK_SIZE pixels per chunk of the displacement copy
+CHUNK_SIZE = 16
+MAX_BLOCK_MB = 128
+# pixels per bin (on average) of the radar-coded lat/lon index
+PIXELS_PER_BIN = 64
+
+EXAMPLE = """example:
+  he5_point_query.py S1_IW1_128_0596_0597_20160605_XXXXXXXX.he5 --build
+  he5_point_query.py S1_IW1_128_0596_0597_20160605_XXXXXXXX.he5 --lalo -0.81794 -91.13625
+  he5_point_query.py S1_IW1_128_0596_0597_20160605_XXXXXXXX.he5 --polygon "-91.137 -0.819,-91.135 -0.819,-91.135 -0.817,-91.137 -0.817"
+  he5_point_query.py S1_IW1_128_0596_0597_20160605_XXXXXXXX.he5 --csv points.csv -o points_timeseries.csv
+  he5_point_query.py --url "https://insarmaps.miami.edu/start/-0.8286/-91.1462/14.1973?startDataset=S1_IW1_128_0596_0597_20160605_XXXXXXXX&pointLat=-0.81794&pointLon=-91.13625"
+"""
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Pixel time-series queries of HDF-EOS5 products using a sidecar index',
+                                     formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+    parser.add_argument('he5_file', nargs='?', default=None, help='HDF-EOS5 file (default: startDataset of --url)')
+    parser.add_argument('--build', dest='build', action='store_true', help='(re)build the index and exit')
+    parser.add_argument('--lalo', dest='lalo', type=float, nargs=2, metavar=('LAT', 'LON'), help='query one point')
+    parser.add_argument('--polygon', dest='polygon', default=None,
+                        help='query the mean time-series of the pixels in a polygon: "lon lat,lon lat,..."\n'
+                             'or POLYGON((lon lat,...)) as scene_footprint')
+    parser.add_argument('--csv', dest='csv_file', default=None,
+                        help='batch query of the points in a CSV file with lat,lon columns (optional: name)')
+    parser.add_argument('--url', dest='url', default=None, help='query pointLat/pointLon of an insarmaps URL')
+    parser.add_argument('-o', '--output', dest='out_file', default=None, help='output CSV file (default: stdout)')
+    return parser
+
+
+def cmd_line_parse(iargs=None):
+    parser = create_parser()
+    inps = parser.parse_args(args=iargs)
+    if inps.url:
+        params = parse_insarmaps_url(inps.url)
+        if not inps.he5_file:
+            inps.he5_file = params['file'] + '.he5'
+        if not inps.lalo and params['point_lat'] is not None:
+            inps.lalo = [params['point_lat'], params['point_lon']]
+    if not inps.he5_file:
+        parser.print_usage()
+        raise SystemExit('error: he5_file or --url is required')
+    return inps
+
+
+def get_fingerprint(he5_file):
+    stat = os.stat(he5_file)
+    return f'{os.path.abspath(he5_file)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def get_index_file(he5_file):
+    return he5_file + INDEX_SUFFIX
+
+
+def read_str_attrs(obj):
+    return {key: (value.decode('utf8') if isinstance(value, bytes) else value) for key, value in obj.attrs.items()}
+
+
+def copy_timeseries_major(fi, fo, max_mb=MAX_BLOCK_MB):
+    """Copy the displacement into a dataset chunked as (num_date, CHUNK_SIZE, CHUNK_SIZE), in row blocks."""
+    dsi = fi[f'{GROUP}/observation/displacement']
+    num_date, length, width = dsi.shape
+    chunks = (num_date, min(CHUNK_SIZE, length), min(CHUNK_SIZE, width))
+    dso = fo.create_dataset('displacement', shape=dsi.shape, dtype=np.float32, chunks=chunks,
+                            compression='gzip', compression_opts=4, shuffle=True)
+    step = dsi.chunks[1] if dsi.chunks else 1
+    step = int(np.lcm(step, chunks[1]))
+    num_rows = max(1, int(max_mb * 1024 ** 2 / (num_date * width * 4)) // step) * step
+    for row0 in range(0, length, num_rows):
+        dso[:, row0:row0 + num_rows, :] = dsi[:, row0:row0 + num_rows, :]
+    return dso
+
+
+def build_radar_bins(fi, fo):
+    """Bin the pixels by latitude/longitude; writes sorted lat/lon/pixel index and the bin offset table."""
+    lat = fi[f'{GROUP}/geometry/latitude'][:]
+    lon = fi[f'{GROUP}/geometry/longitude'][:]
+    length, width = lat.shape
+    valid = (lat != 0) & (lon != 0) & np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) < 90)
+    pixel = np.flatnonzero(valid)
+    lat, lon = lat.ravel()[pixel], lon.ravel()[pixel]
+
+    south, north, west, east = lat.min(), lat.max(), lon.min(), lon.max()
+    # square bins holding PIXELS_PER_BIN pixels on average
+    bin_size = float(np.sqrt((north - south) * (east - west) / max(pixel.size, 1) * PIXELS_PER_BIN))
+    bin_size = max(bin_size, 1e-6)
+    num_row = int((north - south) // bin_size) + 1
+    num_col = int((east - west) // bin_size) + 1
+    key = ((lat - south) // bin_size).astype(np.int64) * num_col + ((lon - west) // bin_size).astype(np.int64)
+    order = np.argsort(key, kind='stable')
+    bin_start = np.searchsorted(key[order], np.arange(num_row * num_col + 1))
+
+    fo.create_dataset('pixel', data=pixel[order].astype(np.int64), chunks=True)
+    fo.create_dataset('latitude', data=lat[order].astype(np.float32), chunks=True)
+    fo.create_dataset('longitude', data=lon[order].astype(np.float32), chunks=True)
+    fo.create_dataset('bin_start', data=bin_start.astype(np.int64), chunks=True)
+    fo.attrs.update({'BIN_SOUTH': south, 'BIN_WEST': west, 'BIN_SIZE': bin_size,
+                     'BIN_ROWS': num_row, 'BIN_COLS': num_col, 'LENGTH': length, 'WIDTH': width})
+    return
+
+
+def build_index(he5_file, index_file=None):
+    """Write the sidecar index of he5_file; returns the index file."""
+    index_file = index_file or get_index_file(he5_file)
+    time0 = time.time()
+    tmp_file = index_file + '.tmp'
+    with h5py.File(he5_file, 'r') as fi, h5py.File(tmp_file, 'w') as fo:
+        attrs = read_str_attrs(fi)
+        fo.create_dataset('date', data=fi[f'{GROUP}/observation/date'][:])
+        copy_timeseries_major(fi, fo)
+        if 'Y_FIRST' in attrs.keys():
+            fo.attrs['COORDINATES'] = 'GEO'
+            for key in ['Y_FIRST', 'Y_STEP', 'X_FIRST', 'X_STEP', 'LENGTH', 'WIDTH']:
+                fo.attrs[key] = float(attrs[key])
+        else:
+            fo.attrs['COORDINATES'] = 'RADAR'
+            build_radar_bins(fi, fo)
+        fo.attrs['SOURCE'] = get_fingerprint(he5_file)
+    os.replace(tmp_file, index_file)
+    print('built index {} in {:.1f} s'.format(index_file, time.time() - time0), file=sys.stderr)
+    return index_file
+
+
+def open_index(he5_file):
+    """Open the index of he5_file, (re)building it if missing or out of date."""
+    index_file = get_index_file(he5_file)
+    if os.path.isfile(index_file):
+        with h5py.File(index_file, 'r') as f:
+            current = f.attrs.get('SOURCE') == get_fingerprint(he5_file)
+        if not current:
+            print(f'{he5_file} changed, rebuilding the index', file=sys.stderr)
+            build_index(he5_file, index_file)
+    else:
+        build_index(he5_file, index_file)
+    # a chunk cache of a few chunks is enough for point queries
+    return h5py.File(index_file, 'r', rdcc_nbytes=16 * 1024 ** 2)
+
+
+def get_dates(index):
+    return [d.decode('utf8') for d in index['date'][:]]
+
+
+def find_bin_pixels(index, south, north, west, east):
+    """Pixel index and lat/lon of the radar-coded pixels in the bins touching the bounding box."""
+    size, num_row, num_col = index.attrs['BIN_SIZE'], int(index.attrs['BIN_ROWS']), int(index.attrs['BIN_COLS'])
+    r0 = max(int((south - index.attrs['BIN_SOUTH']) // size), 0)
+    r1 = min(int((north - index.attrs['BIN_SOUTH']) // size), num_row - 1)
+    c0 = max(int((west - index.attrs['BIN_WEST']) // size), 0)
+    c1 = min(int((east - index.attrs['BIN_WEST']) // size), num_col - 1)
+    pixel, lat, lon = [], [], []
+    for r in range(r0, r1 + 1):
+        # the bins of one row of the bin grid are contiguous in the sorted arrays
+        start, end = index['bin_start'][r * num_col + c0], index['bin_start'][r * num_col + c1 + 1]
+        if end > start:
+            pixel.append(index['pixel'][start:end])
+            lat.append(index['latitude'][start:end])
+            lon.append(index['longitude'][start:end])
+    if not pixel:
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    return np.concatenate(pixel), np.concatenate(lat), np.concatenate(lon)
+
+
+def locate_point(index, lat, lon):
+    """(row, col) of the pixel nearest to lat/lon, None if outside of the product."""
+    if index.attrs['COORDINATES'] == 'GEO':
+        row = int(np.floor((lat - index.attrs['Y_FIRST']) / index.attrs['Y_STEP']))
+        col = int(np.floor((lon - index.attrs['X_FIRST']) / index.attrs['X_STEP']))
+        if 0 <= row < index.attrs['LENGTH'] and 0 <= col < index.attrs['WIDTH']:
+            return row, col
+        return None
+
+    size = index.attrs['BIN_SIZE']
+    pixel, plat, plon = find_bin_pixels(index, lat - size, lat + size, lon - size, lon + size)
+    if pixel.size == 0:
+        return None
+    distance = (plat - lat) ** 2 + ((plon - lon) * np.cos(np.deg2rad(lat))) ** 2
+    nearest = np.argmin(distance)
+    if distance[nearest] > size ** 2:
+        return None
+    return divmod(int(pixel[nearest]), int(index.attrs['WIDTH']))
+
+
+def query_point(index, lat, lon):
+    """Displacement time-series (num_date,) of the pixel nearest to lat/lon and its (row, col)."""
+    rowcol = locate_point(index, lat, lon)
+    if rowcol is None:
+        return None, None
+    return index['displacement'][:, rowcol[0], rowcol[1]], rowcol
+
+
+def parse_polygon(polygon):
+    """[(lon, lat), ...] of 'lon lat,lon lat,...' or POLYGON((lon lat,...))."""
+    polygon = polygon.upper().replace('POLYGON', '').replace('(', '').replace(')', '')
+    return [tuple(float(v) for v in vertex.split()) for vertex in polygon.split(',') if vertex.strip()]
+
+
+def query_polygon(index, polygon):
+    """Mean displacement time-series of the pixels inside polygon [(lon, lat), ...] and number of pixels."""
+    vertices = np.array(polygon, dtype=np.float64)
+    path = PolygonPath(vertices)
+    west, south = vertices.min(axis=0)
+    east, north = vertices.max(axis=0)
+    width = int(index.attrs['WIDTH'])
+
+    if index.attrs['COORDINATES'] == 'GEO':
+        rows = sorted([(north - index.attrs['Y_FIRST']) / index.attrs['Y_STEP'],
+                       (south - index.attrs['Y_FIRST']) / index.attrs['Y_STEP']])
+        cols = sorted([(west - index.attrs['X_FIRST']) / index.attrs['X_STEP'],
+                       (east - index.attrs['X_FIRST']) / index.attrs['X_STEP']])
+        y0, y1 = max(int(np.floor(rows[0])), 0), min(int(np.ceil(rows[1])), int(index.attrs['LENGTH']))
+        x0, x1 = max(int(np.floor(cols[0])), 0), min(int(np.ceil(cols[1])), width)
+        if y1 <= y0 or x1 <= x0:
+            return None, 0
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        plat = index.attrs['Y_FIRST'] + (yy.ravel() + 0.5) * index.attrs['Y_STEP']
+        plon = index.attrs['X_FIRST'] + (xx.ravel() + 0.5) * index.attrs['X_STEP']
+        pixel = yy.ravel() * width + xx.ravel()
+    else:
+        pixel, plat, plon = find_bin_pixels(index, south, north, west, east)
+
+    inside = path.contains_points(np.column_stack([plon, plat]))
+    if not np.any(inside):
+        return None, 0
+    rows, cols = np.divmod(pixel[inside], width)
+    # read the bounding window once (few chunks) and pick the pixels
+    y0, x0 = rows.min(), cols.min()
+    window = index['displacement'][:, y0:rows.max() + 1, x0:cols.max() + 1]
+    data = window[:, rows - y0, cols - x0]
+    with np.errstate(invalid='ignore'):
+        data[data == 0] = np.nan
+        mean = np.nanmean(data, axis=1)
+    return mean, int(inside.sum())
+
+
+def query_csv(index, csv_file):
+    """Time-series of all points of a CSV file with lat,lon (and optional name) columns."""
+    rows = []
+    with open(csv_file, 'r') as f:
+        for i, record in enumerate(csv.DictReader(f)):
+            record = {key.strip().lower(): value for key, value in record.items()}
+            lat, lon = float(record['lat']), float(record['lon'])
+            data, rowcol = query_point(index, lat, lon)
+            rows.append((record.get('name', str(i)), lat, lon, rowcol, data))
+    return rows
+
+
+def write_table(dates, rows, out_file=None):
+    """One line per point: name, lat, lon, row, col and the displacement of every date."""
+    f = open(out_file, 'w', newline='') if out_file else sys.stdout
+    writer = csv.writer(f)
+    writer.writerow(['name', 'lat', 'lon', 'row', 'col'] + dates)
+    for name, lat, lon, rowcol, data in rows:
+        values = ['{:.5f}'.format(v) for v in data] if data is not None else [''] * len(dates)
+        rowcol = rowcol if rowcol is not None else ('', '')
+        writer.writerow([name, lat, lon, rowcol[0], rowcol[1]] + values)
+    if out_file:
+        f.close()
+        print('writing ', out_file)
+    return
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+
+    if inps.build:
+        build_index(inps.he5_file)
+        return
+
+    with open_index(inps.he5_file) as index:
+        dates = get_dates(index)
+        time0 = time.time()
+        if inps.csv_file:
+            rows = query_csv(index, inps.csv_file)
+        elif inps.polygon:
+            data, num_pixel = query_polygon(index, parse_polygon(inps.polygon))
+            rows = [(f'polygon_{num_pixel}_pixels', np.nan, np.nan, None, data)]
+        elif inps.lalo:
+            data, rowcol = query_point(index, inps.lalo[0], inps.lalo[1])
+            rows = [('point', inps.lalo[0], inps.lalo[1], rowcol, data)]
+        else:
+            raise SystemExit('error: one of --lalo, --polygon, --csv or --url with pointLat/pointLon is required')
+        milliseconds = (time.time() - time0) * 1000
+
+    write_table(dates, rows, inps.out_file)
+    print('{} queries in {:.1f} ms'.format(len(rows), milliseconds), file=sys.stderr)
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Patch cost model for MiaplPy phase linking.
+
+The phase linking step runs one task per group of num_worker patches (task --index i processes
+patches i*num_worker ... (i+1)*num_worker-1). Patches with many valid distributed-scatterer (DS)
+pixels take much longer than patches over water or with mostly persistent scatterers (PS), so
+splitting tasks into jobs by count gives unbalanced jobs. This script predicts the run time of
+each patch from the mask and amplitude dispersion, job_submission.py uses the prediction to balance
+the tasks among jobs, and recorded task timings refine the model.
+job_submission.py writes the cost file from the options of the phase linking tasks when it splits the
+run file into jobs, if it does not exist yet.
+"""
+import os
+import re
+import sys
+import shlex
+import glob
+import json
+import argparse
+import heapq
+import h5py
+import numpy as np
+
+COST_FILE = 'patch_costs.json'
+MODEL_FILE = 'patch_cost_model.json'
+TIMINGS_FILE = 'patch_task_timings.txt'
+
+# seconds = overhead + num_dates * (ds * num_ds_pixels + ps * num_ps_pixels)
+# the default corresponds to seconds_factor=2.2 of miaplpy_phase_linking for a 200 x 200 DS patch
+DEFAULT_COST_MODEL = {'overhead': 10.0, 'ds': 2.2 / 40000, 'ps': 0.1 * 2.2 / 40000}
+AMP_DISPERSION_THRESHOLD = 0.25
+NUM_SAMPLE_DATES = 20
+# defaults of miaplpy.inversion.patchSize, rangeWindow and azimuthWindow
+PATCH_SIZE = 200
+RANGE_WINDOW = 19
+AZIMUTH_WINDOW = 9
+# phase linking options (MiaplPy phase_linking.py) read from the tasks of the run file
+TASK_OPTIONS = {'slc_stack': ['-f', '--slc-stack', '--slc_stack'],
+                'mask_file': ['-m', '--mask'],
+                'patch_size': ['--patch-size', '--patch_size'],
+                'range_window': ['--range-window', '--range_window'],
+                'azimuth_window': ['--azimuth-window', '--azimuth_window'],
+                'num_worker': ['--num-worker', '--num_worker']}
+
+EXAMPLE = """example:
+  phase_linking_cost.py miaplpy/inputs/slcStack.h5 --patch-size 200 --num-worker 4
+  phase_linking_cost.py miaplpy/inputs/slcStack.h5 --mask miaplpy/maskPS.h5 --out-dir miaplpy
+  phase_linking_cost.py --refine miaplpy
+"""
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Predict MiaplPy phase linking run time per patch',
+                                     formatter_class=argparse.RawTextHelpFormatter, epilog=EXAMPLE)
+    parser.add_argument('slc_stack', nargs='?', default=None, help='slcStack.h5 file')
+    parser.add_argument('--patch-size', dest='patch_size', type=int, default=PATCH_SIZE,
+                        help='patch size of miaplpy.inversion.patchSize (default: %(default)s)')
+    parser.add_argument('--range-window', dest='range_window', type=int, default=RANGE_WINDOW,
+                        help='miaplpy.inversion.rangeWindow, sets the patch overlap (default: %(default)s)')
+    parser.add_argument('--azimuth-window', dest='azimuth_window', type=int, default=AZIMUTH_WINDOW,
+                        help='miaplpy.inversion.azimuthWindow, sets the patch overlap (default: %(default)s)')
+    parser.add_argument('--num-worker', dest='num_worker', type=int, default=1,
+                        help='patches per phase linking task (miaplpy.multiprocessing.numProcessor) (default: %(default)s)')
+    parser.add_argument('--mask', dest='mask_file', default=None, help='mask file (non-zero: pixel is processed)')
+    parser.add_argument('--out-dir', dest='out_dir', default=None,
+                        help='directory for {} (default: directory of slc_stack/..)'.format(COST_FILE))
+    parser.add_argument('--refine', dest='refine_dir', default=None, metavar='DIR',
+                        help='fit the cost model to the task timings recorded in DIR')
+    return parser
+
+
+def cmd_line_parse(iargs=None):
+    parser = create_parser()
+    inps = parser.parse_args(args=iargs)
+    if not inps.slc_stack and not inps.refine_dir:
+        parser.print_usage()
+        raise SystemExit('error: slc_stack or --refine is required')
+    return inps
+
+
+def get_patch_boxes(length, width, patch_size, azimuth_window=AZIMUTH_WINDOW, range_window=RANGE_WINDOW):
+    """Patch boxes (x0, y0, x1, y1) in the order of MiaplPy phase linking (row-major).
+    As in MiaplPy's patch_slice, the patches after the first row (column) start 2 * azimuth_window
+    (2 * range_window) earlier and overlap the previous patch.
+    """
+    row0 = np.ogrid[0:max(length - 50, 1):patch_size]
+    col0 = np.ogrid[0:max(width - 50, 1):patch_size]
+    row1 = row0 + patch_size
+    col1 = col0 + patch_size
+    row1[-1] = length
+    col1[-1] = width
+    row0[1:] -= 2 * azimuth_window
+    col0[1:] -= 2 * range_window
+    return [(int(col0[j]), int(row0[i]), int(col1[j]), int(row1[i]))
+            for i in range(len(row0)) for j in range(len(col0))]
+
+
+def read_mask(mask_file):
+    """First 2D dataset of an HDF5 mask file as bool array."""
+    with h5py.File(mask_file, 'r') as f:
+        dsets = []
+        f.visititems(lambda name, obj: dsets.append(name) if isinstance(obj, h5py.Dataset) and obj.ndim == 2 else None)
+        return f[dsets[0]][:] != 0
+
+
+def compute_patch_features(slc_file, patch_size, mask_file=None, azimuth_window=AZIMUTH_WINDOW,
+                           range_window=RANGE_WINDOW, num_sample_dates=NUM_SAMPLE_DATES,
+                           da_threshold=AMP_DISPERSION_THRESHOLD):
+    """Number of valid DS and PS pixels per patch, from the amplitude dispersion of sampled dates.
+    The SLC stack is read in strips of one patch row.
+    """
+    with h5py.File(slc_file, 'r') as f:
+        dset = f['slc']
+        num_dates, length, width = dset.shape
+        date_index = np.unique(np.linspace(0, num_dates - 1, min(num_sample_dates, num_dates)).astype(int))
+        mask = read_mask(mask_file) if mask_file else np.ones((length, width), dtype=np.bool_)
+
+        boxes = get_patch_boxes(length, width, patch_size, azimuth_window, range_window)
+        features = []
+        strip = None
+        for box in boxes:
+            x0, y0, x1, y1 = box
+            if strip is None or strip[0] != y0:
+                amplitude = np.abs(dset[date_index.tolist(), y0:y1, :])
+                mean = amplitude.mean(axis=0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    dispersion = amplitude.std(axis=0) / mean
+                strip = (y0, mean, dispersion)
+            valid = mask[y0:y1, x0:x1] * (strip[1][:, x0:x1] > 0)
+            num_ps = int(np.sum(valid * (strip[2][:, x0:x1] < da_threshold)))
+            num_valid = int(np.sum(valid))
+            features.append({'box': list(box), 'num_ds': num_valid - num_ps, 'num_ps': num_ps})
+    return features, int(num_dates)
+
+
+def predict_seconds(feature, num_dates, model=DEFAULT_COST_MODEL):
+    """Predicted phase linking time of one patch."""
+    return model['overhead'] + num_dates * (model['ds'] * feature['num_ds'] + model['ps'] * feature['num_ps'])
+
+
+def read_cost_model(work_dir):
+    model_file = os.path.join(work_dir, MODEL_FILE)
+    if os.path.isfile(model_file):
+        with open(model_file, 'r') as f:
+            return json.load(f)
+    return dict(DEFAULT_COST_MODEL)
+
+
+def estimate_patch_costs(slc_file, patch_size, num_worker=1, mask_file=None, out_dir=None,
+                         azimuth_window=AZIMUTH_WINDOW, range_window=RANGE_WINDOW):
+    """Write patch features and predicted seconds per patch and per task to COST_FILE."""
+    if out_dir is None:
+        out_dir = os.path.dirname(os.path.dirname(os.path.abspath(slc_file)))
+    model = read_cost_model(out_dir)
+    features, num_dates = compute_patch_features(slc_file, patch_size, mask_file=mask_file,
+                                                 azimuth_window=azimuth_window, range_window=range_window)
+    for feature in features:
+        feature['seconds'] = predict_seconds(feature, num_dates, model)
+
+    seconds = [feature['seconds'] for feature in features]
+    task_seconds = [sum(seconds[i:i + num_worker]) for i in range(0, len(seconds), num_worker)]
+    costs = {'slc_stack': os.path.abspath(slc_file),
+             'num_dates': num_dates,
+             'patch_size': patch_size,
+             'range_window': range_window,
+             'azimuth_window': azimuth_window,
+             'num_worker': num_worker,
+             'model': model,
+             'patches': features,
+             'task_seconds': task_seconds}
+    cost_file = os.path.join(out_dir, COST_FILE)
+    with open(cost_file, 'w') as f:
+        json.dump(costs, f, indent=1)
+
+    print('{} patches in {} tasks, predicted task time: min {:.0f} s, median {:.0f} s, max {:.0f} s'.format(
+          len(features), len(task_seconds), min(task_seconds), np.median(task_seconds), max(task_seconds)))
+    print('writing ', cost_file)
+    return costs
+
+
+def find_cost_file(batch_file):
+    """COST_FILE of the miaplpy directory of a run file (miaplpy/network_*/run_files/run_*), None if missing."""
+    run_files_dir = os.path.dirname(os.path.abspath(batch_file))
+    for work_dir in [os.path.dirname(run_files_dir), os.path.dirname(os.path.dirname(run_files_dir))]:
+        cost_file = os.path.join(work_dir, COST_FILE)
+        if os.path.isfile(cost_file):
+            return cost_file
+    return None
+
+
+def get_task_options(task):
+    """Options of a phase linking task line (TASK_OPTIONS); the SLC stack defaults to the *slcStack.h5 argument."""
+    args = shlex.split(task.split('\n')[0].split(';')[0])
+    options = {}
+    for name, flags in TASK_OPTIONS.items():
+        for i, arg in enumerate(args[:-1]):
+            if arg in flags:
+                options[name] = args[i + 1]
+    if 'slc_stack' not in options:
+        slc_files = [arg for arg in args if arg.endswith('slcStack.h5')]
+        if slc_files:
+            options['slc_stack'] = slc_files[0]
+    for name in ['patch_size', 'range_window', 'azimuth_window', 'num_worker']:
+        if name in options:
+            options[name] = int(options[name]) if options[name].isdigit() else None
+    return options
+
+
+def create_cost_file(tasks):
+    """Write COST_FILE for the phase linking tasks of a run file, using the options of the first task.
+    Returns the cost file, None if the SLC stack is not known.
+    """
+    options = get_task_options(tasks[0]) if tasks else {}
+    if not options.get('slc_stack') or not os.path.isfile(options['slc_stack']):
+        print('SLC stack of the phase linking tasks not found, no patch cost prediction')
+        return None
+    mask_file = options.get('mask_file')
+    estimate_patch_costs(options['slc_stack'],
+                         options.get('patch_size') or PATCH_SIZE,
+                         num_worker=options.get('num_worker') or 1,
+                         mask_file=mask_file if mask_file and os.path.isfile(mask_file) else None,
+                         azimuth_window=options.get('azimuth_window') or AZIMUTH_WINDOW,
+                         range_window=options.get('range_window') or RANGE_WINDOW)
+    return os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(options['slc_stack']))), COST_FILE)
+
+
+def get_task_index(task, default):
+    """Task (patch group) index from the --index option of a phase linking command."""
+    match = re.search(r'--index\s+(\d+)', task)
+    return int(match.group(1)) if match else default
+
+
+def get_task_seconds(tasks, cost_file):
+    """Predicted seconds of each task line."""
+    with open(cost_file, 'r') as f:
+        task_seconds = json.load(f)['task_seconds']
+    mean_seconds = float(np.mean(task_seconds))
+    seconds = []
+    for i, task in enumerate(tasks):
+        index = get_task_index(task, i)
+        seconds.append(task_seconds[index] if index < len(task_seconds) else mean_seconds)
+    return seconds
+
+
+def balance_tasks(task_seconds, number_of_jobs, max_tasks_per_job=None):
+    """Assign tasks to jobs, longest task first to the job with the least predicted time.
+    Jobs with max_tasks_per_job tasks (the tasks a node can run at once) are full and skipped.
+    Returns a list of task index lists (in original order within a job) and the predicted job seconds.
+    """
+    number_of_jobs = max(1, min(int(number_of_jobs), len(task_seconds)))
+    if max_tasks_per_job:
+        number_of_jobs = max(number_of_jobs, int(np.ceil(len(task_seconds) / max_tasks_per_job)))
+    heap = [(0.0, job) for job in range(number_of_jobs)]
+    jobs = [[] for i in range(number_of_jobs)]
+    for index in np.argsort(task_seconds, kind='stable')[::-1]:
+        seconds, job = heapq.heappop(heap)
+        jobs[job].append(int(index))
+        if not max_tasks_per_job or len(jobs[job]) < max_tasks_per_job:
+            heapq.heappush(heap, (seconds + task_seconds[index], job))
+    job_seconds = [sum(task_seconds[i] for i in job) for job in jobs]
+    return [sorted(job) for job in jobs], job_seconds
+
+
+def add_timing_to_task(task, index, timings_file):
+    """Shell command group that runs task and appends 'index seconds' to timings_file."""
+    return '{{ t0=$(date +%s); {}; echo "{} $(( $(date +%s) - t0 ))" >> {}; }}\n'.format(
+        task.split('\n')[0], index, timings_file)
+
+
+def refine_cost_model(work_dir):
+    """Least-squares fit of the cost model to recorded task timings; writes MODEL_FILE."""
+    with open(os.path.join(work_dir, COST_FILE), 'r') as f:
+        costs = json.load(f)
+    timings = {}
+    for timings_file in glob.glob(os.path.join(work_dir, '*', 'run_files', TIMINGS_FILE)) + \
+                        glob.glob(os.path.join(work_dir, 'run_files', TIMINGS_FILE)):
+        with open(timings_file, 'r') as f:
+            for line in f:
+                if len(line.split()) == 2:
+                    index, seconds = line.split()
+                    timings[int(index)] = float(seconds)
+    if len(timings) < 3:
+        print('not enough task timings ({}) to refine the cost model'.format(len(timings)))
+        return read_cost_model(work_dir)
+
+    patches = costs['patches']
+    num_worker = costs['num_worker']
+    num_dates = costs['num_dates']
+    A, b = [], []
+    for index, seconds in sorted(timings.items()):
+        group = patches[index * num_worker:(index + 1) * num_worker]
+        if not group:
+            continue
+        A.append([len(group),
+                  num_dates * sum(p['num_ds'] for p in group),
+                  num_dates * sum(p['num_ps'] for p in group)])
+        b.append(seconds)
+    coef = np.clip(np.linalg.lstsq(np.array(A, dtype=np.float64), np.array(b), rcond=None)[0], 0, None)
+    model = {'overhead': float(coef[0]), 'ds': float(coef[1]), 'ps': float(coef[2]), 'num_timings': len(b)}
+
+    residual = np.array(b) - np.array(A).dot(coef)
+    print('refined cost model from {} tasks: {}, rms residual {:.1f} s'.format(
+          len(b), model, np.sqrt(np.mean(residual ** 2))))
+    with open(os.path.join(work_dir, MODEL_FILE), 'w') as f:
+        json.dump(model, f, indent=2)
+    return model
+
+
+def main(iargs=None):
+    inps = cmd_line_parse(iargs)
+
+    if inps.refine_dir:
+        refine_cost_model(inps.refine_dir)
+        return
+
+    estimate_patch_costs(inps.slc_stack, inps.patch_size, num_worker=inps.num_worker,
+                         mask_file=inps.mask_file, out_dir=inps.out_dir,
+                         azimuth_window=inps.azimuth_window, range_window=inps.range_window)
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -47,6 +47,8 @@ def cmd_line_parse(iargs=None, script=None):
         parser = add_execute_runfiles(parser)
     if script == 'export_amplitude_tif':
         parser = add_export_amplitude(parser)
+    if script == 'ifgramStack_to_ifgram_and_coherence':
+        parser = add_export_ifgram(parser)
     if script == 'email_results':
         parser = add_email_args(parser)
     if script == 'generate_chunk_template_files':
@@ -144,7 +146,7 @@ def add_execute_runfiles(parser):
 
 def add_export_amplitude(parser):
     products = parser.add_argument_group('Options for exporting geo/ortho-rectified products')
-    products.add_argument('-f', '--file', dest='input_file', type=str, help='Input SLC')
+    products.add_argument('-f', '--file', dest='input_file', type=str, nargs='+', help='Input SLC(s)')
     products.add_argument('-l', '--lat', dest='lat_file', type=str,
                           default='lat.rdr.ml', help='latitude file in radar coordinate')
     products.add_argument('-L', '--lon', dest='lon_file', type=str,
@@ -158,6 +160,18 @@ def add_export_amplitude(parser):
     products.add_argument('-t', '--type', dest='im_type', type=str, default='ortho',
                           help="ortho, geo")
     products.add_argument('--outDir', dest='out_dir', default='image_products', help='output directory.')
+    products.add_argument('--num-workers', dest='num_workers', type=int, default=min(8, os.cpu_count() or 1),
+                          help='number of SLCs geocoded in parallel (default: %(default)s)')
+
+    return parser
+
+
+def add_export_ifgram(parser):
+    products = parser.add_argument_group('Options for exporting interferograms and coherence as GeoTIFF')
+    products.add_argument('--num-workers', dest='num_workers', type=int, default=min(8, os.cpu_count() or 1),
+                          help='number of GeoTIFFs written in parallel (default: %(default)s)')
+    products.add_argument('--force', dest='force', action='store_true',
+                          help='re-export GeoTIFFs even if they are up to date')
 
     return parser
 
@@ -69,6 +69,8 @@ cp -p minsar/additions/mintpy/cli/save_hdfeos5.py tools/MintPy/src/mintpy/cli/
 cp -p minsar/additions/miaplpy/prep_slc_isce.py tools/MiaplPy/src/miaplpy
 cp minsar/additions/miaplpy/unwrap_ifgram.py tools/MiaplPy/src/miaplpy
 cp minsar/additions/miaplpy/utils.py tools/MiaplPy/src/miaplpy/objects
+cp -p minsar/additions/miaplpy/concatenate_patches_parallel.py tools/MiaplPy/src/miaplpy
+cp -p minsar/additions/miaplpy/sequential_phase_linking.py tools/MiaplPy/src/miaplpy
 
 ### Adding ISCE fixes and copying checked-out ISCE version (the latest) into miniforge directory ###
 if [[ "$(uname)" == "Linux" ]]; then